@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Python sample demonstrating use of the Google Genomics Pipelines API.
+
+This sample demonstrates running several quality-control tools over one
+or more BAM or FASTQ files in Google Cloud Storage in a single pipeline:
+
+  index:     samtools index     (BAM inputs; writes <file>.bai)
+  flagstat:  samtools flagstat  (BAM inputs; writes <file>.flagstat)
+  idxstats:  samtools idxstats  (BAM inputs; writes <file>.idxstats)
+  fastqc:    FastQC             (all inputs; writes <name>_fastqc.html/.zip)
+  gzip:      gzip               (uncompressed inputs; writes <file>.gz)
+
+Running the samtools, fastqc and compress samples separately pays for a VM
+start, a Docker image pull and a full copy of each input three times. Here
+each input is copied to the VM once and the selected steps run concurrently
+against the local copy; all outputs are copied to Cloud Storage together.
+
+Usage:
+  * python run_bam_qc.py \
+      --project <project-id> \
+      --zones <gce-zones> \
+      --disk-size <size-in-gb> \
+      --steps <step> [<step> ...] \
+      --input <gcs-input-path> \
+      --output <gcs-output-path> \
+      --logging <gcs-logging-path> \
+      --poll-interval <interval-in-seconds>
+
+Where the steps are optional (default is all steps) and the poll-interval is
+optional (default is no polling). When polling, the operations of all the
+requests are refreshed together. The idxstats step requires the index, so
+selecting idxstats also selects index.
+
+The steps run as many at once as the VM has cores; use --cpus to request
+a larger machine.
+
+The options shared by the batch launchers, such as --input-manifest,
+--journal, --cache-dir, --speculate, --zone-failover, --subscription,
+--quota-regions, --auto-resources and --plan, are described in
+pipelines_pylib/launch.py.
+
+Users will typically want to restrict the Compute Engine zones to avoid Cloud
+Storage egress charges. This script supports a short-hand pattern-matching
+for specifying zones, such as:
+
+  --zones "*"                # All zones
+  --zones "us-*"             # All US zones
+  --zones "us-central1-*"    # All us-central1 zones
+
+an explicit list may be specified, space-separated:
+  --zones us-central1-a us-central1-b
+"""
+
+import argparse
+import collections
+import itertools
+
+from pipelines_pylib import clients
+from pipelines_pylib import defaults
+from pipelines_pylib import gcs
+from pipelines_pylib import inputs
+from pipelines_pylib import launch
+from pipelines_pylib import metrics
+from pipelines_pylib import packing
+
+# The command for each step, keyed by step name, along with the shell "case"
+# pattern of the input files it applies to. Commands are run from the input
+# directory for each localized input ${file} and write to ${OUT}.
+STEPS = collections.OrderedDict([
+  ('index', ('*.bam',
+             'samtools index ${file} ${OUT}/${file}.bai && '
+             'ln -sf ${OUT}/${file}.bai ${file}.bai')),
+  ('idxstats', ('*.bam',
+                'samtools idxstats ${file} > ${OUT}/${file}.idxstats')),
+  ('flagstat', ('*.bam',
+                'samtools flagstat ${file} > ${OUT}/${file}.flagstat')),
+  ('fastqc', ('*',
+              'fastqc ${file} --outdir=${OUT}')),
+  ('gzip', ('*',
+            'case ${file} in *.gz|*.bz2|*.bam|*.cram) ;; '
+            '*) gzip -c ${file} > ${OUT}/${file}.gz;; esac')),
+])
+
+# Steps which must follow another step on the same file
+STEP_DEPENDENCIES = {
+  'idxstats': 'index',
+}
+
+
+def build_command(steps):
+  """Returns the Docker command which runs the given steps.
+
+  Each independent step (or chain of dependent steps) over each input file
+  is a task. The tasks are run by xargs, as many at once as the VM has
+  cores; the command fails if any of them failed.
+  """
+
+  chains = collections.OrderedDict()
+  for step, (pattern, cmd) in STEPS.items():
+    if step not in steps:
+      continue
+
+    head = STEP_DEPENDENCIES.get(step, step)
+    chains.setdefault(head, (pattern, []))[1].append(cmd)
+
+  # Each task is a line "<chain> <file>", which xargs passes to a shell as
+  # $0 and $1
+  tasks = [
+    'case ${file} in %s) echo "%d ${file}";; esac' % (pattern, idx)
+    for idx, (pattern, _) in enumerate(chains.values())
+  ]
+  run = ' '.join('%d) (%s);;' % (idx, ' && '.join(cmds))
+                  for idx, (_, cmds) in enumerate(chains.values()))
+
+  return ('export OUT=/mnt/data/output && mkdir -p ${OUT} && '
+          'cd /mnt/data/input && '
+          '(for file in $(/bin/ls); do %s; done) | '
+          'xargs -n 2 -P $(nproc) bash -c \'file=$1; case $0 in %s esac\'') % (
+              '; '.join(tasks), run)
+
+
+# Parse input args
+parser = argparse.ArgumentParser()
+parser.add_argument("--project", required=True,
+                    help="Cloud project id to run the pipeline in")
+parser.add_argument("--disk-size", required=True, type=int,
+                    help="Size (in GB) of disk for both input and output")
+parser.add_argument("--zones", required=True, nargs="+",
+                    help="List of Google Compute Engine zones (supports wildcards)")
+parser.add_argument("--steps", nargs="+", choices=STEPS.keys(),
+                    default=STEPS.keys(),
+                    help="Steps to run over each input (default: all steps)")
+parser.add_argument("--cpus", default=1, type=int,
+                    help="Minimum number of CPU cores for the VM")
+parser.add_argument("--output", required=True,
+                    help="Cloud Storage path to write output files")
+parser.add_argument("--logging", required=True,
+                    help="Cloud Storage path to send logging output")
+launch.add_arguments(parser)
+args = launch.parse_args(parser)
+
+steps = set(args.steps)
+steps.update(STEP_DEPENDENCIES[s] for s in args.steps if s in STEP_DEPENDENCIES)
+
+# Create the Cloud Storage store, for listing and sizing the inputs
+client_pool = clients.ClientPool()
+store = gcs.GcsStore(client_pool.service('storage', 'v1'))
+
+# Read and expand the inputs lazily, in chunks small enough for one request
+input_paths, input_chunks = launch.read_inputs(parser, args, store)
+
+# The Docker command, followed by packing its outputs if requested
+cmd = build_command(steps)
+if args.pack_outputs:
+  cmd = packing.packed_command(cmd)
+
+# Build the pipeline request
+body_timer = metrics.timer('launcher.build_body').start()
+body = {
+  # The ephemeralPipeline provides the template for the pipeline
+  # The pipelineArgs provide the inputs specific to this run
+
+  'ephemeralPipeline': {
+    'projectId': args.project,
+    'name': 'bam_qc',
+    'description': 'Run samtools, FastQC and gzip over one or more files',
+
+    # Define the resources needed for this pipeline.
+    'resources': {
+      # Create a data disk that is attached to the VM and destroyed when the
+      # pipeline terminates.
+      'disks': [ {
+        'name': 'datadisk',
+        'autoDelete': True,
+
+        # Within the Docker container, specify a mount point for the disk.
+        # The pipeline input argument below will specify that inputs should be
+        # written to this disk.
+        'mountPoint': '/mnt/data',
+      } ],
+    },
+
+    # Specify the Docker image to use along with the command. Projects IDs with a
+    # colon (:) must swap it for a forward slash when specifying image names.
+    'docker': {
+      'imageName': 'gcr.io/%s/bam_qc' % args.project.replace(':', '/'),
+
+      'cmd': cmd,
+    },
+
+    # The inputFile<n> specified in the pipelineArgs (see below) will specify the
+    # Cloud Storage path to copy to /mnt/data/input/. Each input is copied once,
+    # and is read from there by every step.
+
+    'inputParameters': [ {
+      'name': 'inputFile%d' % idx,
+      'description': 'Cloud Storage path to an input file',
+      'localCopy': {
+        'path': 'input/',
+        'disk': 'datadisk'
+      }
+    } for idx in range(len(input_paths)) ],
+
+    # By specifying an outputParameter, we instruct the pipelines API to
+    # copy /mnt/data/output/* (the outputs of all steps) to the Cloud Storage
+    # location specified in the pipelineArgs (see below).
+    # With --pack-outputs, only the archive and index written to
+    # /mnt/data/packed are copied.
+    'outputParameters': [ {
+      'name': 'outputPath',
+      'description': 'Cloud Storage path for where to write QC output',
+      'localCopy': {
+        'path': (packing.PACKED_PATH if args.pack_outputs
+                 else 'output/*'),
+        'disk': 'datadisk'
+      }
+    } ]
+  },
+
+  'pipelineArgs': {
+    'projectId': args.project,
+
+    # Override the resources needed for this pipeline
+    'resources': {
+      'minimumCpuCores': args.cpus,
+
+      # Expand any zone short-hand patterns
+      'zones': defaults.get_zones(args.zones),
+
+      # For the data disk, specify the size
+      'disks': [ {
+        'name': 'datadisk',
+
+        'sizeGb': args.disk_size,
+      } ]
+    },
+
+    # Pass the user-specified Cloud Storage paths as a map of input files
+    'inputs': {
+      'inputFile%d' % idx : value for idx, value in enumerate(input_paths)
+    },
+
+    # Pass the user-specified Cloud Storage destination path of the QC output
+    'outputs': {
+      'outputPath': args.output
+    },
+
+    # Pass the user-specified Cloud Storage destination for pipeline logging
+    'logging': {
+      'gcsPath': args.logging
+    },
+  }
+}
+
+body_timer.stop()
+
+# The first request is for the first chunk of inputs; build one more request
+# per remaining chunk
+requests = itertools.chain(
+    [body], (inputs.with_inputs(body, chunk) for chunk in input_chunks))
+
+# Submit the requests and, if polling, wait for them to complete
+launch.run_batch(args, requests, client_pool, store, min_cores=args.cpus)
@@ -13,13 +13,32 @@ files in Google Cloud Storage.
 
 This pipeline is run in an "ephemeral" manner; no call to pipelines.create()
 is necessary. No pipeline is persisted in the pipelines list.
+
+With --auto-resources <mirror-db>, the operations mirror at <mirror-db> (see
+tools/operations_mirror.py) is synced, and the cores, memory and disk of the
+request are set to the cheapest predefined machine type (and disk)
+predicted, from the past successful runs of the pipeline, to finish within
+--target-runtime minutes (default: 60). Until the mirror has enough
+successful runs, the request keeps its resources.
+
+With --subscription <name>, completion is noticed from notifications pulled
+from a Cloud Pub/Sub subscription, such as one to a Cloud Storage
+notification on the logging bucket (see pipelines_pylib/notifications.py),
+rather than by polling the operation every 20 seconds.
+
+The PYTHONPATH must include the top-level directory of
+pipelines-api-examples, for the pipelines_pylib modules.
 """
 
+import argparse
 import pprint
-import time
 
-from oauth2client.client import GoogleCredentials
-from apiclient.discovery import build
+from pipelines_pylib import clients
+from pipelines_pylib import gcs
+from pipelines_pylib import jobs
+from pipelines_pylib import mirror
+from pipelines_pylib import notifications
+from pipelines_pylib import resources
 
 PROJECT_ID='**FILL IN PROJECT ID**'
 BUCKET='**FILL IN BUCKET**'
@@ -33,12 +52,24 @@ SCRIPT='gs://%s/%s/script.R' % (BUCKET, PREFIX)
 # This script will poll for completion of the pipeline.
 POLL_INTERVAL_SECONDS = 20
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--auto-resources", metavar="MIRROR_DB",
+                    help="Path to an operations mirror; sync it and set the "
+                         "request's resources from past runs of the pipeline")
+parser.add_argument("--target-runtime", default=60, type=float,
+                    help="Run time (in minutes) that --auto-resources should "
+                         "meet (default: 60)")
+parser.add_argument("--subscription",
+                    help="Wait on notifications from this Cloud Pub/Sub "
+                         "subscription (projects/<project>/subscriptions/"
+                         "<name>), polling only as a fallback")
+args = parser.parse_args()
+
 # Create the genomics service.
-credentials = GoogleCredentials.get_application_default()
-service = build('genomics', 'v1alpha2', credentials=credentials)
+client_pool = clients.ClientPool()
+service = client_pool.service('genomics', 'v1alpha2')
 
-# Run the pipeline.
-operation = service.pipelines().run(body={
+body = {
   # The ephemeralPipeline provides the template for the pipeline.
   # The pipelineArgs provide the inputs specific to this run.
   'ephemeralPipeline' : {
@@ -156,19 +187,47 @@ operation = service.pipelines().run(body={
         ]
     }
   }
-}).execute()
+}
+
+# Size the VM and disk from past runs of the pipeline
+if args.auto_resources:
+  ops = mirror.OperationsMirror(args.auto_resources)
+  ops.sync(service, PROJECT_ID)
+  recommender = resources.Recommender(
+      ops, gcs.GcsStore(client_pool.service('storage', 'v1')),
+      target_runtime=args.target_runtime * 60)
+  body, recommendation = recommender.apply(body)
+  if recommendation:
+    print "Using %(machine_type)s and a %(disk_gb)d GB disk (predicted " \
+          "run time %(runtime)d seconds)" % recommendation
+
+# Wait on completion notifications, polling only as a fallback
+waiter = None
+if args.subscription:
+  waiter = notifications.CompletionWaiter(
+      service, notifications.PubSubSource(
+          client_pool.service('pubsub', 'v1'), args.subscription))
 
-# Emit the result of the pipeline run submission and poll for completion.
-pp = pprint.PrettyPrinter(indent=2)
-pp.pprint(operation)
-operation_name = operation['name']
-print
-print "Polling for completion of operation"
-
-while not operation['done']:
-  print "Operation not complete. Sleeping %d seconds" % (POLL_INTERVAL_SECONDS)
-  time.sleep(POLL_INTERVAL_SECONDS)
-  operation = service.operations().get(name=operation_name).execute()
+# Run the pipeline.
+client = jobs.PipelineClient(service, poll_interval=POLL_INTERVAL_SECONDS,
+                             waiter=waiter)
+try:
+  future = client.run(body)
+
+  # Emit the result of the pipeline run submission and poll for completion.
+  pp = pprint.PrettyPrinter(indent=2)
+  pp.pprint(future.submission())
+  print
+  if waiter:
+    print "Waiting for notifications of completion of operation"
+  else:
+    print "Polling for completion of operation every %d seconds" % (
+        POLL_INTERVAL_SECONDS)
+  operation = future.result()
+finally:
+  client.close()
+  if waiter:
+    waiter.close()
 
 print
 print "Operation complete"
@@ -28,6 +28,62 @@ Usage:
 
 Where the poll-interval is optional (default is no polling).
 
+By default each input is copied to the VM's data disk, compressed (or
+decompressed) in place, and the results copied to the output path, so the
+disk must be large enough for every input plus its output.
+
+With --streaming, nothing is staged on disk. Each input object is streamed
+through the compression command and uploaded to the output path as it is
+produced, with download, compression and upload overlapping. The streaming is
+done by stream_compress.py, which must be copied to Cloud Storage, along with
+the pipelines_pylib folder, and their folder passed as --script-path:
+
+  * python run_compress.py \
+      --project <project-id> \
+      --zones <gce-zones> \
+      --streaming \
+      --script-path <gcs-folder-containing-stream_compress.py> \
+      --operation <compression-operation> \
+      --input <gcs-input-path> \
+      --output <gcs-output-path> \
+      --logging <gcs-logging-path>
+
+The --disk-size is then optional; the disk only holds the script.
+
+Streaming mode supports more operations than gzip, gunzip, bzip2 and bunzip2:
+
+  bgzip, zstd, unzstd:  BGZF and Zstandard (de)compression
+  <from>:<to>:          transcoding in one pass, for example "bzip2:bgzip"
+
+along with --level and --threads to set the compression level and the
+number of compression threads (bgzip, zstd), and --index to write a .gzi
+index alongside each bgzip output. These use the gcr.io/<project-id>/compress
+image built from the Dockerfile in this directory.
+
+With --benchmark FORMAT[:LEVEL,...] [...], the pipeline instead compresses a
+sample of the inputs with each codec and level and writes the compression
+ratio and throughput of each to the pipeline log, for example:
+
+  --benchmark gzip:1,6,9 bgzip:6 zstd:1,3,9,19 bzip2:9
+
+With --verify (streaming only), each output is checked as it is written,
+without reading it again: the CRC32C of the streamed bytes is compared with
+the CRC32C Cloud Storage reports for the uploaded object, and compressed
+outputs are decompressed as they are uploaded to confirm they are intact
+(and, when compressing, that they reproduce the input). An output which fails
+to decompress is not written, and the pipeline fails if any check fails.
+--manifest <gcs-path> writes a tab-separated manifest of every output and the
+result of its checks. (Without --streaming, outputs are copied from disk by
+gsutil, which already validates the CRC32C of each upload.) --verify needs
+the crcmod C extension in the image; --slow-crc32c allows computing CRC32C
+in Python instead, which limits throughput.
+
+The options shared by the batch launchers, such as --input-manifest,
+--journal, --cache-dir, --zone-failover and --plan, are described in
+pipelines_pylib/launch.py. When the inputs are split into several requests
+(see --inputs-per-request), the --manifest of each request after the first
+is written to <manifest>.<n>. --pack-outputs is not supported.
+
 Users will typically want to restrict the Compute Engine zones to avoid Cloud
 Storage egress charges. This script supports a short-hand pattern-matching
 for specifying zones, such as:
@@ -41,41 +97,199 @@ an explicit list may be specified, space-separated:
 """
 
 import argparse
-import pprint
-
-from oauth2client.client import GoogleCredentials
-from apiclient.discovery import build
+import copy
+import itertools
 
+from pipelines_pylib import clients
 from pipelines_pylib import defaults
-from pipelines_pylib import poller
+from pipelines_pylib import gcs
+from pipelines_pylib import inputs
+from pipelines_pylib import launch
+from pipelines_pylib import metrics
+
+import stream_compress
+
+# Disk size (in GB) when streaming; the disk only holds the script
+STREAMING_DISK_SIZE_GB = 10
+
+# Operations which can be run in place on localized files, with stock images
+LOCALIZED_OPERATIONS = [ "gzip", "gunzip", "bzip2", "bunzip2" ]
+STOCK_FORMATS = [ "gzip", "bzip2" ]
+
+def streaming_request(body, args, index):
+  """Returns a copy of a request body which streams its inputs instead of
+  copying them to and from the data disk.
+
+  The input paths and the output path are passed to stream_compress.py as
+  environment variables (input parameters without a localCopy), and the
+  script streams each object through the codec straight to the output path.
+  The output paths are named as in cache.STREAMED_OUTPUTS, so that the result
+  cache treats them as outputs rather than inputs. The manifest of each
+  request after the first (index 0) is written to <manifest>.<index>.
+  """
+
+  body = copy.deepcopy(body)
+  pipeline = body['ephemeralPipeline']
+  input_count = len([p for p in pipeline['inputParameters']
+                     if p['name'].startswith('inputFile')])
+  manifest = args.manifest
+  if manifest and index:
+    manifest = '%s.%d' % (manifest, index)
+
+  if args.benchmark:
+    options = '--benchmark %s' % ' '.join(args.benchmark)
+    formats = set(codec.split(':')[0] for codec in args.benchmark)
+  else:
+    options = '--operation %s --jobs %d --output "${OUTPUT_PATH}"' % (
+        args.operation, args.jobs)
+    formats = set(f for f in stream_compress.parse_operation(args.operation)
+                  if f)
+
+  if args.level is not None:
+    options += ' --level %d' % args.level
+  if args.threads:
+    options += ' --threads %d' % args.threads
+  if args.index:
+    options += ' --index'
+  if args.verify:
+    options += ' --verify'
+  if args.slow_crc32c:
+    options += ' --slow-crc32c'
+  if args.manifest:
+    options += ' --manifest "${MANIFEST_PATH}"'
+
+  pipeline['docker'] = {
+    # google/cloud-sdk provides python, gsutil, gzip and bzip2. Other codecs
+    # need the image built from compress/Dockerfile.
+    'imageName': ('google/cloud-sdk' if formats <= set(STOCK_FORMATS) else
+                  'gcr.io/%s/compress' % args.project.replace(':', '/')),
+
+    # "--" ends the options, as --benchmark takes any number of codecs
+    'cmd': ('PYTHONPATH=/mnt/data/scripts '
+            'python /mnt/data/scripts/stream_compress.py %s -- %s' % (
+              options,
+              ' '.join('"${inputFile%d}"' % idx
+                       for idx in range(input_count)))),
+  }
+
+  # Each concurrent object uses one core per compression thread
+  if args.threads:
+    body['pipelineArgs']['resources']['minimumCpuCores'] = (
+        args.threads * args.jobs)
+
+  pipeline['inputParameters'] = [ {
+    'name': 'inputFile%d' % idx,
+    'description': 'Cloud Storage path to an input file',
+  } for idx in range(input_count) ] + [ {
+    'name': 'OUTPUT_PATH',
+    'description': 'Cloud Storage path to write output files',
+  }, {
+    'name': 'streamCompress_Script',
+    'description': 'Cloud Storage path to stream_compress.py script',
+    'defaultValue': '%s/stream_compress.py' % args.script_path.rstrip('/'),
+    'localCopy': {
+      'path': 'scripts/',
+      'disk': 'datadisk'
+    }
+  }, {
+    'name': 'pipelinesPylib',
+    'description': 'Cloud Storage path to the pipelines_pylib modules',
+    'defaultValue': '%s/pipelines_pylib/*.py' % args.script_path.rstrip('/'),
+    'localCopy': {
+      'path': 'scripts/pipelines_pylib/',
+      'disk': 'datadisk'
+    }
+  } ]
+  pipeline['outputParameters'] = []
+
+  body['pipelineArgs']['inputs']['OUTPUT_PATH'] = args.output
+  if manifest:
+    pipeline['inputParameters'].append({
+      'name': 'MANIFEST_PATH',
+      'description': 'Cloud Storage path to write the output manifest',
+    })
+    body['pipelineArgs']['inputs']['MANIFEST_PATH'] = manifest
+  body['pipelineArgs']['outputs'] = {}
+  return body
+
 
 # Parse input args
 parser = argparse.ArgumentParser()
 parser.add_argument("--project", required=True,
                     help="Cloud project id to run the pipeline in")
-parser.add_argument("--disk-size", required=True, type=int,
-                    help="Size (in GB) of disk for both input and output")
+parser.add_argument("--disk-size", type=int,
+                    help="Size (in GB) of disk for both input and output "
+                         "(required unless --streaming)")
 parser.add_argument("--zones", required=True, nargs="+",
                     help="List of Google Compute Engine zones (supports wildcards)")
 parser.add_argument("--operation", required=False, default="gzip",
-                    choices=[ "gzip", "gunzip", "bzip2", "bunzip2" ],
-                    help="Choice of compression/decompression command")
-parser.add_argument("--input", required=True, nargs="+",
-                    help="Cloud Storage path to input file(s)")
+                    choices=stream_compress.OPERATIONS,
+                    help="Choice of compression/decompression command, or "
+                         "<from>:<to> to transcode (operations other than "
+                         "%s require --streaming)" %
+                         ", ".join(LOCALIZED_OPERATIONS))
 parser.add_argument("--output", required=True,
                     help="Cloud Storage path to output file (with the .gz extension)")
 parser.add_argument("--logging", required=True,
                     help="Cloud Storage path to send logging output")
-parser.add_argument("--poll-interval", default=0, type=int,
-                    help="Frequency (in seconds) to poll for completion (default: no polling)")
-args = parser.parse_args()
-
-# Create the genomics service
-credentials = GoogleCredentials.get_application_default()
-service = build('genomics', 'v1alpha2', credentials=credentials)
-
-# Run the pipeline
-operation = service.pipelines().run(body={
+parser.add_argument("--streaming", action="store_true",
+                    help="Stream objects through the compression command "
+                         "instead of copying them to local disk")
+parser.add_argument("--script-path",
+                    help="Cloud Storage folder containing stream_compress.py "
+                         "and pipelines_pylib (required with --streaming)")
+parser.add_argument("--jobs", default=1, type=int,
+                    help="Number of objects to stream concurrently "
+                         "(with --streaming)")
+parser.add_argument("--level", type=int,
+                    help="Compression level (with --streaming)")
+parser.add_argument("--threads", type=int,
+                    help="Compression threads for bgzip and zstd "
+                         "(with --streaming)")
+parser.add_argument("--index", action="store_true",
+                    help="Write a .gzi index for each bgzip output "
+                         "(with --streaming)")
+parser.add_argument("--verify", action="store_true",
+                    help="Verify each output in-stream against its CRC32C "
+                         "and by decompressing it (with --streaming)")
+parser.add_argument("--manifest",
+                    help="Cloud Storage path to write a manifest of outputs "
+                         "and checks (with --streaming)")
+parser.add_argument("--slow-crc32c", action="store_true",
+                    help="With --verify, compute CRC32C in Python if the "
+                         "image lacks the crcmod C extension (far slower)")
+parser.add_argument("--benchmark", nargs="+", metavar="FORMAT[:LEVEL,...]",
+                    help="Benchmark codecs on a sample of the inputs instead "
+                         "of processing them (with --streaming)")
+launch.add_arguments(parser)
+args = launch.parse_args(parser)
+
+if args.streaming and not args.script_path:
+  parser.error("--script-path is required with --streaming")
+if not args.streaming and not args.disk_size:
+  parser.error("--disk-size is required unless --streaming")
+if not args.streaming and (args.operation not in LOCALIZED_OPERATIONS or
+                           args.level is not None or args.threads or
+                           args.index or args.benchmark or
+                           args.verify or args.manifest):
+  parser.error("--operation %s, --level, --threads, --index, --verify, "
+               "--manifest and --benchmark require --streaming" %
+               args.operation)
+# The outputs are written next to the inputs, or streamed, not to
+# /mnt/data/output
+if args.pack_outputs:
+  parser.error("--pack-outputs is not supported by run_compress.py")
+
+# Create the Cloud Storage store, for listing and sizing the inputs
+client_pool = clients.ClientPool()
+store = gcs.GcsStore(client_pool.service('storage', 'v1'))
+
+# Read and expand the inputs lazily, in chunks small enough for one request
+input_paths, input_chunks = launch.read_inputs(parser, args, store)
+
+# Build the pipeline request
+body_timer = metrics.timer('launcher.build_body').start()
+body = {
   # The ephemeralPipeline provides the template for the pipeline
   # The pipelineArgs provide the inputs specific to this run
 
@@ -145,7 +359,7 @@ operation = service.pipelines().run(body={
         'path': 'workspace/',
         'disk': 'datadisk'
       }
-    } for idx in range(len(args.input)) ],
+    } for idx in range(len(input_paths)) ],
 
     # By specifying an outputParameter, we instruct the pipelines API to
     # copy /mnt/data/workspace/* to the Cloud Storage location specified in
@@ -172,7 +386,7 @@ operation = service.pipelines().run(body={
       'disks': [ {
         'name': 'datadisk',
 
-        'sizeGb': args.disk_size,
+        'sizeGb': args.disk_size or STREAMING_DISK_SIZE_GB,
       } ]
     },
 
@@ -183,7 +397,7 @@ operation = service.pipelines().run(body={
     #   <etc>
     # }
     'inputs': {
-      'inputFile%d' % idx : value for idx, value in enumerate(args.input)
+      'inputFile%d' % idx : value for idx, value in enumerate(input_paths)
     },
 
     # Pass the user-specified Cloud Storage destination path of output
@@ -196,13 +410,20 @@ operation = service.pipelines().run(body={
       'gcsPath': args.logging
     },
   }
-}).execute()
-
-# Emit the result of the pipeline run submission
-pp = pprint.PrettyPrinter(indent=2)
-pp.pprint(operation)
-
-# If requested - poll until the operation reaches completion state ("done: true")
-if args.poll_interval > 0:
-  completed_op = poller.poll(service, operation, args.poll_interval)
-  pp.pprint(completed_op)
+}
+
+body_timer.stop()
+
+# The first request is for the first chunk of inputs; build one more request
+# per remaining chunk
+requests = itertools.chain(
+    [body], (inputs.with_inputs(body, chunk) for chunk in input_chunks))
+if args.streaming:
+  requests = (streaming_request(request, args, index)
+              for index, request in enumerate(requests))
+
+# Submit the requests and, if polling, wait for them to complete. Each
+# concurrent object uses one core per compression thread.
+launch.run_batch(args, requests, client_pool, store,
+                 min_cores=(args.threads * args.jobs
+                            if args.streaming and args.threads else 1))
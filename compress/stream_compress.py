@@ -0,0 +1,797 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+# stream_compress.py
+#
+# Compresses or decompresses Cloud Storage objects without staging them on
+# local disk. For each input object, the object is downloaded, piped through
+# the compression command and uploaded (as a streaming, resumable upload)
+# at the same time:
+#
+#   gsutil cat gs://in/obj | gzip -c | gsutil cp - gs://out/obj.gz
+#
+# so the disk only needs to hold this script, and download, compression and
+# upload overlap.
+#
+# This script is run on the pipeline VM by run_compress.py --streaming. It can
+# also be run locally against a directory standing in for Cloud Storage
+# (--local-root), where gs://bucket/path/to/object is the file
+# <local-root>/bucket/path/to/object. This makes it possible to measure codec
+# throughput offline.
+#
+# Usage:
+#   python stream_compress.py \
+#       --operation <compression-operation> \
+#       --output <gcs-output-path> \
+#       [--level <compression-level>] \
+#       [--threads <codec-threads>] \
+#       [--index] \
+#       [--jobs <number-of-concurrent-objects>] \
+#       [--verify] \
+#       [--manifest <gcs-manifest-path>] \
+#       [--local-root <local-directory>] \
+#       <gcs-input-path> [<gcs-input-path> ...]
+#
+# The script imports pipelines_pylib, which must be on the PYTHONPATH; the
+# pipeline copies the package from --script-path along with the script.
+#
+# Input paths may contain wildcards. Each output object is named for its
+# input object, with the compression suffix added (or removed).
+#
+# The compression operations are:
+#
+#   gzip, bzip2, bgzip, zstd:   compress
+#   gunzip, bunzip2, unzstd:    decompress (gunzip also decompresses bgzip)
+#   <from>:<to>:                transcode, for example "bzip2:bgzip"
+#
+# Transcoding pipes the decompressor straight into the compressor; the
+# uncompressed data is never written anywhere.
+#
+# --level sets the compression level and --threads the number of compression
+# threads (bgzip and zstd only). With --index, a bgzip output object is
+# accompanied by a <output>.gzi index (as written by "bgzip -i"), built from
+# the compressed stream as it is uploaded, so that tools can seek into it.
+#
+# With --verify, each output is checked in the same pass that writes it, so
+# multi-GB objects are not read a second time:
+#
+#   * the CRC32C of the uploaded bytes is computed as they stream past and
+#     compared with the CRC32C which Cloud Storage reports for the committed
+#     object (streaming uploads are otherwise not checksummed end-to-end)
+#   * compressed outputs are also piped into the format's decompressor as
+#     they are uploaded; the decompressor must succeed and, when compressing
+#     uncompressed inputs, reproduce the input byte-for-byte (by length and
+#     CRC32). An output which fails to decompress is not committed.
+#
+# Decompression operations need no decompress-verify: the codec checks the
+# input's own trailer (gzip and zstd checksums, bzip2 block CRCs) and fails
+# on a truncated or corrupt input.
+#
+# --manifest writes a tab-separated summary with one row per input: source,
+# destination, bytes in and out, the CRC32C computed in-stream and the CRC32C
+# reported by the object store, and the result of each check. The script exits
+# with a non-zero status if any object failed.
+#
+# Benchmark mode compresses a sample from the start of (some of) the inputs
+# with each requested codec and level, and reports the compression ratio and
+# the compression and decompression throughput. Nothing is written:
+#
+#   python stream_compress.py \
+#       --benchmark gzip:1,6,9 bgzip:6 zstd:1,3,9,19 bzip2:9 \
+#       [--sample-size <megabytes-per-input>] \
+#       [--sample-count <number-of-inputs>] \
+#       <gcs-input-path> [<gcs-input-path> ...]
+
+from __future__ import print_function
+
+import argparse
+import glob
+import multiprocessing.pool
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+from pipelines_pylib import gcs
+
+# Size of each read from an input or codec stream
+CHUNK_SIZE = 1024 * 1024
+
+# Compression formats. For each: the file suffix, the compress and
+# decompress commands (reading stdin and writing stdout), and the options for
+# setting the compression level and the number of threads.
+FORMATS = {
+  'gzip': {
+    'suffix': '.gz',
+    'compress': ['gzip', '-c'],
+    'decompress': ['gzip', '-dc'],
+    'level': ['-%d'],
+  },
+  'bzip2': {
+    'suffix': '.bz2',
+    'compress': ['bzip2', '-c'],
+    'decompress': ['bzip2', '-dc'],
+    'level': ['-%d'],
+  },
+  'bgzip': {
+    'suffix': '.gz',
+    'compress': ['bgzip', '-c'],
+    'decompress': ['bgzip', '-dc'],
+    'level': ['-l', '%d'],
+    'threads': ['-@', '%d'],
+  },
+  'zstd': {
+    'suffix': '.zst',
+    'compress': ['zstd', '-c', '-q'],
+    'decompress': ['zstd', '-dc', '-q'],
+    'level': ['--ultra', '-%d'],
+    'threads': ['-T%d'],
+  },
+}
+
+# Decompression operations, and the format each one decompresses
+DECOMPRESS_OPERATIONS = {
+  'gunzip': 'gzip',
+  'bunzip2': 'bzip2',
+  'unzstd': 'zstd',
+}
+
+# All supported operations: compress, decompress and transcode
+OPERATIONS = sorted(FORMATS.keys()) + sorted(DECOMPRESS_OPERATIONS.keys()) + [
+  '%s:%s' % (src, dst) for src in sorted(FORMATS) for dst in sorted(FORMATS)
+  if src != dst
+]
+
+
+# Manifest columns (see --manifest)
+MANIFEST_COLUMNS = [
+  'source', 'destination', 'bytes_in', 'bytes_out',
+  'crc32c', 'stored_crc32c', 'upload_check', 'decompress_check', 'error',
+]
+
+def _options(template, value):
+  return [option % value if '%' in option else option for option in template]
+
+
+def compress_command(fmt, level=None, threads=None):
+  """Returns the command which compresses stdin to stdout in a format."""
+
+  command = list(FORMATS[fmt]['compress'])
+  if level is not None:
+    command += _options(FORMATS[fmt]['level'], level)
+  if threads and 'threads' in FORMATS[fmt]:
+    command += _options(FORMATS[fmt]['threads'], threads)
+  return command
+
+
+def parse_operation(operation):
+  """Returns the (source format, target format) of an operation.
+
+  Either may be None: compression has no source format, decompression has no
+  target format.
+  """
+
+  if operation in DECOMPRESS_OPERATIONS:
+    return DECOMPRESS_OPERATIONS[operation], None
+  if ':' in operation:
+    return tuple(operation.split(':', 1))
+  return None, operation
+
+
+def operation_commands(operation, level=None, threads=None):
+  """Returns the list of commands to pipe together for an operation."""
+
+  source, target = parse_operation(operation)
+
+  commands = []
+  if source:
+    commands.append(list(FORMATS[source]['decompress']))
+  if target:
+    commands.append(compress_command(target, level, threads))
+  return commands
+
+
+def output_name(operation, name):
+  """Returns the output object name for an input object name."""
+
+  source, target = parse_operation(operation)
+
+  if source and name.endswith(FORMATS[source]['suffix']):
+    name = name[:-len(FORMATS[source]['suffix'])]
+  if target:
+    name += FORMATS[target]['suffix']
+  return name
+
+
+class GsutilStore(object):
+  """Cloud Storage objects, streamed through gsutil."""
+
+  def list(self, pattern):
+    if not any(c in pattern for c in '*?['):
+      return [pattern]
+    output = subprocess.check_output(['gsutil', 'ls', pattern])
+    # One object per line; names may contain spaces
+    return [line.rstrip('\r') for line in
+            output.decode('utf-8').splitlines() if line.strip()]
+
+  def open_read(self, path):
+    """Returns (file, process) for reading an object."""
+    proc = subprocess.Popen(['gsutil', '-q', 'cat', path],
+                            stdout=subprocess.PIPE, close_fds=True)
+    return proc.stdout, proc
+
+  def open_write(self, path):
+    """Returns (file, process) for writing an object.
+
+    The upload is committed only when the file is closed and gsutil exits
+    successfully; killing the process abandons the upload.
+    """
+    proc = subprocess.Popen(['gsutil', '-q', 'cp', '-', path],
+                            stdin=subprocess.PIPE, close_fds=True)
+    return proc.stdin, proc
+
+  def read_sample(self, path, num_bytes):
+    """Returns (up to) the first num_bytes of an object."""
+    return subprocess.check_output(
+        ['gsutil', '-q', 'cat', '-r', '0-%d' % (num_bytes - 1), path])
+
+  def crc32c(self, path):
+    """Returns the base64-encoded CRC32C which Cloud Storage reports for an
+    object, or None if it reports none (composite objects)."""
+
+    output = subprocess.check_output(['gsutil', 'stat', path])
+    for line in output.decode('utf-8').splitlines():
+      key, _, value = line.strip().partition(':')
+      if key == 'Hash (crc32c)':
+        return value.strip()
+    return None
+
+
+class LocalStore(object):
+  """A local directory standing in for Cloud Storage."""
+
+  def __init__(self, root):
+    self._root = root
+
+  def local_path(self, path):
+    if not path.startswith('gs://'):
+      raise ValueError('Not a Cloud Storage path: %s' % path)
+    return os.path.join(self._root, *path[len('gs://'):].split('/'))
+
+  def list(self, pattern):
+    root = os.path.join(self._root, '')
+    return sorted('gs://' + p[len(root):].replace(os.sep, '/')
+                  for p in glob.glob(self.local_path(pattern))
+                  if os.path.isfile(p))
+
+  def open_read(self, path):
+    return open(self.local_path(path), 'rb'), None
+
+  def read_sample(self, path, num_bytes):
+    with open(self.local_path(path), 'rb') as f:
+      return f.read(num_bytes)
+
+  def open_write(self, path):
+    local = self.local_path(path)
+    if not os.path.isdir(os.path.dirname(local)):
+      os.makedirs(os.path.dirname(local))
+    return open(local, 'wb'), None
+
+  def crc32c(self, path):
+    crc = 0
+    with open(self.local_path(path), 'rb') as f:
+      for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        crc = gcs.crc32c(chunk, crc)
+    return gcs.encode_crc32c(crc)
+
+  def abandon(self, path):
+    """Removes a partially written object."""
+    try:
+      os.remove(self.local_path(path))
+    except OSError:
+      pass
+
+
+class BgzfIndexer(object):
+  """Builds a .gzi index from a BGZF stream as it is written.
+
+  BGZF is a series of gzip blocks, each recording its compressed size (in the
+  "BC" extra subfield) and uncompressed size (ISIZE). The .gzi index lists the
+  compressed and uncompressed offset of the start of every block after the
+  first, as little-endian uint64 pairs preceded by their count.
+  """
+
+  def __init__(self):
+    self._buffer = bytearray()
+    self._compressed = 0
+    self._uncompressed = 0
+    self.entries = []
+
+  def _block_size(self):
+    """Returns the size of the block at the start of the buffer, or None if
+    the buffer does not yet hold its header."""
+
+    if len(self._buffer) < 12:
+      return None
+    xlen = struct.unpack('<H', bytes(self._buffer[10:12]))[0]
+    if len(self._buffer) < 12 + xlen:
+      return None
+
+    pos = 12
+    while pos + 4 <= 12 + xlen:
+      si1, si2, slen = struct.unpack('<BBH', bytes(self._buffer[pos:pos + 4]))
+      if (si1, si2) == (66, 67):  # "BC"
+        return struct.unpack('<H', bytes(self._buffer[pos + 4:pos + 6]))[0] + 1
+      pos += 4 + slen
+    raise ValueError('Output is not BGZF: block without a BC subfield')
+
+  def update(self, chunk):
+    self._buffer.extend(chunk)
+    while True:
+      size = self._block_size()
+      if size is None or len(self._buffer) < size:
+        return
+
+      isize = struct.unpack('<I', bytes(self._buffer[size - 4:size]))[0]
+      del self._buffer[:size]
+
+      self._compressed += size
+      self._uncompressed += isize
+      # The empty end-of-file block is not indexed
+      if isize:
+        self.entries.append((self._compressed, self._uncompressed))
+
+  def index(self):
+    """Returns the contents of the .gzi index file."""
+
+    return struct.pack('<Q', len(self.entries)) + b''.join(
+        struct.pack('<QQ', c, u) for c, u in self.entries)
+
+
+class Crc32cObserver(object):
+  """Computes the CRC32C of a stream, for comparison with the object store."""
+
+  def __init__(self):
+    self.crc = 0
+
+  def update(self, chunk):
+    self.crc = gcs.crc32c(chunk, self.crc)
+
+  def encoded(self):
+    return gcs.encode_crc32c(self.crc)
+
+
+class Crc32Observer(object):
+  """Computes the length and (zlib) CRC32 of a stream.
+
+  CRC32 is used for comparisons within this script; zlib computes it far
+  faster than CRC32C can be computed without crcmod.
+  """
+
+  def __init__(self):
+    self.crc = 0
+    self.size = 0
+
+  def update(self, chunk):
+    self.crc = zlib.crc32(chunk, self.crc)
+    self.size += len(chunk)
+
+
+class DecompressVerifier(object):
+  """Decompresses an output stream as it is written.
+
+  Each chunk is also written to a decompressor, whose output is checksummed
+  on a separate thread. finish() reports whether the decompressor succeeded
+  and, if an expected Crc32Observer (over the uncompressed input) was given,
+  whether the decompressed output matches it.
+  """
+
+  def __init__(self, fmt, expected=None):
+    self._expected = expected
+    self._error = None
+    self._decompressed = Crc32Observer()
+
+    self._command = FORMATS[fmt]['decompress']
+    self._proc = subprocess.Popen(self._command,
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, close_fds=True)
+    self._reader = threading.Thread(target=self._read)
+    self._reader.start()
+
+  def _read(self):
+    for chunk in iter(lambda: self._proc.stdout.read(CHUNK_SIZE), b''):
+      self._decompressed.update(chunk)
+
+  def update(self, chunk):
+    if self._error:
+      return
+    try:
+      self._proc.stdin.write(chunk)
+    except (IOError, OSError) as e:
+      # The decompressor exited early; finish() reports why
+      self._error = 'decompressor stopped reading: %s' % e
+
+  def finish(self):
+    """Waits for the decompressor; returns an error message or None."""
+
+    try:
+      self._proc.stdin.close()
+    except (IOError, OSError):
+      pass
+    self._reader.join()
+
+    if self._proc.wait() != 0:
+      return 'decompress-verify failed: %s exited with status %d' % (
+          self._command[0], self._proc.returncode)
+    if self._error:
+      return self._error
+
+    expected, actual = self._expected, self._decompressed
+    if expected and (expected.size, expected.crc) != (actual.size, actual.crc):
+      return ('decompress-verify failed: decompressed %d bytes (crc32 %08x), '
+              'expected %d bytes (crc32 %08x)' % (
+                  actual.size, actual.crc & 0xFFFFFFFF,
+                  expected.size, expected.crc & 0xFFFFFFFF))
+    return None
+
+
+def _copy(src, dst, counts, key, observers=()):
+  """Copies src to dst in chunks, counting the bytes copied in counts[key]
+  and passing each chunk to the update() method of each observer."""
+
+  counts[key] = 0
+  while True:
+    chunk = src.read(CHUNK_SIZE)
+    if not chunk:
+      return
+    dst.write(chunk)
+    counts[key] += len(chunk)
+    for observer in observers:
+      observer.update(chunk)
+
+
+def _write_object(store, path, data):
+  """Writes a small object in one piece."""
+
+  writer, writer_proc = store.open_write(path)
+  writer.write(data)
+  writer.close()
+  if writer_proc and writer_proc.wait() != 0:
+    raise RuntimeError('upload of %s failed' % path)
+
+
+def stream(store, source, destination, commands, input_observers=(),
+           output_observers=()):
+  """Streams one object through a pipe of codec commands into another object.
+
+  The input is fed to the first codec on a separate thread while the output
+  of the last codec is uploaded, so that download, (de)compression and upload
+  overlap.
+
+  Args:
+      store: GsutilStore or LocalStore
+      source: path of the input object
+      destination: path of the output object
+      commands: list of commands (argument lists) to pipe together
+      input_observers: objects whose update() method is passed each chunk of
+        the input
+      output_observers: objects whose update() method is passed each chunk of
+        the output. If an observer has a finish() method, it is called once
+        the output is complete but before it is committed; a non-None return
+        value is an error message, and the output is not committed.
+
+  Returns:
+      A dict with the bytes read ("in"), bytes written ("out") and the elapsed
+      time in seconds ("seconds").
+
+  Raises:
+      RuntimeError: if the download, a codec, an observer or the upload
+        failed. The output object is not committed.
+  """
+
+  start = time.time()
+  counts = {}
+  errors = []
+
+  reader, reader_proc = store.open_read(source)
+  writer, writer_proc = store.open_write(destination)
+
+  # close_fds keeps concurrent streams from holding each other's pipes open
+  codecs = []
+  for command in commands:
+    codecs.append(subprocess.Popen(
+        command, stdin=codecs[-1].stdout if codecs else subprocess.PIPE,
+        stdout=subprocess.PIPE, close_fds=True))
+    if len(codecs) > 1:
+      codecs[-2].stdout.close()
+  first, last = codecs[0], codecs[-1]
+
+  def feed():
+    try:
+      _copy(reader, first.stdin, counts, 'in', input_observers)
+    except (IOError, OSError) as e:
+      errors.append('reading %s: %s' % (source, e))
+    finally:
+      first.stdin.close()
+      reader.close()
+
+  feeder = threading.Thread(target=feed)
+  feeder.start()
+
+  try:
+    _copy(last.stdout, writer, counts, 'out', output_observers)
+  except (IOError, OSError, ValueError) as e:
+    errors.append('writing %s: %s' % (destination, e))
+    # Unblock the feeder, which may be waiting on the codecs
+    for codec in codecs:
+      codec.kill()
+    last.stdout.close()
+
+  feeder.join()
+  for command, codec in zip(commands, codecs):
+    if codec.wait() != 0:
+      errors.append('%s exited with status %d' % (command[0], codec.returncode))
+  if reader_proc and reader_proc.wait() != 0:
+    errors.append('download of %s failed' % source)
+  for observer in output_observers:
+    if hasattr(observer, 'finish'):
+      error = observer.finish()
+      if error:
+        errors.append(error)
+
+  if errors:
+    # Do not commit a truncated output
+    if writer_proc:
+      writer_proc.kill()
+      writer_proc.wait()
+    else:
+      writer.close()
+      store.abandon(destination)
+    raise RuntimeError('; '.join(errors))
+
+  writer.close()
+  if writer_proc and writer_proc.wait() != 0:
+    raise RuntimeError('upload of %s failed' % destination)
+
+  counts['seconds'] = time.time() - start
+  return counts
+
+
+def _mb_per_sec(num_bytes, seconds):
+  return num_bytes / (1024.0 * 1024.0) / max(seconds, 1e-6)
+
+
+def _run_codec(command, data):
+  """Runs a codec over in-memory data; returns (output, seconds)."""
+
+  start = time.time()
+  proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                          stdout=subprocess.PIPE, close_fds=True)
+  output = proc.communicate(data)[0]
+  if proc.returncode != 0:
+    raise RuntimeError('%s exited with status %d' % (command[0],
+                                                     proc.returncode))
+  return output, time.time() - start
+
+
+def benchmark(samples, codecs, threads=None):
+  """Measures each codec and level over a set of samples.
+
+  Args:
+      samples: list of (uncompressed) sample data
+      codecs: list of (format, level) pairs; a level of None is the
+        codec's default level
+      threads: optional number of compression threads (bgzip and zstd)
+
+  Returns:
+      A list of dicts, one per codec and level, with the format, level,
+      compression ratio and compress/decompress throughput in MB/s.
+  """
+
+  total = sum(len(sample) for sample in samples)
+
+  results = []
+  for fmt, level in codecs:
+    compressed_size = 0
+    compress_seconds = 0
+    decompress_seconds = 0
+    for sample in samples:
+      compressed, seconds = _run_codec(
+          compress_command(fmt, level, threads), sample)
+      compressed_size += len(compressed)
+      compress_seconds += seconds
+
+      _, seconds = _run_codec(FORMATS[fmt]['decompress'], compressed)
+      decompress_seconds += seconds
+
+    results.append({
+      'format': fmt,
+      'level': level,
+      'ratio': float(total) / max(compressed_size, 1),
+      'compress_mb_per_sec': _mb_per_sec(total, compress_seconds),
+      'decompress_mb_per_sec': _mb_per_sec(total, decompress_seconds),
+    })
+  return results
+
+
+def _parse_benchmark_codec(value):
+  """Parses FORMAT[:LEVEL,LEVEL,...] into a list of (format, level)."""
+
+  fmt, _, levels = value.partition(':')
+  if fmt not in FORMATS:
+    raise argparse.ArgumentTypeError('unknown format: %s' % fmt)
+  if not levels:
+    return [(fmt, None)]
+  return [(fmt, int(level)) for level in levels.split(',')]
+
+
+def main():
+  """Entry point to the script."""
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--operation", choices=OPERATIONS,
+                      help="Compression, decompression or transcoding "
+                           "operation")
+  parser.add_argument("--output",
+                      help="Cloud Storage path to write output objects")
+  parser.add_argument("--level", type=int,
+                      help="Compression level (default: the codec default)")
+  parser.add_argument("--threads", type=int,
+                      help="Number of compression threads (bgzip and zstd)")
+  parser.add_argument("--index", action="store_true",
+                      help="Write a .gzi index alongside each bgzip output")
+  parser.add_argument("--jobs", default=1, type=int,
+                      help="Number of objects to stream concurrently")
+  parser.add_argument("--verify", action="store_true",
+                      help="Check each output in-stream: compare its CRC32C "
+                           "with the object store and decompress it as it is "
+                           "uploaded")
+  parser.add_argument("--manifest",
+                      help="Cloud Storage path to write a tab-separated "
+                           "manifest of outputs and checks")
+  parser.add_argument("--slow-crc32c", action="store_true",
+                      help="With --verify, compute CRC32C in Python if the "
+                           "crcmod C extension is not installed (far slower)")
+  parser.add_argument("--benchmark", nargs="+", type=_parse_benchmark_codec,
+                      metavar="FORMAT[:LEVEL,...]",
+                      help="Benchmark codecs and levels on a sample of the "
+                           "inputs instead of processing them")
+  parser.add_argument("--sample-size", default=64, type=int,
+                      help="Megabytes read from each input when benchmarking")
+  parser.add_argument("--sample-count", default=4, type=int,
+                      help="Number of inputs sampled when benchmarking")
+  parser.add_argument("--local-root",
+                      help="Local directory standing in for Cloud Storage")
+  parser.add_argument("inputs", nargs="+",
+                      help="Cloud Storage path to input object(s)")
+  args = parser.parse_args()
+
+  if not args.benchmark and not (args.operation and args.output):
+    parser.error("--operation and --output are required unless --benchmark")
+  if args.index and parse_operation(args.operation or '')[1] != 'bgzip':
+    parser.error("--index requires an operation which writes bgzip")
+
+  if args.verify and not gcs.HAS_CRCMOD and not args.slow_crc32c:
+    parser.error("--verify needs the crcmod C extension to compute CRC32C "
+                 "at streaming speed; install it, or pass --slow-crc32c to "
+                 "compute it in Python")
+
+  store = LocalStore(args.local_root) if args.local_root else GsutilStore()
+
+  sources = [path for pattern in args.inputs for path in store.list(pattern)]
+  if not sources:
+    print("ERROR: No input objects found", file=sys.stderr)
+    sys.exit(1)
+
+  if args.benchmark:
+    samples = [store.read_sample(path, args.sample_size * 1024 * 1024)
+               for path in sources[:args.sample_count]]
+    print("Sampled %d bytes from %d inputs" % (
+        sum(len(sample) for sample in samples), len(samples)))
+
+    codecs = [codec for codecs in args.benchmark for codec in codecs]
+    print("%-8s %7s %8s %14s %16s" % (
+        "codec", "level", "ratio", "compress MB/s", "decompress MB/s"))
+    for result in benchmark(samples, codecs, args.threads):
+      print("%-8s %7s %8.2f %14.1f %16.1f" % (
+          result['format'],
+          'default' if result['level'] is None else result['level'],
+          result['ratio'], result['compress_mb_per_sec'],
+          result['decompress_mb_per_sec']))
+    return
+
+  commands = operation_commands(args.operation, args.level, args.threads)
+  source_format, target_format = parse_operation(args.operation)
+
+  def run(source):
+    destination = '%s/%s' % (args.output.rstrip('/'),
+                             output_name(args.operation,
+                                         source.rsplit('/', 1)[-1]))
+    record = {'source': source, 'destination': destination}
+
+    indexer = BgzfIndexer() if args.index else None
+    checksum = Crc32cObserver() if args.verify else None
+    verifier = None
+    input_observers = []
+    if args.verify and target_format:
+      # Compressing uncompressed input: the decompressed output must
+      # reproduce the input. Transcoding: it must decompress cleanly.
+      expected = None if source_format else Crc32Observer()
+      if expected:
+        input_observers.append(expected)
+      verifier = DecompressVerifier(target_format, expected)
+    output_observers = [o for o in (indexer, checksum, verifier) if o]
+
+    try:
+      counts = stream(store, source, destination, commands,
+                      input_observers, output_observers)
+      if indexer:
+        _write_object(store, destination + '.gzi', indexer.index())
+    except RuntimeError as e:
+      print("ERROR: %s: %s" % (source, e), file=sys.stderr)
+      record.update({'error': str(e),
+                     'decompress_check': 'FAILED' if verifier else '',
+                     'failed': True})
+      return record
+
+    record.update({'bytes_in': counts['in'], 'bytes_out': counts['out'],
+                   'decompress_check': 'OK' if verifier else ''})
+    if checksum:
+      record['crc32c'] = checksum.encoded()
+      record['stored_crc32c'] = store.crc32c(destination)
+      if record['stored_crc32c'] == record['crc32c']:
+        record['upload_check'] = 'OK'
+      else:
+        record.update({'upload_check': 'FAILED', 'failed': True,
+                       'error': 'CRC32C mismatch after upload'})
+        print("ERROR: %s: CRC32C of %s is %s, streamed %s" % (
+            source, destination, record['stored_crc32c'], record['crc32c']),
+            file=sys.stderr)
+
+    print("%s -> %s: %d -> %d bytes in %.1f seconds (%.1f MB/s)%s" % (
+        source, destination, counts['in'], counts['out'], counts['seconds'],
+        _mb_per_sec(counts['in'], counts['seconds']),
+        '' if not args.verify or record.get('failed') else ', verified'))
+    record.update(counts)
+    return record
+
+  start = time.time()
+  pool = multiprocessing.pool.ThreadPool(args.jobs)
+  try:
+    results = pool.map(run, sources)
+  finally:
+    pool.close()
+  elapsed = time.time() - start
+
+  if args.manifest:
+    rows = ['\t'.join(MANIFEST_COLUMNS)] + [
+        '\t'.join(str(r.get(column, '')) for column in MANIFEST_COLUMNS)
+        for r in results]
+    _write_object(store, args.manifest,
+                  ('\n'.join(rows) + '\n').encode('utf-8'))
+
+  failed = [r for r in results if r.get('failed')]
+  succeeded = [r for r in results if not r.get('failed')]
+
+  total_in = sum(r['in'] for r in succeeded)
+  total_out = sum(r['out'] for r in succeeded)
+  print("Total: %d objects, %d -> %d bytes in %.1f seconds (%.1f MB/s)" % (
+      len(succeeded), total_in, total_out, elapsed,
+      _mb_per_sec(total_in, elapsed)))
+
+  if failed:
+    print("ERROR: %d of %d objects failed" % (len(failed), len(results)),
+          file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
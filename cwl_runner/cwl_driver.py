@@ -0,0 +1,421 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Launch many CWL workflows with cwl_runner.sh and monitor them together.
+
+Each line of the batch file is a JSON object with the cwl_runner.sh options
+of one workflow, named by their long option names, for example:
+
+  {"workflow-file": "gs://MY-BUCKET/wf/transform.cwl",
+   "settings-file": "gs://MY-BUCKET/wf/sample1.json",
+   "input-recursive": "gs://MY-BUCKET/wf",
+   "output": "gs://MY-BUCKET/output/sample1"}
+
+Options given to this script (such as --machine-type or --queue) apply to
+every workflow, unless the workflow's line sets them.
+
+The workflows are launched in parallel, then their status files are polled
+concurrently until every workflow has COMPLETED or FAILED. Each status read
+is conditional on the object's generation, so a workflow whose status has
+not changed costs one small metadata request rather than a download. When a
+workflow finishes, the time spent in each phase (disk format, localization,
+install, run and upload) is read from the PHASE lines of its stdout log.
+
+Usage:
+  * PYTHONPATH=.. python cwl_driver.py \
+      [--state <local-state-path>] \
+      [--poll-interval <interval-in-seconds>] \
+      [--timeout <seconds>] \
+      [--project <project-id>] \
+      [--report <local-tsv-path>] \
+      [--machine-type ... --disk-size ... --zone ... --runner ... --queue ...] \
+      <batch-file>
+
+A workflow whose VM stops without writing a final status (for example, a
+preempted or deleted VM) would never finish. With --project, the VM of each
+unfinished workflow launched with a zone is looked up on every poll, and a
+workflow whose VM no longer exists is marked FAILED. With --timeout, the
+script stops monitoring after that many seconds, reporting the workflows
+not yet finished with their last status.
+
+With --state, each launched workflow is recorded as it is launched; running
+the same command again (for example after the script was interrupted) does
+not launch them again, and resumes monitoring them.
+
+The report has one tab-separated row per workflow: its operation id, status,
+seconds spent in each phase, total seconds and output path.
+
+This requires the google-api-python-client, the Cloud SDK (for
+cwl_runner.sh) and the PYTHONPATH to include the top-level directory of
+pipelines-api-examples.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import multiprocessing.pool
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from pipelines_pylib import clients
+from pipelines_pylib import gcs
+
+CWL_RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'cwl_runner.sh')
+
+# Phases of a workflow, in the order cwl_startup.sh runs them
+PHASES = ['disk', 'localization', 'install', 'run', 'upload']
+
+TERMINAL_STATUSES = ('COMPLETED', 'FAILED')
+
+REPORT_COLUMNS = (['operation-id', 'status'] + PHASES + ['total', 'output'])
+
+# Name of the VM which runs a workflow (see cwl_runner.sh)
+VM_NAME = 'cwl-vm-%s'
+
+# Polls of a finished workflow's stdout log before reporting it without
+# phase timings (the log is copied when the VM shuts down)
+LOG_POLLS = 10
+
+_PHASE_LINE = re.compile(r'^PHASE (\w+) (\d+)$', re.MULTILINE)
+
+# Options applied to every workflow (cwl_runner.sh long option names)
+RUNNER_OPTIONS = ['machine-type', 'disk-size', 'zone', 'runner', 'queue',
+                  'input-cache-size']
+RUNNER_FLAGS = ['preemptible', 'keep-alive', 'stream-outputs']
+
+
+def parse_phase_timings(stdout):
+  """Returns the seconds spent in each phase of a workflow.
+
+  Args:
+      stdout: the workflow's stdout log, with "PHASE <name> <epoch-seconds>"
+        lines marking the start of each phase (and "PHASE done ...").
+
+  Returns:
+      An OrderedDict of phase name -> seconds, for each phase which ended.
+  """
+
+  markers = [(name, int(t)) for name, t in _PHASE_LINE.findall(stdout)]
+  timings = collections.OrderedDict()
+  for (name, start), (_, end) in zip(markers, markers[1:]):
+    timings[name] = timings.get(name, 0) + end - start
+  return timings
+
+
+def runner_command(workflow, defaults):
+  """Returns the cwl_runner.sh command line for a workflow.
+
+  Args:
+      workflow: dict of long option name -> value (true for flags).
+      defaults: options applied unless the workflow sets them.
+  """
+
+  options = dict(defaults)
+  options.update(workflow)
+
+  command = [CWL_RUNNER]
+  for name in sorted(options):
+    value = options[name]
+    if value is True:
+      command.append('--' + name)
+    elif value not in (None, False, ''):
+      command.extend(['--' + name, str(value)])
+  return command
+
+
+class Workflow(object):
+  """The status and phase timings of a launched workflow."""
+
+  def __init__(self, operation_id, output, zone=None):
+    self.operation_id = operation_id
+    self.output = output.rstrip('/')
+    self.zone = zone  # of the workflow's own VM, if known
+    self.status = None
+    self.timings = None
+
+    self._status_generation = None
+    self._log_generation = None
+    self._log_polls = 0
+
+  def status_path(self):
+    return '%s/status-%s.txt' % (self.output, self.operation_id)
+
+  def stdout_path(self):
+    return '%s/stdout-%s.txt' % (self.output, self.operation_id)
+
+  def done(self):
+    return (self.status in TERMINAL_STATUSES and
+            (self.timings is not None or self._log_polls >= LOG_POLLS))
+
+  def refresh(self, store):
+    """Reads the workflow's status, and once finished its stdout log, if
+    they changed since last read."""
+
+    result = store.read_if_changed(self.status_path(), self._status_generation)
+    if result is not None:
+      data, self._status_generation = result
+      if data is not None:
+        self.status = data.decode('utf-8').strip()
+
+    if self.status in TERMINAL_STATUSES and self.timings is None:
+      self._log_polls += 1
+      result = store.read_if_changed(self.stdout_path(), self._log_generation)
+      if result is not None:
+        data, self._log_generation = result
+        if data is not None:
+          self.timings = parse_phase_timings(data.decode('utf-8', 'replace'))
+
+  def vm_lost(self):
+    """Marks the workflow FAILED after its VM stopped without writing a
+    final status; its stdout log is read once more, in case it was
+    copied."""
+
+    self.status = 'FAILED'
+    self._log_polls = max(self._log_polls, LOG_POLLS - 1)
+
+  def vm_exists(self, compute, project):
+    """Returns whether the workflow's VM exists; True if its zone is not
+    known."""
+
+    from apiclient import errors
+
+    if not self.zone:
+      return True
+    try:
+      compute.instances().get(project=project, zone=self.zone,
+                              instance=VM_NAME % self.operation_id).execute()
+    except errors.HttpError as e:
+      if e.resp.status == 404:
+        return False
+      raise
+    return True
+
+  def report_row(self):
+    timings = self.timings or {}
+    row = [self.operation_id, self.status or '']
+    row += [str(timings[p]) if p in timings else '' for p in PHASES]
+    row += [str(sum(timings.values())) if timings else '', self.output]
+    return row
+
+
+def read_batch(path):
+  with open(path) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def workflow_key(workflow):
+  return json.dumps(workflow, sort_keys=True)
+
+
+def read_state(path):
+  """Returns a dict of workflow key -> launched state record."""
+
+  state = {}
+  if path and os.path.exists(path):
+    with open(path) as f:
+      for line in f:
+        if line.strip():
+          record = json.loads(line)
+          state[record['key']] = record
+  return state
+
+
+def launch(workflows, defaults, state_path, workers):
+  """Launches workflows with cwl_runner.sh in parallel.
+
+  Returns:
+      A list of state records ({key, operation-id, output}) for the
+      workflows launched.
+  """
+
+  lock = threading.Lock()
+
+  def launch_one(workflow):
+    command = runner_command(workflow, defaults)
+    operation_id = subprocess.check_output(command).decode('utf-8').split()[-1]
+    record = {'key': workflow_key(workflow), 'operation-id': operation_id,
+              'output': workflow['output']}
+    with lock:
+      print("Launched workflow %s (%s)" % (operation_id, workflow['output']))
+      if state_path:
+        with open(state_path, 'a') as f:
+          f.write(json.dumps(record, sort_keys=True) + '\n')
+    return record
+
+  pool = multiprocessing.pool.ThreadPool(workers)
+  try:
+    return pool.map(launch_one, workflows)
+  finally:
+    pool.close()
+
+
+def workflow_zone(workflow, defaults):
+  """Returns the zone of a workflow's own VM, or None if it is not known
+  (no zone was given, or the workflow was queued to run on a worker)."""
+
+  options = dict(defaults)
+  options.update(workflow)
+  if options.get('queue'):
+    return None
+  return options.get('zone') or None
+
+
+def check_vm(store, compute, project, workflow):
+  """Marks an unfinished workflow FAILED if its VM no longer exists."""
+
+  if workflow.status in TERMINAL_STATUSES:
+    return
+  if workflow.vm_exists(compute, project):
+    return
+
+  # The VM writes its final status before it is deleted
+  workflow.refresh(store)
+  if workflow.status not in TERMINAL_STATUSES:
+    print("VM %s of workflow %s no longer exists; marking it FAILED" % (
+        VM_NAME % workflow.operation_id, workflow.operation_id))
+    workflow.vm_lost()
+
+
+def monitor(store, workflows, poll_interval, workers, timeout=None,
+            compute=None, project=None):
+  """Polls the workflows' status files until every workflow is done.
+
+  Args:
+      store: gcs.GcsStore holding the status files
+      workflows: list of Workflow
+      poll_interval: seconds between polls
+      workers: number of workflows polled in parallel
+      timeout: optional seconds after which to stop polling
+      compute: optional compute service; with project, the VMs of
+        unfinished workflows are looked up, and those which no longer exist
+        are marked FAILED
+
+  Returns:
+      True if every workflow is done, False if the timeout was reached.
+  """
+
+  deadline = None if timeout is None else time.time() + timeout
+  pool = multiprocessing.pool.ThreadPool(workers)
+  try:
+    while True:
+      pending = [w for w in workflows if not w.done()]
+      pool.map(lambda w: w.refresh(store), pending)
+      if compute and project:
+        pool.map(lambda w: check_vm(store, compute, project, w), pending)
+
+      statuses = collections.Counter(w.status or 'UNKNOWN' for w in workflows)
+      print("%s: %s" % (time.strftime('%H:%M:%S'), ', '.join(
+          '%d %s' % (n, s) for s, n in sorted(statuses.items()))))
+
+      if all(w.done() for w in workflows):
+        return True
+      if deadline is not None and time.time() + poll_interval > deadline:
+        print("Stopped monitoring after %d seconds with %d workflows not "
+              "finished" % (timeout, len([w for w in workflows
+                                          if not w.done()])))
+        return False
+      time.sleep(poll_interval)
+  finally:
+    pool.close()
+
+
+def print_summary(workflows):
+  """Prints the mean seconds spent in each phase by the workflows."""
+
+  print("Phase\tWorkflows\tMean seconds")
+  for phase in PHASES + ['total']:
+    values = [w.timings[phase] if phase != 'total' else sum(w.timings.values())
+              for w in workflows
+              if w.timings and (phase == 'total' or phase in w.timings)]
+    if values:
+      print("%s\t%d\t%.0f" % (phase, len(values),
+                              float(sum(values)) / len(values)))
+
+
+def main():
+  """Entry point to the script."""
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("batch",
+                      help="JSON lines file of cwl_runner.sh options, one "
+                           "line per workflow")
+  parser.add_argument("--state",
+                      help="Local path recording launched workflows; "
+                           "workflows already recorded are not relaunched")
+  parser.add_argument("--poll-interval", default=60, type=int,
+                      help="Frequency (in seconds) to poll the status files")
+  parser.add_argument("--timeout", type=int,
+                      help="Seconds after which to stop monitoring "
+                           "(default: until every workflow finishes)")
+  parser.add_argument("--project",
+                      help="Cloud project id of the workflows' VMs; if set, "
+                           "a workflow whose VM no longer exists is marked "
+                           "FAILED")
+  parser.add_argument("--workers", default=16, type=int,
+                      help="Number of workflows launched or polled in parallel")
+  parser.add_argument("--report",
+                      help="Local path to write the report (default: stdout)")
+  for name in RUNNER_OPTIONS:
+    parser.add_argument("--" + name,
+                        help="cwl_runner.sh --%s for every workflow" % name)
+  for name in RUNNER_FLAGS:
+    parser.add_argument("--" + name, action="store_true",
+                        help="cwl_runner.sh --%s for every workflow" % name)
+  args = parser.parse_args()
+
+  defaults = dict((name, getattr(args, name.replace('-', '_')))
+                  for name in RUNNER_OPTIONS + RUNNER_FLAGS)
+
+  batch = read_batch(args.batch)
+  state = read_state(args.state)
+  to_launch = [w for w in batch if workflow_key(w) not in state]
+  if len(to_launch) < len(batch):
+    print("Resuming %d workflows launched earlier" %
+          (len(batch) - len(to_launch)))
+
+  launched = launch(to_launch, defaults, args.state, args.workers)
+  for record in launched:
+    state[record['key']] = record
+
+  workflows = [Workflow(state[workflow_key(w)]['operation-id'],
+                        state[workflow_key(w)]['output'],
+                        workflow_zone(w, defaults)) for w in batch]
+
+  # Status files are read from many threads, each needing its own connection
+  client_pool = clients.ClientPool()
+  storage = client_pool.service('storage', 'v1')
+  compute = client_pool.service('compute', 'v1') if args.project else None
+  monitor(gcs.GcsStore(storage), workflows, args.poll_interval, args.workers,
+          args.timeout, compute, args.project)
+
+  out = open(args.report, 'w') if args.report else sys.stdout
+  try:
+    print('\t'.join(REPORT_COLUMNS), file=out)
+    for workflow in workflows:
+      print('\t'.join(workflow.report_row()), file=out)
+  finally:
+    if args.report:
+      out.close()
+
+  print_summary(workflows)
+
+  failed = [w for w in workflows if w.status != 'COMPLETED']
+  if failed:
+    print("%d of %d workflows did not complete" % (len(failed), len(workflows)))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
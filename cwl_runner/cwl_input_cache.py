@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Mount CWL workflow inputs read on demand through a local block cache.
+
+Rather than copying every input to the local disk before the workflow
+starts, cwl_startup.sh (with cwl_runner.sh --input-cache-size) runs this
+script to present the inputs as a read-only FUSE file system, laid out as
+the copied inputs would be:
+
+  gs://bucket/path/to/object -> <mount-point>/gs/bucket/path/to/object
+
+Inputs are listed when the file system is mounted, and their contents read
+only when the workflow reads them, a block at a time, through a
+blockcache.BlockCache on the local disk (with LRU eviction beyond the cache
+size, and read-ahead for sequential reads).
+
+When the file system is unmounted, the cache statistics are written as JSON
+to the --stats path, including the bytes declared (the total size of the
+inputs) and the bytes actually fetched.
+
+Usage:
+  * PYTHONPATH=.. python cwl_input_cache.py \
+      --cache-dir <local-dir> \
+      --cache-size <size-in-GB> \
+      [--input "<gcs-path>[;<gcs-path>...]"] \
+      [--input-recursive "<gcs-path>[;<gcs-path>...]"] \
+      [--stats <local-json-path>] \
+      <mount-point>
+
+This requires fusepy, the google-api-python-client and the PYTHONPATH to
+include the top-level directory of pipelines-api-examples.
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import json
+import os
+import stat
+import sys
+import time
+
+try:
+  import fuse
+except ImportError:
+  fuse = None
+
+from pipelines_pylib import blockcache
+from pipelines_pylib import clients
+from pipelines_pylib import gcs
+
+
+def local_path(url):
+  """Returns the path under the mount point for a Cloud Storage path, as
+  cwl_startup.sh lays out copied inputs ("gs://b/o" -> "gs/b/o")."""
+
+  return url.replace(':/', '', 1)
+
+
+def list_inputs(store, inputs, inputs_recursive):
+  """Returns a dict of local path -> object metadata for the inputs.
+
+  Args:
+      store: gcs.GcsStore or gcs.LocalStore
+      inputs: Cloud Storage paths (which may contain wildcards) of files,
+        each placed in the folder of its path
+      inputs_recursive: Cloud Storage paths of folders, whose contents are
+        placed under the folder's path
+  """
+
+  files = {}
+  for url in inputs:
+    if gcs.has_wildcard(url):
+      folder = os.path.dirname(local_path(url))
+      for metadata in store.list(url):
+        name = metadata['path'].rsplit('/', 1)[-1]
+        files['%s/%s' % (folder, name)] = metadata
+    else:
+      metadata = store.stat(url)
+      if metadata is None:
+        raise ValueError('Input does not exist: %s' % url)
+      files[local_path(url)] = metadata
+
+  for url in inputs_recursive:
+    prefix = url.rstrip('/') + '/'
+    for metadata in store.list(prefix):
+      files[local_path(metadata['path'])] = metadata
+
+  return files
+
+
+class CachedInputs(fuse.Operations if fuse else object):
+  """A read-only file system of Cloud Storage inputs."""
+
+  def __init__(self, cache, files):
+    """Args:
+        cache: blockcache.BlockCache to read through
+        files: dict of local path -> object metadata
+    """
+    self._cache = cache
+    self._files = dict(('/' + path, metadata)
+                       for path, metadata in files.items())
+    self._folders = {'/': set()}
+    self._time = time.time()
+
+    for path in self._files:
+      parts = path.split('/')
+      for i in range(1, len(parts)):
+        folder = '/'.join(parts[:i]) or '/'
+        self._folders.setdefault(folder, set()).add(parts[i])
+
+  def getattr(self, path, fh=None):
+    attributes = {'st_atime': self._time, 'st_mtime': self._time,
+                  'st_ctime': self._time, 'st_uid': os.getuid(),
+                  'st_gid': os.getgid()}
+    if path in self._folders:
+      attributes.update(st_mode=stat.S_IFDIR | 0o555, st_nlink=2)
+    elif path in self._files:
+      attributes.update(st_mode=stat.S_IFREG | 0o444, st_nlink=1,
+                        st_size=self._files[path]['size'])
+    else:
+      raise fuse.FuseOSError(errno.ENOENT)
+    return attributes
+
+  def readdir(self, path, fh):
+    return ['.', '..'] + sorted(self._folders.get(path, ()))
+
+  def open(self, path, flags):
+    if path not in self._files:
+      raise fuse.FuseOSError(errno.ENOENT)
+    if flags & (os.O_WRONLY | os.O_RDWR):
+      raise fuse.FuseOSError(errno.EROFS)
+    return 0
+
+  def read(self, path, size, offset, fh):
+    try:
+      return self._cache.read(self._files[path]['path'], offset, size)
+    except Exception as e:  # pylint: disable=broad-except
+      print("Error reading %s: %s" % (path, e), file=sys.stderr)
+      raise fuse.FuseOSError(errno.EIO)
+
+  def statfs(self, path):
+    return {'f_bsize': 4096, 'f_namemax': 1024}
+
+
+def split_urls(value):
+  """Splits a ";"-separated list of paths (as passed to cwl_startup.sh)."""
+
+  return [url.strip().strip('"') for url in (value or '').split(';')
+          if url.strip().strip('"')]
+
+
+def main():
+  """Entry point to the script."""
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("mount_point",
+                      help="Local folder to mount the inputs at")
+  parser.add_argument("--input", action="append", default=[],
+                      help="\";\"-separated Cloud Storage paths of input files")
+  parser.add_argument("--input-recursive", action="append", default=[],
+                      help="\";\"-separated Cloud Storage paths of input "
+                           "folders")
+  parser.add_argument("--cache-dir", required=True,
+                      help="Local folder for the cached blocks")
+  parser.add_argument("--cache-size", required=True, type=float,
+                      help="Size of the cache in GB")
+  parser.add_argument("--block-size", default=8, type=int,
+                      help="Size of each block read, in MB")
+  parser.add_argument("--read-ahead", default=blockcache.DEFAULT_READ_AHEAD,
+                      type=int,
+                      help="Blocks to read ahead of a sequential reader")
+  parser.add_argument("--stats",
+                      help="Local path to write the cache statistics to")
+  args = parser.parse_args()
+
+  if fuse is None:
+    parser.error("fusepy is required (pip install fusepy)")
+
+  # Blocks are read from FUSE and read-ahead threads, each needing its own
+  # connection
+  storage = clients.ClientPool().service('storage', 'v1')
+  store = gcs.GcsStore(storage)
+
+  files = list_inputs(
+      store,
+      [url for value in args.input for url in split_urls(value)],
+      [url for value in args.input_recursive for url in split_urls(value)])
+
+  cache = blockcache.BlockCache(store, args.cache_dir,
+                                int(args.cache_size * 1024 ** 3),
+                                block_size=args.block_size * 1024 * 1024,
+                                read_ahead=args.read_ahead)
+  for metadata in files.values():
+    cache.set_size(metadata['path'], metadata['size'])
+
+  declared = sum(metadata['size'] for metadata in files.values())
+  print("Mounting %d inputs (%d bytes) at %s" %
+        (len(files), declared, args.mount_point))
+
+  try:
+    fuse.FUSE(CachedInputs(cache, files), args.mount_point, foreground=True,
+              ro=True, allow_other=True)
+  finally:
+    cache.close()
+
+  stats = cache.stats()
+  stats.update(files=len(files), bytes_declared=declared)
+  print("Input cache: fetched %d of %d bytes declared (%d bytes read, "
+        "%d block hits, %d misses, %d read ahead, %d evictions)" %
+        (stats['bytes_fetched'], declared, stats['bytes_read'], stats['hits'],
+         stats['misses'], stats['read_ahead'], stats['evictions']))
+  if args.stats:
+    with open(args.stats, 'w') as f:
+      json.dump(stats, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,190 @@
+#!/bin/bash
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+# cwl_pool.sh
+#
+# From your shell prompt, launch a pool of Google Compute Engine VMs which
+# run Common Workflow Language (CWL) workflows added to a queue with
+# cwl_runner.sh --queue.
+#
+# Each worker installs Docker and the CWL runner once, then runs queued
+# workflows one after another (reusing the runner and Docker image cache)
+# and deletes itself when the queue has been empty for the idle timeout.
+
+declare QUEUE=
+declare WORKERS=1
+declare IDLE_TIMEOUT=600
+declare KEEP_ALIVE=
+declare DISK_SIZE=200
+declare MACHINE_TYPE="n1-standard-1"
+declare PREEMPTIBLE=
+declare RUNNER="cwltool"
+declare ZONE=
+readonly POOL_ID=$$
+
+read -r -d '' HELP_MESSAGE << EOM
+
+USAGE: $0 [args]
+
+-h --help
+  Show help message and exit
+
+Common options:
+-q --queue GCS_PATH
+  REQUIRED. The Cloud Storage path of the queue that workflows are added to with
+  cwl_runner.sh --queue.
+-n --workers INT
+  The number of worker VMs to launch. Default: ${WORKERS}.
+-t --idle-timeout SECONDS
+  Delete a worker once the queue has been empty for this long. Default: ${IDLE_TIMEOUT}.
+-m --machine-type STRING
+  The Google Compute Engine VM machine type name. Default: ${MACHINE_TYPE}.
+
+Other options:
+-d --disk-size INT
+  The disk size in Gb; each worker's disk holds one workflow at a time. Default: ${DISK_SIZE}.
+-k --keep-alive
+  Leave the VMs running after the idle timeout so that you can ssh in for debugging.
+-p --preemptible
+  Run with preemptible VMs that cost less but may be terminated before finishing.
+-r --runner STRING
+  The CWL runner to use. Values can be "cwltool" or "rabix". Default: ${RUNNER}.
+-z --zone STRING
+  The zone to launch the VMs and disks in. If omitted, your default project zone will be used.
+
+EOM
+
+set -o errexit
+set -o nounset
+
+# Parse command-line
+while [[ $# -gt 0 ]]; do
+  KEY="$1"
+
+  case ${KEY} in
+    -h|--help)
+    echo "${HELP_MESSAGE}"
+    exit 1
+    ;;
+    -q|--queue)
+    QUEUE="${2%/}"
+    shift
+    ;;
+    -n|--workers)
+    WORKERS="$2"
+    shift
+    ;;
+    -t|--idle-timeout)
+    IDLE_TIMEOUT="$2"
+    shift
+    ;;
+    -d|--disk-size)
+    DISK_SIZE="$2"
+    shift
+    ;;
+    -k|--keep-alive)
+    KEEP_ALIVE="true"
+    ;;
+    -m|--machine-type)
+    MACHINE_TYPE="$2"
+    shift
+    ;;
+    -p|--preemptible)
+    PREEMPTIBLE="--preemptible"
+    ;;
+    -z|--zone)
+    ZONE="--zone $2"
+    shift
+    ;;
+    -r|--runner)
+    RUNNER="$2"
+    shift
+    ;;
+    *)
+    # unknown option
+    ;;
+  esac
+  shift
+done
+
+if [[ -z "${QUEUE}" ]]; then
+  >&2 echo "Error: Queue is required."
+  exit 1
+fi
+
+# Worker scripts and logs are kept alongside the queue
+readonly WORKERS_PATH="${QUEUE}/workers"
+
+readonly SCRIPT_DIR="$( cd $( dirname ${BASH_SOURCE[0]} ) && pwd )"
+
+readonly STARTUP_SCRIPT_NAME="cwl_startup.sh"
+readonly STARTUP_SCRIPT="${SCRIPT_DIR}/${STARTUP_SCRIPT_NAME}"
+readonly STARTUP_SCRIPT_URL="${WORKERS_PATH}/${STARTUP_SCRIPT_NAME%.*}-${POOL_ID}.sh"
+
+readonly SHUTDOWN_SCRIPT_NAME="cwl_shutdown.sh"
+readonly SHUTDOWN_SCRIPT="${SCRIPT_DIR}/${SHUTDOWN_SCRIPT_NAME}"
+readonly SHUTDOWN_SCRIPT_URL="${WORKERS_PATH}/${SHUTDOWN_SCRIPT_NAME%.*}-${POOL_ID}.sh"
+
+# Scripts and libraries for the input cache (cwl_runner.sh --input-cache-size)
+readonly SUPPORT_URL="${WORKERS_PATH}/cwl-support-${POOL_ID}"
+
+>&2 echo $(date)
+>&2 echo "Copying scripts to the queue path in Cloud Storage"
+gsutil cp "${STARTUP_SCRIPT}" "${STARTUP_SCRIPT_URL}"
+gsutil cp "${SHUTDOWN_SCRIPT}" "${SHUTDOWN_SCRIPT_URL}"
+gsutil -m cp "${SCRIPT_DIR}/cwl_input_cache.py" "${SUPPORT_URL}/"
+gsutil -m cp -r "${SCRIPT_DIR}/../pipelines_pylib" "${SUPPORT_URL}/"
+
+for (( WORKER=0; WORKER < WORKERS; WORKER++ )); do
+  WORKER_ID="${POOL_ID}-${WORKER}"
+  DISK_NAME="cwl-worker-disk-${WORKER_ID}"
+  DISK_CMD="gcloud compute disks create ${DISK_NAME} ${ZONE} --size ${DISK_SIZE}"
+
+  VM_NAME="cwl-worker-${WORKER_ID}"
+  VM_CMD="gcloud compute instances create ${VM_NAME} \
+--disk name=${DISK_NAME},device-name=${DISK_NAME},auto-delete=yes \
+--machine-type ${MACHINE_TYPE} \
+--scopes storage-rw,compute-rw \
+${ZONE} \
+${PREEMPTIBLE} \
+--metadata \
+startup-script-url=${STARTUP_SCRIPT_URL},\
+shutdown-script-url=${SHUTDOWN_SCRIPT_URL},\
+operation-id=${WORKER_ID},\
+queue=${QUEUE},\
+idle-timeout=${IDLE_TIMEOUT},\
+support-url=${SUPPORT_URL},\
+output=${WORKERS_PATH},\
+runner=${RUNNER},\
+status-file=${WORKERS_PATH}/status-${WORKER_ID}.txt,\
+keep-alive=${KEEP_ALIVE}"
+
+  >&2 echo "Creating worker ${WORKER_ID}"
+  >&2 echo "${DISK_CMD}"
+  >&2 ${DISK_CMD}
+
+  >&2 echo "${VM_CMD}"
+  >&2 ${VM_CMD}
+done
+
+echo ${POOL_ID}
+
+>&2 cat << EOM
+
+Your pool of ${WORKERS} workers is starting.
+
+To run a workflow on the pool, add it to the queue:
+./cwl_runner.sh --queue "${QUEUE}" --workflow-file ... --settings-file ... --output ...
+
+To see the queued and running workflows:
+gsutil ls "${QUEUE}/pending" "${QUEUE}/running"
+
+Each worker deletes itself once the queue has been empty for ${IDLE_TIMEOUT} seconds
+(unless --keep-alive is set). Worker logs are written to:
+${WORKERS_PATH}
+EOM
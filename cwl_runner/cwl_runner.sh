@@ -17,11 +17,14 @@ declare INPUT=
 declare INPUT_RECURSIVE=
 declare OUTPUT=
 declare KEEP_ALIVE=
+declare STREAM_OUTPUTS=
+declare INPUT_CACHE_SIZE=
 declare DISK_SIZE=200
 declare MACHINE_TYPE="n1-standard-1"
 declare PREEMPTIBLE=
 declare RUNNER="cwltool"
 declare ZONE=
+declare QUEUE=
 readonly OPERATION_ID=$$
 
 read -r -d '' HELP_MESSAGE << EOM
@@ -52,10 +55,20 @@ Other options:
   Leave the VM running after the workflow completes or fails so that you can ssh in for debugging.
 -p --preemptible
   Run with a preemptible VM that costs less but may be terminated before finishing.
+-c --input-cache-size INT
+  Instead of copying the inputs to the VM's local disk before the workflow starts, read them
+  on demand through a local cache of this size in Gb. The --disk-size then only needs to
+  hold the cache and the workflow's outputs.
+-u --stream-outputs
+  Upload each output file as soon as it is written, while the workflow runs, rather than
+  all outputs after it completes.
 -r --runner STRING
   The CWL runner to use. Values can be "cwltool" or "rabix". Default: ${RUNNER}.
 -z --zone STRING
   The zone to launch the VM and disk in. If omitted, your default project zone will be used.
+-q --queue PATH
+  Instead of launching a VM, add the workflow to the queue (a Cloud Storage path) of a
+  pool of workers started with cwl_pool.sh. The VM options above are then ignored.
 
 EOM
 
@@ -98,6 +111,13 @@ while [[ $# -gt 0 ]]; do
     -k|--keep-alive)
     KEEP_ALIVE="true"
     ;;
+    -c|--input-cache-size)
+    INPUT_CACHE_SIZE="$2"
+    shift
+    ;;
+    -u|--stream-outputs)
+    STREAM_OUTPUTS="true"
+    ;;
     -m|--machine-type)
     MACHINE_TYPE="$2"
     shift
@@ -113,6 +133,10 @@ while [[ $# -gt 0 ]]; do
     RUNNER="$2"
     shift
     ;;
+    -q|--queue)
+    QUEUE="${2%/}"
+    shift
+    ;;
     *)
     # unknown option
     ;;
@@ -125,6 +149,48 @@ if [[ -z "${WORKFLOW_FILE}" || -z "${SETTINGS_FILE}" || -z "${OUTPUT}" ]]; then
   exit 1
 fi
 
+readonly STATUS_FILE="${OUTPUT}/status-${OPERATION_ID}.txt"
+
+# Scripts and libraries for the input cache
+readonly SUPPORT_URL="${OUTPUT}/cwl-support-${OPERATION_ID}"
+
+if [[ -n "${QUEUE}" ]]; then
+  >&2 echo "Adding the workflow to the queue ${QUEUE}"
+  readonly JOB_FILE=".$(basename ${0%.*} )-${OPERATION_ID}.job"
+  cat > "${JOB_FILE}" << EOF
+operation-id=${OPERATION_ID}
+workflow-file=${WORKFLOW_FILE}
+settings-file=${SETTINGS_FILE}
+input=${INPUT}
+input-recursive=${INPUT_RECURSIVE}
+output=${OUTPUT}
+status-file=${STATUS_FILE}
+stream-outputs=${STREAM_OUTPUTS}
+input-cache-size=${INPUT_CACHE_SIZE}
+EOF
+  echo "QUEUED" | gsutil -q cp - "${STATUS_FILE}"
+  gsutil -q cp "${JOB_FILE}" "${QUEUE}/pending/${OPERATION_ID}.job"
+  rm "${JOB_FILE}"
+
+  echo ${OPERATION_ID}
+
+  >&2 cat << EOM
+
+Your job is queued. It will be run by the next free worker of the pool.
+
+To monitor your job, check the status to see if it's QUEUED, RUNNING, COMPLETED, or FAILED:
+gsutil cat "${STATUS_FILE}"
+
+To cancel a queued job, remove it from the queue:
+gsutil rm "${QUEUE}/pending/${OPERATION_ID}.job"
+
+To debug a failed run, look at the log files in your output directory:
+gsutil cat "${OUTPUT}/stderr-${OPERATION_ID}.txt" | less
+gsutil cat "${OUTPUT}/stdout-${OPERATION_ID}.txt" | less
+EOM
+  exit 0
+fi
+
 readonly DISK_NAME="cwl-disk-${OPERATION_ID}"
 readonly DISK_CMD="gcloud compute disks create ${DISK_NAME} ${ZONE} --size ${DISK_SIZE}"
 
@@ -138,8 +204,6 @@ readonly SHUTDOWN_SCRIPT_NAME="cwl_shutdown.sh"
 readonly SHUTDOWN_SCRIPT="${SCRIPT_DIR}/${SHUTDOWN_SCRIPT_NAME}"
 readonly SHUTDOWN_SCRIPT_URL="${OUTPUT}/${SHUTDOWN_SCRIPT_NAME%.*}-${OPERATION_ID}.sh"
 
-readonly STATUS_FILE="${OUTPUT}/status-${OPERATION_ID}.txt"
-
 readonly VM_NAME="cwl-vm-${OPERATION_ID}"
 readonly VM_CMD="gcloud compute instances create ${VM_NAME} \
 --disk name=${DISK_NAME},device-name=${DISK_NAME},auto-delete=yes \
@@ -158,6 +222,9 @@ input-recursive=\"${INPUT_RECURSIVE}\",\
 output=${OUTPUT},\
 runner=${RUNNER},\
 status-file=${STATUS_FILE},\
+stream-outputs=${STREAM_OUTPUTS},\
+input-cache-size=${INPUT_CACHE_SIZE},\
+support-url=${SUPPORT_URL},\
 keep-alive=${KEEP_ALIVE}"
 
 >&2 echo $(date)
@@ -174,6 +241,10 @@ EOF
 gsutil cp "${STARTUP_SCRIPT}" "${STARTUP_SCRIPT_URL}"
 gsutil cp "${SHUTDOWN_SCRIPT}" "${SHUTDOWN_SCRIPT_URL}"
 gsutil cp "${TMP_SCRIPT}" "${OUTPUT}/${TMP_SCRIPT/./}"
+if [[ -n "${INPUT_CACHE_SIZE}" ]]; then
+  gsutil -m cp "${SCRIPT_DIR}/cwl_input_cache.py" "${SUPPORT_URL}/"
+  gsutil -m cp -r "${SCRIPT_DIR}/../pipelines_pylib" "${SUPPORT_URL}/"
+fi
 rm "${TMP_SCRIPT}"
 
 >&2 echo "Creating Google Compute Engine VM and disk"
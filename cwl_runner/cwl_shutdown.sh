@@ -28,6 +28,25 @@ CMD="gsutil -m cp ${STDOUT} ${STDERR} ${OUTPUT}/"
 echo "${CMD}"
 ${CMD}
 
+# A pool worker (see cwl_pool.sh) records the job it is running; the job's
+# logs and status are handled the same way as those of a single workflow
+readonly CURRENT_JOB="/tmp/cwl-current-job.sh"
+if [[ -f "${CURRENT_JOB}" ]]; then
+  source "${CURRENT_JOB}"
+
+  echo "Copying stdout and stderr of job ${JOB_ID} to Cloud Storage"
+  CMD="gsutil -m cp /tmp/stdout-${JOB_ID}.txt /tmp/stderr-${JOB_ID}.txt ${JOB_OUTPUT}/"
+  echo "${CMD}"
+  ${CMD}
+
+  JOB_STATUS_LOCAL="/tmp/status-${JOB_ID}.txt"
+  if [[ "$(cat ${JOB_STATUS_LOCAL})" == "RUNNING" ]]; then
+    echo "Setting status of job ${JOB_ID} to FAILED"
+    echo "FAILED" > ${JOB_STATUS_LOCAL}
+    gsutil cp ${JOB_STATUS_LOCAL} ${JOB_STATUS_FILE}
+  fi
+fi
+
 # Typically shutdown will cause a running job to fail and status will be set to FAILED
 # In case the status is left as RUNNING, set it to FAILED
 STATUS="$(cat ${STATUS_LOCAL})"
@@ -10,6 +10,11 @@
 #
 # This is the startup script that runs on Compute Engine to run
 # a Common Workflow Language (CWL) workflow with cwltool.
+#
+# If the VM has a "queue" metadata attribute (see cwl_pool.sh), it runs as a
+# pool worker instead: Docker and the CWL runner are installed once, then
+# workflow jobs are taken from the queue and run one after another until the
+# queue has been empty for the idle timeout.
 
 readonly METADATA_URL="http://metadata.google.internal/computeMetadata/v1/instance"
 readonly METADATA_HEADERS="Metadata-Flavor: Google"
@@ -17,8 +22,30 @@ readonly OPERATION_ID=$(curl "${METADATA_URL}/attributes/operation-id" -H "${MET
 readonly OUTPUT=$(curl "${METADATA_URL}/attributes/output" -H "${METADATA_HEADERS}")
 readonly STATUS_FILE=$(curl "${METADATA_URL}/attributes/status-file" -H "${METADATA_HEADERS}")
 readonly STATUS_LOCAL="/tmp/status-${OPERATION_ID}.txt"
+readonly QUEUE=$(curl --fail --silent "${METADATA_URL}/attributes/queue" -H "${METADATA_HEADERS}")
 STATUS="RUNNING"
 
+readonly MOUNT_POINT="/mnt/data"
+readonly CWL_VIRTUALENV="/opt/cwl"
+readonly RABIX_VERSION="1.0.0-rc2"
+readonly RABIX="/opt/rabix-${RABIX_VERSION}/rabix"
+
+# Details of the job a pool worker is running, for the shutdown script
+readonly CURRENT_JOB="/tmp/cwl-current-job.sh"
+
+# Seconds between checks of an empty queue
+readonly QUEUE_POLL_INTERVAL=30
+
+# Scripts and pipelines_pylib for the input cache (see cwl_input_cache.py)
+readonly SUPPORT_URL=$(curl --fail --silent "${METADATA_URL}/attributes/support-url" -H "${METADATA_HEADERS}")
+readonly SUPPORT_FOLDER="/opt/cwl-support"
+readonly INPUT_CACHE_VIRTUALENV="/opt/cwl-input-cache"
+INPUT_CACHE_PID=
+
+# Number of output files uploaded at once while a workflow runs
+readonly STREAM_UPLOADS=4
+STREAM_PID=
+
 echo "$(date)"
 echo "Status ${STATUS}"
 echo "${STATUS}" > ${STATUS_LOCAL}
@@ -34,138 +61,451 @@ echo "$(date)"
 echo "Running startup script"
 
 echo "Initializing variables"
-readonly WORKFLOW_FILE=$(curl "${METADATA_URL}/attributes/workflow-file" -H "${METADATA_HEADERS}")
-readonly SETTINGS_FILE=$(curl "${METADATA_URL}/attributes/settings-file" -H "${METADATA_HEADERS}")
-readonly INPUT=$(curl "${METADATA_URL}/attributes/input" -H "${METADATA_HEADERS}")
-readonly INPUT_RECURSIVE=$(curl "${METADATA_URL}/attributes/input-recursive" -H "${METADATA_HEADERS}")
 readonly DISK_NAME=google-$(curl "${METADATA_URL}/disks/1/device-name" -H "${METADATA_HEADERS}")
 readonly RUNNER=$(curl "${METADATA_URL}/attributes/runner" -H "${METADATA_HEADERS}")
 
-echo "$(date)"
-echo "Mounting and formatting disk"
-readonly MOUNT_POINT="/mnt/data"
-sudo mkfs.ext4 -F -E lazy_itable_init=0,lazy_journal_init=0,discard /dev/disk/by-id/${DISK_NAME}
-sudo mkdir -p ${MOUNT_POINT}
-sudo mount -o discard,defaults /dev/disk/by-id/${DISK_NAME} ${MOUNT_POINT}
-sudo chmod 777 ${MOUNT_POINT}
+# Marks the start of a phase (disk, localization, install, run, upload or
+# done) in stdout, where cwl_driver.py reads the time spent in each phase.
+function start_phase() {
+  echo "$(date)"
+  echo "PHASE $1 $(date +%s)"
+}
 
-echo "$(date)"
-echo "Creating folders for workflow inputs and outputs"
-readonly INPUT_FOLDER="${MOUNT_POINT}/input"
-readonly OUTPUT_FOLDER="${MOUNT_POINT}/output"
-readonly TMP_FOLDER="${MOUNT_POINT}/tmp"
-sudo mkdir -m 777 -p "${INPUT_FOLDER}"
-sudo mkdir -m 777 -p "${OUTPUT_FOLDER}"
-sudo mkdir -m 777 -p "${TMP_FOLDER}"
+# Writes a status (RUNNING, COMPLETED or FAILED) to a local and a Cloud
+# Storage status file.
+function set_status() {
+  local status="$1"
+  local status_local="$2"
+  local status_file="$3"
 
-echo "$(date)"
-echo "Copying input files to local disk"
-while IFS=';' read -ra URL_LIST; do
-  for URL in "${URL_LIST[@]}"; do
-    URL=$(echo ${URL} | tr -d '"')  # Remove quotes
-    URL_LOCAL="${INPUT_FOLDER}/$(dirname ${URL//:\//})"
-    CMD="mkdir -p ${URL_LOCAL}"
-    echo "${CMD}"
-    ${CMD}
-    CMD="gsutil -m -o GSUtil:parallel_composite_upload_threshold=150M cp ${URL} ${URL_LOCAL}"
-    echo "${CMD}"
-    ${CMD}
+  echo "$(date)"
+  echo "Status ${status}"
+  echo ${status} > ${status_local}
+  CMD="gsutil cp ${status_local} ${status_file}"
+  echo "${CMD}"
+  ${CMD}
+}
+
+function mount_disk() {
+  start_phase disk
+  echo "Mounting and formatting disk"
+  sudo mkfs.ext4 -F -E lazy_itable_init=0,lazy_journal_init=0,discard /dev/disk/by-id/${DISK_NAME}
+  sudo mkdir -p ${MOUNT_POINT}
+  sudo mount -o discard,defaults /dev/disk/by-id/${DISK_NAME} ${MOUNT_POINT}
+  sudo chmod 777 ${MOUNT_POINT}
+}
+
+# Creates the input, output and tmp folders of a job under the given folder.
+function create_folders() {
+  local job_folder="$1"
+
+  echo "$(date)"
+  echo "Creating folders for workflow inputs and outputs"
+  INPUT_FOLDER="${job_folder}/input"
+  OUTPUT_FOLDER="${job_folder}/output"
+  TMP_FOLDER="${job_folder}/tmp"
+  sudo mkdir -m 777 -p "${INPUT_FOLDER}"
+  sudo mkdir -m 777 -p "${OUTPUT_FOLDER}"
+  sudo mkdir -m 777 -p "${TMP_FOLDER}"
+}
+
+# Copies the inputs, workflow file and settings file of a job (given in
+# INPUT, INPUT_RECURSIVE, WORKFLOW_FILE and SETTINGS_FILE) to INPUT_FOLDER.
+function localize_inputs() {
+  start_phase localization
+  echo "Copying input files to local disk"
+  while IFS=';' read -ra URL_LIST; do
+    for URL in "${URL_LIST[@]}"; do
+      URL=$(echo ${URL} | tr -d '"')  # Remove quotes
+      URL_LOCAL="${INPUT_FOLDER}/$(dirname ${URL//:\//})"
+      CMD="mkdir -p ${URL_LOCAL}"
+      echo "${CMD}"
+      ${CMD}
+      CMD="gsutil -m -o GSUtil:parallel_composite_upload_threshold=150M cp ${URL} ${URL_LOCAL}"
+      echo "${CMD}"
+      ${CMD}
+    done
+  done <<< "${INPUT}"
+
+  echo "$(date)"
+  echo "Recursively copying input folders to local disk"
+  while IFS=';' read -ra URL_LIST; do
+    for URL in "${URL_LIST[@]}"; do
+      URL=$(echo ${URL} | tr -d '"')  # Remove quotes
+      URL_LOCAL="${INPUT_FOLDER}/${URL//:\//}"
+      CMD="mkdir -p ${URL_LOCAL}"
+      echo "${CMD}"
+      ${CMD}
+      CMD="gsutil -m -o GSUtil:parallel_composite_upload_threshold=150M rsync -r ${URL}/ ${URL_LOCAL}"
+      echo "${CMD}"
+      ${CMD}
+    done
+  done <<< "${INPUT_RECURSIVE}"
+
+  echo "Copying workflow file to local disk"
+  WORKFLOW_LOCAL="${INPUT_FOLDER}/${WORKFLOW_FILE//:\//}"
+  CMD="mkdir -p $(dirname ${WORKFLOW_LOCAL})"
+  echo "${CMD}"
+  ${CMD}
+  CMD="gsutil -m cp ${WORKFLOW_FILE} ${WORKFLOW_LOCAL}"
+  echo "${CMD}"
+  ${CMD}
+
+  echo "Copying settings file to local disk"
+  SETTINGS_LOCAL="${INPUT_FOLDER}/${SETTINGS_FILE//:\//}"
+  CMD="mkdir -p $(dirname ${SETTINGS_LOCAL})"
+  echo "${CMD}"
+  ${CMD}
+  CMD="gsutil -m cp ${SETTINGS_FILE} ${SETTINGS_LOCAL}"
+  echo "${CMD}"
+  ${CMD}
+}
+
+# Installs fusepy, the google-api-python-client and the input cache script,
+# if not already installed.
+function install_input_cache() {
+  if [[ -x "${INPUT_CACHE_VIRTUALENV}/bin/python" ]]; then
+    return
+  fi
+
+  start_phase install
+  echo "Installing the input cache"
+  sudo apt-get update
+  sudo apt-get --yes install fuse gcc python-dev python-setuptools ca-certificates
+  sudo easy_install -U virtualenv
+  sudo virtualenv "${INPUT_CACHE_VIRTUALENV}"
+  sudo "${INPUT_CACHE_VIRTUALENV}/bin/pip" install fusepy google-api-python-client crcmod
+
+  sudo mkdir -p "${SUPPORT_FOLDER}"
+  CMD="sudo gsutil -m cp -r ${SUPPORT_URL}/* ${SUPPORT_FOLDER}/"
+  echo "${CMD}"
+  ${CMD}
+}
+
+# Mounts the inputs, workflow file and settings file of a job at INPUT_FOLDER
+# (see localize_inputs), read on demand through a local block cache of the
+# given size (in GB) in the given folder.
+function mount_inputs() {
+  local cache_size="$1"
+  local cache_folder="$2"
+
+  install_input_cache
+
+  start_phase localization
+  echo "Mounting input files, cached on local disk"
+  sudo mkdir -m 777 -p "${cache_folder}"
+  INPUT_CACHE_STATS="${cache_folder}/input-cache-stats.json"
+  PYTHONPATH="${SUPPORT_FOLDER}" "${INPUT_CACHE_VIRTUALENV}/bin/python" \
+    "${SUPPORT_FOLDER}/cwl_input_cache.py" \
+    --cache-dir "${cache_folder}/blocks" \
+    --cache-size "${cache_size}" \
+    --stats "${INPUT_CACHE_STATS}" \
+    --input "${INPUT}" \
+    --input-recursive "${INPUT_RECURSIVE}" \
+    --input "${WORKFLOW_FILE};${SETTINGS_FILE}" \
+    "${INPUT_FOLDER}" &
+  INPUT_CACHE_PID=$!
+
+  for i in $(seq 120); do
+    if mountpoint -q "${INPUT_FOLDER}"; then
+      break
+    fi
+    sleep 1
   done
-done <<< "${INPUT}"
 
-echo "$(date)"
-echo "Recursively copying input folders to local disk"
-while IFS=';' read -ra URL_LIST; do
-  for URL in "${URL_LIST[@]}"; do
-    URL=$(echo ${URL} | tr -d '"')  # Remove quotes
-    URL_LOCAL="${INPUT_FOLDER}/${URL//:\//}"
-    CMD="mkdir -p ${URL_LOCAL}"
-    echo "${CMD}"
-    ${CMD}
-    CMD="gsutil -m -o GSUtil:parallel_composite_upload_threshold=150M rsync -r ${URL}/ ${URL_LOCAL}"
+  WORKFLOW_LOCAL="${INPUT_FOLDER}/${WORKFLOW_FILE//:\//}"
+  SETTINGS_LOCAL="${INPUT_FOLDER}/${SETTINGS_FILE//:\//}"
+}
+
+# Unmounts the inputs (if mounted) and copies the input cache statistics for
+# the given job id to the given Cloud Storage path.
+function unmount_inputs() {
+  local output="$1"
+  local job_id="$2"
+
+  if [[ -n "${INPUT_CACHE_PID}" ]]; then
+    echo "Unmounting input files"
+    fusermount -u "${INPUT_FOLDER}"
+    wait ${INPUT_CACHE_PID}
+    INPUT_CACHE_PID=
+    CMD="gsutil cp ${INPUT_CACHE_STATS} ${output}/input-cache-stats-${job_id}.json"
     echo "${CMD}"
     ${CMD}
-  done
-done <<< "${INPUT_RECURSIVE}"
-
-echo "Copying workflow file to local disk"
-readonly WORKFLOW_LOCAL="${INPUT_FOLDER}/${WORKFLOW_FILE//:\//}"
-CMD="mkdir -p $(dirname ${WORKFLOW_LOCAL})"
-echo "${CMD}"
-${CMD}
-CMD="gsutil -m cp ${WORKFLOW_FILE} ${WORKFLOW_LOCAL}"
-echo "${CMD}"
-${CMD}
-
-echo "Copying settings file to local disk"
-readonly SETTINGS_LOCAL="${INPUT_FOLDER}/${SETTINGS_FILE//:\//}"
-CMD="mkdir -p $(dirname ${SETTINGS_LOCAL})"
-echo "${CMD}"
-${CMD}
-CMD="gsutil -m cp ${SETTINGS_FILE} ${SETTINGS_LOCAL}"
-echo "${CMD}"
-${CMD}
+  fi
+}
 
-echo "$(date)"
-echo "Installing Docker and CWL runner ${RUNNER}"
+function install_runner() {
+  start_phase install
+  echo "Installing Docker and CWL runner ${RUNNER}"
 
-if [[ ${RUNNER} == "cwltool" ]]; then
-  sudo apt-get update
-  sudo apt-get --yes install apt-utils docker.io gcc python-dev python-setuptools ca-certificates
-  sudo easy_install -U virtualenv
-  sudo systemctl start docker.service
+  if [[ ${RUNNER} == "cwltool" ]]; then
+    sudo apt-get update
+    sudo apt-get --yes install apt-utils docker.io gcc python-dev python-setuptools ca-certificates inotify-tools
+    sudo easy_install -U virtualenv
+    sudo systemctl start docker.service
 
-  echo "$(date)"
-  echo "Starting virtualenv"
-  virtualenv cwl
-  source cwl/bin/activate
-  pip install cwlref-runner
+    echo "$(date)"
+    echo "Creating virtualenv"
+    sudo virtualenv "${CWL_VIRTUALENV}"
+    sudo "${CWL_VIRTUALENV}/bin/pip" install cwlref-runner
 
-  echo "$(date)"
+  elif [[ ${RUNNER} == "rabix" ]]
+  then
+    sudo apt-get --yes install openjdk-8-jre
+    sudo apt-get update
+    sudo apt-get --yes install apt-utils docker.io gcc ca-certificates inotify-tools
+    sudo systemctl start docker.service
+
+    (cd /opt && sudo wget https://github.com/rabix/bunny/releases/download/v${RABIX_VERSION}/rabix-${RABIX_VERSION}.tar.gz && sudo tar -xvf rabix-${RABIX_VERSION}.tar.gz)
+
+  else
+    >&2 echo "Error. Unknown CWL runner: ${RUNNER}"
+  fi
+}
+
+# Runs the workflow in WORKFLOW_LOCAL with SETTINGS_LOCAL and sets STATUS to
+# COMPLETED or FAILED.
+function run_workflow() {
+  STATUS="FAILED"
+
+  start_phase run
   echo "Running the CWL workflow"
   export HOME="/root"  # cwl runner needs it; startup scripts don't have it defined
   cd "${INPUT_FOLDER}"
-  CMD="cwl-runner --outdir ${OUTPUT_FOLDER} --tmpdir-prefix ${TMP_FOLDER} --tmp-outdir-prefix ${TMP_FOLDER} ${WORKFLOW_LOCAL} ${SETTINGS_LOCAL}"
-  echo "${CMD}"
-  ${CMD} && STATUS="COMPLETED" || STATUS="FAILED"
 
-  deactivate
+  if [[ ${RUNNER} == "cwltool" ]]; then
+    source "${CWL_VIRTUALENV}/bin/activate"
+    CMD="cwl-runner --outdir ${OUTPUT_FOLDER} --tmpdir-prefix ${TMP_FOLDER} --tmp-outdir-prefix ${TMP_FOLDER} ${WORKFLOW_LOCAL} ${SETTINGS_LOCAL}"
+    echo "${CMD}"
+    ${CMD} && STATUS="COMPLETED" || STATUS="FAILED"
+    deactivate
 
-elif [[ ${RUNNER} == "rabix" ]]
-then
-  sudo apt-get --yes install openjdk-8-jre
-  sudo apt-get update
-  sudo apt-get --yes install apt-utils docker.io gcc ca-certificates
-  sudo systemctl start docker.service
+  elif [[ ${RUNNER} == "rabix" ]]
+  then
+    CMD="${RABIX} --basedir ${OUTPUT_FOLDER} --outdir ${OUTPUT_FOLDER} --tmpdir-prefix ${TMP_FOLDER} --tmp-outdir-prefix ${TMP_FOLDER} ${WORKFLOW_LOCAL} ${SETTINGS_LOCAL}"
+    echo "${CMD}"
+    ${CMD} && STATUS="COMPLETED" || STATUS="FAILED"
+  fi
 
-  cd "${INPUT_FOLDER}"
-  wget https://github.com/rabix/bunny/releases/download/v1.0.0-rc2/rabix-1.0.0-rc2.tar.gz && tar -xvf rabix-1.0.0-rc2.tar.gz
-  RABIX="${INPUT_FOLDER}/rabix-1.0.0-rc2/rabix"
+  cd /
+  echo "$(date)"
+  echo "Finished running CWL"
+}
+
+# Uploads each file written to OUTPUT_FOLDER to the given Cloud Storage path
+# as soon as it is closed, while the workflow runs. Files are copied with
+# their modification times (cp -P), so the final rsync in delocalize_outputs
+# only transfers files which changed after they were uploaded, or which were
+# missed while a new folder was being watched.
+function start_output_streaming() {
+  local output="$1"
 
   echo "$(date)"
-  echo "Running the CWL workflow"
-  export HOME="/root"  # cwl runner needs it; startup scripts don't have it defined
-  CMD="${RABIX} --basedir ${OUTPUT_FOLDER} --outdir ${OUTPUT_FOLDER} --tmpdir-prefix ${TMP_FOLDER} --tmp-outdir-prefix ${TMP_FOLDER} ${WORKFLOW_LOCAL} ${SETTINGS_LOCAL}"
+  echo "Streaming output files to ${output}"
+  inotifywait --quiet --monitor --recursive --event close_write --event moved_to \
+      --format '%w%f' "${OUTPUT_FOLDER}" \
+    | xargs -d '\n' -r -P ${STREAM_UPLOADS} -I {} \
+        bash -c 'gsutil -q cp -P "$1" "$2/${1#$3/}"' _ {} "${output}" "${OUTPUT_FOLDER}" &
+  STREAM_PID=$!
+}
+
+# Stops watching OUTPUT_FOLDER and waits for the uploads in progress.
+function stop_output_streaming() {
+  if [[ -n "${STREAM_PID}" ]]; then
+    echo "Waiting for streamed output uploads to finish"
+    pkill -f "inotifywait .*${OUTPUT_FOLDER}"
+    wait ${STREAM_PID}
+    STREAM_PID=
+  fi
+}
+
+# Copies OUTPUT_FOLDER to the given Cloud Storage path.
+function delocalize_outputs() {
+  local output="$1"
+
+  start_phase upload
+  stop_output_streaming
+  echo "Copying output files to Cloud Storage"
+  CMD="gsutil -m -o GSUtil:parallel_composite_upload_threshold=150M rsync -r ${OUTPUT_FOLDER}/ ${output}/"
   echo "${CMD}"
-  ${CMD} && STATUS="COMPLETED" || STATUS="FAILED"
+  ${CMD}
+}
+
+# Queue functions, for a queue in Cloud Storage or (for testing on a single
+# machine) a local directory, with pending/, running/ and done/ folders of
+# <job-id>.job files.
+
+function queue_is_local() {
+  [[ "${QUEUE}" != gs://* ]]
+}
+
+# Prints the ids of the pending jobs, oldest first.
+function queue_pending() {
+  if queue_is_local; then
+    ls -tr "${QUEUE}/pending" 2>/dev/null | sed -n 's/\.job$//p'
+  else
+    gsutil ls -l "${QUEUE}/pending/*.job" 2>/dev/null | grep 'gs://' | sort -k 2 \
+      | sed -e 's#.*/##' -e 's/\.job$//'
+  fi
+}
+
+# Claims a pending job by moving it to running/. Only one worker's claim of a
+# job succeeds: locally, the rename fails once the job has moved, and in
+# Cloud Storage, the copy is conditional on running/<job-id>.job not existing.
+function queue_claim() {
+  local job_id="$1"
+
+  if queue_is_local; then
+    mv "${QUEUE}/pending/${job_id}.job" "${QUEUE}/running/${job_id}.job" 2>/dev/null
+  else
+    gsutil -q -h "x-goog-if-generation-match:0" \
+      cp "${QUEUE}/pending/${job_id}.job" "${QUEUE}/running/${job_id}.job" 2>/dev/null \
+      && gsutil -q rm "${QUEUE}/pending/${job_id}.job"
+  fi
+}
+
+function queue_finish() {
+  local job_id="$1"
+
+  if queue_is_local; then
+    mkdir -p "${QUEUE}/done"
+    mv "${QUEUE}/running/${job_id}.job" "${QUEUE}/done/${job_id}.job"
+  else
+    gsutil -q mv "${QUEUE}/running/${job_id}.job" "${QUEUE}/done/${job_id}.job"
+  fi
+}
+
+# Prints the value of an attribute ("name=value" line) of a job file.
+function job_attribute() {
+  local job_file="$1"
+  local name="$2"
+
+  sed -n "s/^${name}=//p" "${job_file}" | head -n 1
+}
+
+# Runs one job from the queue, with its stdout and stderr captured in its own
+# log files, and the same status file and output layout as a single-workflow
+# VM.
+function run_job() {
+  local job_id="$1"
+  local job_file="/tmp/${job_id}.job"
+
+  if queue_is_local; then
+    cp "${QUEUE}/running/${job_id}.job" "${job_file}"
+  else
+    gsutil -q cp "${QUEUE}/running/${job_id}.job" "${job_file}"
+  fi
+
+  WORKFLOW_FILE=$(job_attribute "${job_file}" workflow-file)
+  SETTINGS_FILE=$(job_attribute "${job_file}" settings-file)
+  INPUT=$(job_attribute "${job_file}" input)
+  INPUT_RECURSIVE=$(job_attribute "${job_file}" input-recursive)
+  local job_output=$(job_attribute "${job_file}" output)
+  local job_status_file=$(job_attribute "${job_file}" status-file)
+  local job_status_local="/tmp/status-${job_id}.txt"
+  local job_stdout="/tmp/stdout-${job_id}.txt"
+  local job_stderr="/tmp/stderr-${job_id}.txt"
+  local job_folder="${MOUNT_POINT}/jobs/${job_id}"
+
+  printf 'JOB_ID=%q\nJOB_OUTPUT=%q\nJOB_STATUS_FILE=%q\n' \
+    "${job_id}" "${job_output}" "${job_status_file}" > "${CURRENT_JOB}"
+
+  {
+    set_status RUNNING "${job_status_local}" "${job_status_file}"
+    create_folders "${job_folder}"
+    local input_cache_size=$(job_attribute "${job_file}" input-cache-size)
+    if [[ -n "${input_cache_size}" ]]; then
+      mount_inputs "${input_cache_size}" "${job_folder}/input-cache"
+    else
+      localize_inputs
+    fi
+    if [[ "$(job_attribute "${job_file}" stream-outputs)" == "true" ]]; then
+      start_output_streaming "${job_output}"
+    fi
+    run_workflow
+    unmount_inputs "${job_output}" "${job_id}"
+    delocalize_outputs "${job_output}"
+    start_phase done
+  } > "${job_stdout}" 2> "${job_stderr}"
+
+  echo "Job ${job_id} ${STATUS}"
+  gsutil -m cp "${job_stdout}" "${job_stderr}" "${job_output}/"
+  set_status "${STATUS}" "${job_status_local}" "${job_status_file}"
+
+  queue_finish "${job_id}"
+  rm -f "${CURRENT_JOB}" "${job_file}" "${job_stdout}" "${job_stderr}"
+  sudo rm -rf "${job_folder}"
+}
+
+# Takes jobs from the queue until it has been empty for IDLE_TIMEOUT seconds.
+function run_worker() {
+  local idle_timeout=$(curl --fail --silent "${METADATA_URL}/attributes/idle-timeout" -H "${METADATA_HEADERS}")
+  local idle_since=$(date +%s)
+  local job_id
+  local claimed
+
+  echo "$(date)"
+  echo "Taking jobs from ${QUEUE} (idle timeout ${idle_timeout:=600} seconds)"
+
+  while true; do
+    claimed=
+    for job_id in $(queue_pending); do
+      if queue_claim "${job_id}"; then
+        echo "$(date)"
+        echo "Running job ${job_id}"
+        run_job "${job_id}"
+        claimed="true"
+        break
+      fi
+    done
+
+    if [[ -n "${claimed}" ]]; then
+      idle_since=$(date +%s)
+    elif (( $(date +%s) - idle_since >= idle_timeout )); then
+      echo "$(date)"
+      echo "Queue empty for ${idle_timeout} seconds"
+      break
+    else
+      sleep ${QUEUE_POLL_INTERVAL}
+    fi
+  done
+
+  STATUS="COMPLETED"
+}
+
+mount_disk
+
+if [[ -n "${QUEUE}" ]]; then
+  install_runner
+  run_worker
 
 else
-  >&2 echo "Error. Unknown CWL runner: ${RUNNER}"
-fi
+  echo "Initializing variables"
+  readonly WORKFLOW_FILE=$(curl "${METADATA_URL}/attributes/workflow-file" -H "${METADATA_HEADERS}")
+  readonly SETTINGS_FILE=$(curl "${METADATA_URL}/attributes/settings-file" -H "${METADATA_HEADERS}")
+  readonly INPUT=$(curl "${METADATA_URL}/attributes/input" -H "${METADATA_HEADERS}")
+  readonly INPUT_RECURSIVE=$(curl "${METADATA_URL}/attributes/input-recursive" -H "${METADATA_HEADERS}")
 
-echo "$(date)"
-echo "Finished running CWL"
-echo "Copying output files to Cloud Storage"
-CMD="gsutil -m -o GSUtil:parallel_composite_upload_threshold=150M rsync -r ${OUTPUT_FOLDER}/ ${OUTPUT}/"
-echo "${CMD}"
-${CMD}
+  readonly INPUT_CACHE_SIZE=$(curl --fail --silent "${METADATA_URL}/attributes/input-cache-size" -H "${METADATA_HEADERS}")
 
-echo "$(date)"
-echo "Status ${STATUS}"
-echo ${STATUS} > ${STATUS_LOCAL}
-CMD="gsutil cp ${STATUS_LOCAL} ${STATUS_FILE}"
-echo "${CMD}"
-${CMD}
+  create_folders "${MOUNT_POINT}"
+  if [[ -n "${INPUT_CACHE_SIZE}" ]]; then
+    mount_inputs "${INPUT_CACHE_SIZE}" "${MOUNT_POINT}/input-cache"
+  else
+    localize_inputs
+  fi
+  install_runner
+  STREAM_OUTPUTS=$(curl --fail --silent "${METADATA_URL}/attributes/stream-outputs" -H "${METADATA_HEADERS}")
+  if [[ "${STREAM_OUTPUTS}" == "true" ]]; then
+    start_output_streaming "${OUTPUT}"
+  fi
+  run_workflow
+  unmount_inputs "${OUTPUT}" "${OPERATION_ID}"
+  delocalize_outputs "${OUTPUT}"
+  start_phase done
+fi
+
+set_status "${STATUS}" "${STATUS_LOCAL}" "${STATUS_FILE}"
 
 KEEP_ALIVE=$(curl "${METADATA_URL}/attributes/keep-alive" -H "${METADATA_HEADERS}")
 if [[ "${KEEP_ALIVE}" = "true" ]]; then
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Summarize FastQC results across many samples in a single table.
+
+FastQC writes a <name>_fastqc.zip per input file, containing
+<name>_fastqc/fastqc_data.txt with the basic statistics and the pass/warn/fail
+status of each analysis module. This script reads fastqc_data.txt directly
+out of each zip (the zips are read into memory, not extracted to disk),
+processing many zips in parallel, and writes one tab-separated row per
+sample:
+
+  Filename, Total Sequences, Sequences flagged as poor quality,
+  Sequence length, %GC, <status of each FastQC module>
+
+Usage:
+  * PYTHONPATH=.. python aggregate_fastqc.py \
+      [--workers <number-of-parallel-reads>] \
+      [--output <local-tsv-path>] \
+      <zip-path> [<zip-path> ...]
+
+Zip paths may be local files or Cloud Storage paths, which may include
+wildcards:
+
+  PYTHONPATH=.. python aggregate_fastqc.py \
+      "gs://YOUR-BUCKET/pipelines-api-examples/fastqc/output/*_fastqc.zip"
+
+The PYTHONPATH must include the top-level directory of
+pipelines-api-examples, and reading from Cloud Storage also requires the
+google-api-python-client.
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import multiprocessing.pool
+import sys
+import zipfile
+
+from pipelines_pylib import gcs
+
+# Basic Statistics measures included in the summary (in column order)
+BASIC_STATISTICS = [
+  'Filename',
+  'Total Sequences',
+  'Sequences flagged as poor quality',
+  'Sequence length',
+  '%GC',
+]
+
+
+def parse_fastqc_data(lines):
+  """Parses fastqc_data.txt.
+
+  Args:
+      lines: iterable of the (text) lines of fastqc_data.txt
+
+  Returns:
+      A tuple of (dict of Basic Statistics measure -> value,
+                  list of (module name, status) in file order).
+  """
+
+  statistics = {}
+  modules = []
+
+  module = None
+  for line in lines:
+    line = line.rstrip('\n')
+    if line.startswith('>>END_MODULE'):
+      module = None
+    elif line.startswith('>>'):
+      module, status = line[2:].split('\t')
+      modules.append((module, status))
+    elif module == 'Basic Statistics' and not line.startswith('#'):
+      measure, value = line.split('\t', 1)
+      statistics[measure] = value
+
+  return statistics, modules
+
+
+def read_fastqc_zip(data):
+  """Returns the parsed fastqc_data.txt from the contents of a FastQC zip."""
+
+  with zipfile.ZipFile(io.BytesIO(data)) as archive:
+    names = [n for n in archive.namelist() if n.endswith('/fastqc_data.txt')]
+    if len(names) != 1:
+      raise ValueError('Expected one fastqc_data.txt, found %d' % len(names))
+
+    text = archive.read(names[0]).decode('utf-8')
+    return parse_fastqc_data(text.splitlines())
+
+
+def main():
+  """Entry point to the script."""
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--workers", default=16, type=int,
+                      help="Number of zip files to read in parallel")
+  parser.add_argument("--output",
+                      help="Local path to write the summary (default: stdout)")
+  parser.add_argument("zips", nargs="+",
+                      help="Local or Cloud Storage paths to *_fastqc.zip files")
+  args = parser.parse_args()
+
+  reader = gcs.Reader()
+  paths = reader.expand(args.zips)
+
+  def summarize(path):
+    return read_fastqc_zip(reader.read(path))
+
+  # Reads are I/O bound and zlib releases the GIL, so threads suffice
+  pool = multiprocessing.pool.ThreadPool(args.workers)
+  try:
+    results = pool.map(summarize, paths)
+  finally:
+    pool.close()
+
+  # Module columns, in the order FastQC reports them
+  module_names = []
+  for _, modules in results:
+    for name, _ in modules:
+      if name != 'Basic Statistics' and name not in module_names:
+        module_names.append(name)
+
+  out = open(args.output, 'w') if args.output else sys.stdout
+  try:
+    print('\t'.join(BASIC_STATISTICS + module_names), file=out)
+    for statistics, modules in results:
+      statuses = dict(modules)
+      print('\t'.join([statistics.get(m, '') for m in BASIC_STATISTICS] +
+                      [statuses.get(m, '') for m in module_names]), file=out)
+  finally:
+    if args.output:
+      out.close()
+
+  print("Summarized %d FastQC results" % len(results), file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
@@ -33,12 +33,23 @@ Usage:
       --project <project-id> \
       --zones <gce-zones> \
       --disk-size <size-in-gb> \
+      --threads <number-of-threads> \
       --input <gcs-input-path> \
       --output <gcs-output-path> \
       --logging <gcs-logging-path> \
       --poll-interval <interval-in-seconds>
 
-Where the poll-interval is optional (default is no polling).
+Where the threads are optional (default is 1) and the poll-interval is
+optional (default is no polling). When polling, the operations of all the
+requests are refreshed together.
+
+FastQC processes one file per thread. With --threads N, FastQC analyzes up
+to N input files at once and the VM is given at least N cores.
+
+The options shared by the batch launchers, such as --input-manifest,
+--journal, --cache-dir, --speculate, --zone-failover, --subscription,
+--quota-regions, --auto-resources and --plan, are described in
+pipelines_pylib/launch.py.
 
 Users will typically want to restrict the Compute Engine zones to avoid Cloud
 Storage egress charges. This script supports a short-hand pattern-matching
@@ -53,13 +64,15 @@ an explicit list may be specified, space-separated:
 """
 
 import argparse
-import pprint
-
-from oauth2client.client import GoogleCredentials
-from apiclient.discovery import build
+import itertools
 
+from pipelines_pylib import clients
 from pipelines_pylib import defaults
-from pipelines_pylib import poller
+from pipelines_pylib import gcs
+from pipelines_pylib import inputs
+from pipelines_pylib import launch
+from pipelines_pylib import metrics
+from pipelines_pylib import packing
 
 # Parse input args
 parser = argparse.ArgumentParser()
@@ -69,22 +82,33 @@ parser.add_argument("--disk-size", required=True, type=int,
                     help="Size (in GB) of disk for both input and output")
 parser.add_argument("--zones", required=True, nargs="+",
                     help="List of Google Compute Engine zones (supports wildcards)")
-parser.add_argument("--input", required=True, nargs="+",
-                    help="Cloud Storage path to input file(s)")
+parser.add_argument("--threads", default=1, type=int,
+                    help="Number of files FastQC processes concurrently "
+                         "(also sets the minimum number of CPU cores)")
 parser.add_argument("--output", required=True,
                     help="Cloud Storage path to write output files")
 parser.add_argument("--logging", required=True,
                     help="Cloud Storage path to send logging output")
-parser.add_argument("--poll-interval", default=0, type=int,
-                    help="Frequency (in seconds) to poll for completion (default: no polling)")
-args = parser.parse_args()
-
-# Create the genomics service
-credentials = GoogleCredentials.get_application_default()
-service = build('genomics', 'v1alpha2', credentials=credentials)
-
-# Run the pipeline
-operation = service.pipelines().run(body={
+launch.add_arguments(parser)
+args = launch.parse_args(parser)
+
+# Create the Cloud Storage store, for listing and sizing the inputs
+client_pool = clients.ClientPool()
+store = gcs.GcsStore(client_pool.service('storage', 'v1'))
+
+# Read and expand the inputs lazily, in chunks small enough for one request
+input_paths, input_chunks = launch.read_inputs(parser, args, store)
+
+# The Docker command, followed by packing its outputs if requested
+cmd = ('mkdir /mnt/data/output && '
+       'fastqc -t %d /mnt/data/input/* --outdir=/mnt/data/output/'
+       % args.threads)
+if args.pack_outputs:
+  cmd = packing.packed_command(cmd)
+
+# Build the pipeline request
+body_timer = metrics.timer('launcher.build_body').start()
+body = {
   # The ephemeralPipeline provides the template for the pipeline
   # The pipelineArgs provide the inputs specific to this run
 
@@ -118,8 +142,7 @@ operation = service.pipelines().run(body={
 
       # The Pipelines API will create the input directory when localizing files,
       # but does not create the output directory.
-      'cmd': ('mkdir /mnt/data/output && '
-              'fastqc /mnt/data/input/* --outdir=/mnt/data/output/'),
+      'cmd': cmd,
     },
 
     # The Pipelines API currently supports full GCS paths, along with patterns (globs),
@@ -155,16 +178,19 @@ operation = service.pipelines().run(body={
         'path': 'input/',
         'disk': 'datadisk'
       }
-    } for idx in range(len(args.input)) ],
+    } for idx in range(len(input_paths)) ],
 
     # By specifying an outputParameter, we instruct the pipelines API to
     # copy /mnt/data/output/* to the Cloud Storage location specified in
     # the pipelineArgs (see below).
+    # With --pack-outputs, only the archive and index written to
+    # /mnt/data/packed are copied.
     'outputParameters': [ {
       'name': 'outputPath',
       'description': 'Cloud Storage path for where to FastQC output',
       'localCopy': {
-        'path': 'output/*',
+        'path': (packing.PACKED_PATH if args.pack_outputs
+                 else 'output/*'),
         'disk': 'datadisk'
       }
     } ]
@@ -175,7 +201,10 @@ operation = service.pipelines().run(body={
 
     # Override the resources needed for this pipeline
     'resources': {
-      'minimumRamGb': 1, # For this example, override the 3.75 GB default
+      # One core per FastQC thread. FastQC allocates 250 MB of heap per thread;
+      # for a single thread, override the 3.75 GB default.
+      'minimumCpuCores': args.threads,
+      'minimumRamGb': max(1, 0.5 * args.threads),
 
       # Expand any zone short-hand patterns
       'zones': defaults.get_zones(args.zones),
@@ -195,7 +224,7 @@ operation = service.pipelines().run(body={
     #   <etc>
     # }
     'inputs': {
-      'inputFile%d' % idx : value for idx, value in enumerate(args.input)
+      'inputFile%d' % idx : value for idx, value in enumerate(input_paths)
     },
 
     # Pass the user-specified Cloud Storage destination path of the FastQC output
@@ -208,13 +237,14 @@ operation = service.pipelines().run(body={
       'gcsPath': args.logging
     },
   }
-}).execute()
+}
+
+body_timer.stop()
 
-# Emit the result of the pipeline run submission
-pp = pprint.PrettyPrinter(indent=2)
-pp.pprint(operation)
+# The first request is for the first chunk of inputs; build one more request
+# per remaining chunk
+requests = itertools.chain(
+    [body], (inputs.with_inputs(body, chunk) for chunk in input_chunks))
 
-# If requested - poll until the operation reaches completion state ("done: true")
-if args.poll_interval > 0:
-  completed_op = poller.poll(service, operation, args.poll_interval)
-  pp.pprint(completed_op)
+# Submit the requests and, if polling, wait for them to complete
+launch.run_batch(args, requests, client_pool, store, min_cores=args.threads)
@@ -0,0 +1,242 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""A local read-through block cache for Cloud Storage objects.
+
+Objects are read in fixed-size blocks with ranged reads (see gcs.GcsStore and
+gcs.LocalStore read()), and each block fetched is kept in a file in a local
+cache directory. When the cache exceeds its size limit, the least recently
+used blocks are evicted. A sequential reader (a read of the block following
+the previous one read from the same object) also triggers read-ahead of the
+next blocks in background threads, so that streaming through a large object
+is not limited by the latency of each request.
+
+Typical usage:
+
+  cache = blockcache.BlockCache(store, '/mnt/data/cache',
+                                max_bytes=50 * 1024 ** 3)
+  data = cache.read('gs://bucket/sample.bam', offset, length)
+  print cache.stats()
+"""
+
+import collections
+import hashlib
+import multiprocessing.pool
+import os
+import threading
+
+from pipelines_pylib import metrics
+
+# Default size of each block read from Cloud Storage
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Default number of blocks read ahead of a sequential reader
+DEFAULT_READ_AHEAD = 4
+
+# Default number of threads reading ahead
+DEFAULT_WORKERS = 4
+
+
+class BlockCache(object):
+  """Reads byte ranges of objects through an LRU cache of blocks on disk."""
+
+  def __init__(self, store, cache_dir, max_bytes, block_size=DEFAULT_BLOCK_SIZE,
+               read_ahead=DEFAULT_READ_AHEAD, workers=DEFAULT_WORKERS):
+    """Creates a block cache.
+
+    Args:
+        store: gcs.GcsStore or gcs.LocalStore from which blocks are read;
+          it must be thread-safe (see clients.ClientPool)
+        cache_dir: local directory for the cached blocks
+        max_bytes: size of the cache; least recently used blocks are
+          evicted beyond this
+        block_size: bytes in each block
+        read_ahead: blocks to read ahead of a sequential reader (0 disables
+          read-ahead)
+        workers: threads reading ahead
+    """
+    self._store = store
+    self._cache_dir = cache_dir
+    self._max_bytes = max_bytes
+    self._block_size = block_size
+    self._read_ahead = read_ahead
+    self._pool = (multiprocessing.pool.ThreadPool(workers)
+                  if read_ahead else None)
+
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+    self._lock = threading.Lock()
+    self._blocks = collections.OrderedDict()  # (path, index) -> size, LRU first
+    self._pins = collections.Counter()
+    self._fetching = {}  # (path, index) -> threading.Event
+    self._sizes = {}
+    self._last_block = {}
+    self._bytes = 0
+    self._stats = collections.Counter()
+
+  def close(self):
+    if self._pool:
+      self._pool.close()
+
+  def set_size(self, path, size):
+    """Records the size of an object (saving a stat() on first read)."""
+
+    with self._lock:
+      self._sizes[path] = size
+
+  def size(self, path):
+    """Returns the size of an object."""
+
+    with self._lock:
+      if path in self._sizes:
+        return self._sizes[path]
+
+    metadata = self._store.stat(path)
+    if metadata is None:
+      raise IOError('Object does not exist: %s' % path)
+    self.set_size(path, metadata['size'])
+    return metadata['size']
+
+  def stats(self):
+    """Returns the cache statistics: bytes read by callers, bytes fetched
+    from the store, block hits and misses, blocks read ahead and evicted,
+    and bytes currently cached."""
+
+    with self._lock:
+      stats = dict(self._stats)
+      stats['bytes_cached'] = self._bytes
+    for name in ('bytes_read', 'bytes_fetched', 'hits', 'misses',
+                 'read_ahead', 'evictions'):
+      stats.setdefault(name, 0)
+    return stats
+
+  def _block_file(self, key):
+    path, index = key
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return os.path.join(self._cache_dir, '%s-%d' % (digest, index))
+
+  def _evict(self):
+    """Evicts least recently used, unpinned blocks while the cache is over
+    its limit. Called with the lock held."""
+
+    for key in list(self._blocks):
+      if self._bytes <= self._max_bytes:
+        break
+      if self._pins[key]:
+        continue
+      self._bytes -= self._blocks.pop(key)
+      os.remove(self._block_file(key))
+      self._stats['evictions'] += 1
+
+  def _pin(self, key, prefetch=False):
+    """Ensures a block is cached and pins it against eviction.
+
+    Returns:
+        True if the block was pinned (the caller must _unpin() it); False
+        only for a prefetch of a block already cached or being fetched.
+    """
+
+    while True:
+      with self._lock:
+        if key in self._blocks:
+          if prefetch:
+            return False
+          self._blocks[key] = self._blocks.pop(key)  # most recently used
+          self._pins[key] += 1
+          self._stats['hits'] += 1
+          return True
+
+        event = self._fetching.get(key)
+        if event is None:
+          event = threading.Event()
+          self._fetching[key] = event
+          self._stats['read_ahead' if prefetch else 'misses'] += 1
+          break
+
+      if prefetch:
+        return False
+      event.wait()
+
+    # This thread fetches the block; others wait on the event
+    try:
+      path, index = key
+      start = index * self._block_size
+      end = min(start + self._block_size, self.size(path))
+      with metrics.timer('blockcache.fetch'):
+        data = self._store.read(path, start, end)
+      with open(self._block_file(key), 'wb') as f:
+        f.write(data)
+
+      with self._lock:
+        self._blocks[key] = len(data)
+        self._bytes += len(data)
+        self._pins[key] += 1
+        self._stats['bytes_fetched'] += len(data)
+        self._evict()
+    finally:
+      with self._lock:
+        del self._fetching[key]
+      event.set()
+    return True
+
+  def _unpin(self, key):
+    with self._lock:
+      self._pins[key] -= 1
+      if not self._pins[key]:
+        del self._pins[key]
+      self._evict()
+
+  def _prefetch(self, key):
+    try:
+      if self._pin(key, prefetch=True):
+        self._unpin(key)
+    except Exception:  # pylint: disable=broad-except
+      # A failed read-ahead is retried when the block is read
+      pass
+
+  def read(self, path, offset, length):
+    """Returns up to length bytes of an object from offset."""
+
+    size = self.size(path)
+    end = min(offset + length, size)
+    if offset >= end:
+      return b''
+
+    first = offset // self._block_size
+    last = (end - 1) // self._block_size
+
+    # Read ahead of a reader starting at the beginning of the object, or
+    # continuing from the previous block read into a new block
+    with self._lock:
+      previous = self._last_block.get(path)
+      self._last_block[path] = last
+    sequential = (first == 0 if previous is None
+                  else first in (previous, previous + 1) and last > previous)
+    if self._pool and sequential:
+      last_block = (size - 1) // self._block_size
+      for index in range(last + 1, min(last + self._read_ahead, last_block) + 1):
+        self._pool.apply_async(self._prefetch, ((path, index),))
+
+    chunks = []
+    for index in range(first, last + 1):
+      key = (path, index)
+      self._pin(key)
+      try:
+        block_start = index * self._block_size
+        with open(self._block_file(key), 'rb') as f:
+          f.seek(max(offset, block_start) - block_start)
+          chunks.append(f.read(min(end, block_start + self._block_size) -
+                               max(offset, block_start)))
+      finally:
+        self._unpin(key)
+
+    data = b''.join(chunks)
+    with self._lock:
+      self._stats['bytes_read'] += len(data)
+    return data
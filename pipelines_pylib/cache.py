@@ -0,0 +1,353 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""A content-addressed cache of pipeline results.
+
+Identical pipelines (same template, Docker image and command) run over
+identical input objects produce identical outputs, even when the outputs are
+written to a different location. The result cache records the outputs of
+each successful run under a key computed from:
+
+  * a hash of the pipeline template (ephemeralPipeline, without the project
+    and resources, which do not affect the result)
+  * the Docker image name and command
+  * the CRC32C and generation of each input object (or the literal value,
+    for inputs which are not Cloud Storage paths)
+
+When a later request has the same key, the prior outputs are copied to the
+new output locations and no VM is started.
+
+Cache entries are stored by a backend; LocalDirectoryBackend keeps one JSON
+file per entry in a local (or shared) directory. Entries are evicted when
+older than a TTL, and least-recently-used entries are evicted beyond a
+maximum number of entries.
+
+The key is computed once, before the pipeline runs, so that the outputs
+are recorded against the inputs the pipeline read even if an input changes
+while it runs. Only the objects written to an output path while the
+operation was copying out its outputs are recorded, not others already
+there (or written there by other operations which finished earlier).
+
+A pipeline which streams its outputs to Cloud Storage itself, rather than
+having them copied out from its disk, is passed their paths as inputs named
+in STREAMED_OUTPUTS. These are outputs of the result: they are not part of
+the key, and the objects written to them while the pipeline ran are
+recorded and restored like those of its output parameters.
+
+Typical usage:
+
+  store = gcs.GcsStore(storage)
+  results = cache.ResultCache(cache.LocalDirectoryBackend('.cache'), store)
+  key = results.key(body)
+  entry = results.lookup(body, key)
+  if not entry or results.restore(entry, body, key) is None:
+    operation = service.pipelines().run(body=body).execute()
+    ...
+    results.put(body, completed_op, key)
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+from pipelines_pylib import gcs
+from pipelines_pylib import metrics
+from pipelines_pylib import util
+
+# Template fields which do not affect pipeline results
+_NON_RESULT_FIELDS = ('projectId', 'description', 'resources')
+
+# Seconds of allowance, either side of an operation's output copying, for
+# the times Cloud Storage records
+_CLOCK_SLACK = 5
+
+# Description of the operation event which starts copying outputs
+_DELOCALIZING_EVENT = 'delocalizing-files'
+
+# Names of the inputs which pass a pipeline the paths it streams its outputs
+# to (see compress/run_compress.py --streaming)
+STREAMED_OUTPUTS = frozenset(['OUTPUT_PATH', 'MANIFEST_PATH'])
+
+
+def _hash(value):
+  encoded = json.dumps(value, sort_keys=True, separators=(',', ':'))
+  return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def _describe_input(store, value):
+  """Returns the identity of a pipeline input value.
+
+  Cloud Storage paths (which may contain wildcards) are resolved to the
+  list of matching objects with their CRC32C and generation.
+  """
+
+  if not value.startswith('gs://'):
+    return value
+
+  if gcs.has_wildcard(value):
+    objects = store.list(value)
+  else:
+    metadata = store.stat(value)
+    if metadata is None:
+      raise ValueError('Input object does not exist: %s' % value)
+    objects = [metadata]
+
+  return [(o['path'], o['crc32c'], o['generation']) for o in objects]
+
+
+def result_inputs(body):
+  """Returns the inputs of a request which the pipeline reads (all but the
+  paths of its streamed outputs)."""
+
+  inputs = body.get('pipelineArgs', {}).get('inputs', {})
+  return {name: value for name, value in inputs.items()
+          if name not in STREAMED_OUTPUTS}
+
+
+def result_outputs(body):
+  """Returns the output paths of a request, streamed outputs included."""
+
+  outputs = dict(body.get('pipelineArgs', {}).get('outputs', {}))
+  inputs = body.get('pipelineArgs', {}).get('inputs', {})
+  outputs.update((name, value) for name, value in inputs.items()
+                 if name in STREAMED_OUTPUTS)
+  return outputs
+
+
+def cache_key(body, store):
+  """Returns the cache key for a pipelines().run() request body.
+
+  Args:
+      body: the pipelines().run() request body.
+      store: gcs.GcsStore or gcs.LocalStore used to look up input objects.
+  """
+
+  pipeline = body['ephemeralPipeline']
+  template = {k: v for k, v in pipeline.items() if k not in _NON_RESULT_FIELDS}
+  inputs = result_inputs(body)
+
+  return _hash({
+    'template': _hash(template),
+    'image': pipeline['docker']['imageName'],
+    'cmd': pipeline['docker']['cmd'],
+    'inputs': {name: _describe_input(store, value)
+               for name, value in inputs.items()},
+  })
+
+
+class LocalDirectoryBackend(object):
+  """Stores cache entries as JSON files in a local directory."""
+
+  def __init__(self, path):
+    self._path = path
+    if not os.path.isdir(path):
+      os.makedirs(path)
+
+  def _entry_path(self, key):
+    return os.path.join(self._path, '%s.json' % key)
+
+  def get(self, key):
+    """Returns the entry for a key, or None."""
+
+    try:
+      with open(self._entry_path(key)) as f:
+        return json.load(f)
+    except IOError:
+      return None
+
+  def put(self, key, entry):
+    """Writes an entry (atomically replacing any existing entry)."""
+
+    tmp_path = self._entry_path(key) + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(entry, f, sort_keys=True)
+    os.rename(tmp_path, self._entry_path(key))
+
+  def delete(self, key):
+    try:
+      os.remove(self._entry_path(key))
+    except OSError:
+      pass
+
+  def keys(self):
+    return [name[:-len('.json')] for name in os.listdir(self._path)
+            if name.endswith('.json')]
+
+
+class ResultCache(object):
+  """Looks up, records and restores the outputs of pipeline runs."""
+
+  def __init__(self, backend, store, ttl=None, max_entries=None):
+    """Creates a result cache.
+
+    Args:
+        backend: entry storage, such as LocalDirectoryBackend.
+        store: gcs.GcsStore or gcs.LocalStore holding inputs and outputs.
+        ttl: optional maximum age (in seconds) of an entry.
+        max_entries: optional maximum number of entries to keep.
+    """
+    self._backend = backend
+    self._store = store
+    self._ttl = ttl
+    self._max_entries = max_entries
+
+    self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'objects_copied': 0}
+
+  def _expired(self, entry, now):
+    return self._ttl is not None and now - entry['created'] > self._ttl
+
+  def key(self, body):
+    """Returns the cache key for a request body (see cache_key())."""
+
+    with metrics.timer('cache.key'):
+      return cache_key(body, self._store)
+
+  def lookup(self, body, key=None):
+    """Returns the cache entry for a request body, or None on a miss.
+
+    Args:
+        body: the pipelines().run() request body.
+        key: the body's key, if already computed with key().
+    """
+
+    if key is None:
+      key = self.key(body)
+    entry = self._backend.get(key)
+    now = time.time()
+
+    if entry and self._expired(entry, now):
+      self._backend.delete(key)
+      self.stats['evictions'] += 1
+      entry = None
+
+    if not entry:
+      self.stats['misses'] += 1
+      return None
+
+    self.stats['hits'] += 1
+    entry['last_used'] = now
+    self._backend.put(key, entry)
+    return entry
+
+  def _list_outputs(self, path, start, end):
+    """Returns the objects at an output path (an object or a folder) last
+    written between start and end (seconds since the epoch)."""
+
+    metadata = self._store.stat(path)
+    objects = ([metadata] if metadata else
+               self._store.list(path.rstrip('/') + '/'))
+    return [o['path'] for o in objects
+            if start - _CLOCK_SLACK <= o['updated'] <= end + _CLOCK_SLACK]
+
+  def put(self, body, operation, key=None):
+    """Records the outputs of a successfully completed operation.
+
+    Args:
+        body: the pipelines().run() request body which was run.
+        operation: the completed operation object.
+        key: the key computed for the body (with key()) before it was run;
+          if not given it is computed now, from the inputs' current state.
+    """
+
+    if not operation.get('done') or 'error' in operation:
+      return
+
+    # Streamed outputs are written while the operation runs; the others
+    # while it copies them out, before it ends
+    metadata = operation.get('metadata', {})
+    run_start = metadata.get('startTime') or metadata.get('createTime')
+    events = [event['startTime'] for event in metadata.get('events', [])
+              if event.get('description') == _DELOCALIZING_EVENT]
+    copy_start = events[-1] if events else run_start
+    if not run_start or not metadata.get('endTime'):
+      return
+    run_start = util.parse_timestamp(run_start)
+    copy_start = util.parse_timestamp(copy_start)
+    end = util.parse_timestamp(metadata['endTime'])
+
+    if key is None:
+      key = self.key(body)
+    now = time.time()
+
+    recorded = {}
+    for name, path in result_outputs(body).items():
+      start = run_start if name in STREAMED_OUTPUTS else copy_start
+      recorded[name] = {'path': path,
+                        'objects': self._list_outputs(path, start, end)}
+
+    self._backend.put(key, {
+      'operation': operation['name'],
+      'created': now,
+      'last_used': now,
+      'outputs': recorded,
+    })
+    self.evict()
+
+  def restore(self, entry, body, key=None):
+    """Copies the outputs recorded in an entry to a request's output paths.
+
+    If a recorded output no longer exists, the entry is evicted and the
+    pipeline has to be run again.
+
+    Args:
+        entry: the entry returned by lookup().
+        body: the pipelines().run() request body.
+        key: the body's key, if already computed with key().
+
+    Returns:
+        A dict of output name -> list of object paths written, or None if the
+        entry was evicted.
+    """
+
+    outputs = result_outputs(body)
+    restored = {}
+
+    for name, destination in outputs.items():
+      source_root = entry['outputs'][name]['path'].rstrip('/')
+      destination_root = destination.rstrip('/')
+
+      restored[name] = []
+      for source in entry['outputs'][name]['objects']:
+        target = destination_root + source[len(source_root):]
+        with metrics.timer('cache.copy'):
+          copied = self._store.copy(source, target)
+        if not copied:
+          print >> sys.stderr, ("WARNING: output %s of cached operation %s "
+                                "no longer exists" % (source,
+                                                      entry['operation']))
+          self._backend.delete(key if key is not None else self.key(body))
+          self.stats['evictions'] += 1
+          return None
+        restored[name].append(target)
+        self.stats['objects_copied'] += 1
+
+    return restored
+
+  def evict(self):
+    """Removes expired entries and any least-recently-used entries beyond
+    the maximum number of entries."""
+
+    now = time.time()
+    entries = []
+    for key in self._backend.keys():
+      entry = self._backend.get(key)
+      if entry is None:
+        continue
+      if self._expired(entry, now):
+        self._backend.delete(key)
+        self.stats['evictions'] += 1
+      else:
+        entries.append((entry['last_used'], key))
+
+    if self._max_entries is not None and len(entries) > self._max_entries:
+      entries.sort()
+      for _, key in entries[:len(entries) - self._max_entries]:
+        self._backend.delete(key)
+        self.stats['evictions'] += 1
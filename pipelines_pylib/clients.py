@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Thread-safe API service clients.
+
+A service built with apiclient.discovery.build() sends every request over a
+single httplib2.Http, which is not thread-safe: submitting or polling from
+several threads at once corrupts or serializes the requests.
+
+A ClientPool gives each thread its own authorized Http (which keeps its
+connections alive between requests), and returns services which can be
+shared freely between threads: each request is built and sent with the
+calling thread's Http. All threads share one set of credentials; when the
+access token expires, one thread refreshes it and the others pick up the
+new token instead of each requesting their own.
+
+Shortly before the access token expires (tokens.REFRESH_MARGIN), the next
+request refreshes it, rather than waiting for a request to be rejected. With
+a token_cache (or the PIPELINES_TOKEN_CACHE environment variable), the
+access token is also shared with other processes using the same
+credentials, through a locked file (see tokens.py).
+
+Each discovery document is fetched once per pool, not once per thread.
+Requests are retried (with exponential backoff) on server errors and rate
+limiting, and each connection has a timeout.
+
+Typical usage:
+
+  client_pool = clients.ClientPool()
+  service = client_pool.service('genomics', 'v1alpha2')
+  storage = client_pool.service('storage', 'v1')
+
+  # service and storage may now be used from any number of threads
+  operation = service.pipelines().run(body=body).execute()
+
+The HTTP transport is pluggable: http_factory is called (once per thread) to
+create the unauthorized Http, for example to use a proxy or an
+apiclient.http.HttpMock in tests.
+"""
+
+import copy
+import datetime
+import os
+import threading
+
+import httplib2
+from oauth2client import client
+
+from apiclient import discovery
+from apiclient import errors
+from apiclient import http as apiclient_http
+
+from pipelines_pylib import metrics
+from pipelines_pylib import tokens
+
+# Seconds to wait on a connection before failing the request
+DEFAULT_TIMEOUT = 60
+
+# Times to retry a request which failed with a server error or rate limiting
+DEFAULT_NUM_RETRIES = 5
+
+
+class _SharedCredentialsStore(client.Storage):
+  """Holds the latest credentials in memory.
+
+  Each thread authorizes its Http with its own copy of the credentials,
+  attached to this store. oauth2client refreshes through the store under its
+  lock, and adopts the store's credentials instead if another thread has
+  already refreshed them.
+  """
+
+  def __init__(self, credentials):
+    super(_SharedCredentialsStore, self).__init__(lock=threading.Lock())
+    self._credentials = copy.copy(credentials)
+
+  def locked_get(self):
+    return self._credentials
+
+  def locked_put(self, credentials):
+    self._credentials = copy.copy(credentials)
+
+  def locked_delete(self):
+    self._credentials = None
+
+
+def _request_class(num_retries, before_execute):
+  """Returns an HttpRequest class whose execute() retries by default, and
+  first calls before_execute()."""
+
+  class RetryingHttpRequest(apiclient_http.HttpRequest):
+
+    def execute(self, http=None, num_retries=num_retries):
+      before_execute()
+
+      # Per-method latency, for example "api.genomics.operations.get"
+      with metrics.timer('api.' + self.methodId):
+        return apiclient_http.HttpRequest.execute(self, http=http,
+                                                  num_retries=num_retries)
+
+  return RetryingHttpRequest
+
+
+class _ThreadLocalService(object):
+  """A service whose requests are built and sent with the calling thread's
+  own Http."""
+
+  def __init__(self, pool, name, version):
+    self._pool = pool
+    self._name = name
+    self._version = version
+
+  def __getattr__(self, attr):
+    return getattr(self._pool.build(self._name, self._version), attr)
+
+
+class ClientPool(object):
+  """Creates per-thread authorized HTTP connections and API services."""
+
+  def __init__(self, credentials=None, timeout=DEFAULT_TIMEOUT,
+               num_retries=DEFAULT_NUM_RETRIES, http_factory=None,
+               token_cache=None):
+    """Creates a client pool.
+
+    Args:
+        credentials: oauth2client credentials (default: the application
+          default credentials).
+        timeout: seconds to wait on a connection.
+        num_retries: times to retry a request on a server error or rate
+          limiting.
+        http_factory: optional callable returning a new (unauthorized)
+          httplib2.Http-like object (default: httplib2.Http with the timeout).
+        token_cache: optional path of a file in which to share access tokens
+          with other processes (default: $PIPELINES_TOKEN_CACHE, if set).
+    """
+    if credentials is None:
+      with metrics.timer('api.credentials'):
+        credentials = client.GoogleCredentials.get_application_default()
+
+    token_cache = token_cache or os.environ.get(tokens.TOKEN_CACHE_ENV)
+    self._credentials = credentials
+    self._store = (tokens.FileTokenStore(token_cache, credentials)
+                   if token_cache else _SharedCredentialsStore(credentials))
+    self._http_factory = http_factory or (
+        lambda: httplib2.Http(timeout=timeout))
+    self._request_class = _request_class(num_retries,
+                                         self._refresh_if_expiring)
+
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._documents = {}
+
+  def http(self):
+    """Returns the calling thread's authorized Http."""
+
+    if not hasattr(self._local, 'http'):
+      # A token cache has no credentials until a token is first cached
+      credentials = copy.copy(self._store.get() or self._credentials)
+      credentials.set_store(self._store)
+      self._local.credentials = credentials
+      self._local.http = credentials.authorize(self._http_factory())
+    return self._local.http
+
+  def _refresh_if_expiring(self):
+    """Refreshes the calling thread's access token if it expires within
+    tokens.REFRESH_MARGIN (adopting a token already refreshed by another
+    thread or process, if there is one)."""
+
+    credentials = getattr(self._local, 'credentials', None)
+    if credentials is None or not getattr(credentials, 'token_expiry', None):
+      return
+
+    remaining = credentials.token_expiry - datetime.datetime.utcnow()
+    if remaining.total_seconds() < tokens.REFRESH_MARGIN:
+      with metrics.timer('api.refresh'):
+        credentials.refresh(self._http_factory())
+
+  def _document(self, name, version):
+    """Returns the discovery document for an API, fetching it only once."""
+
+    with self._lock:
+      if (name, version) not in self._documents:
+        uri = discovery.DISCOVERY_URI.format(api=name, apiVersion=version)
+        with metrics.timer('api.discovery'):
+          response, content = self.http().request(uri)
+        if response.status >= 400:
+          raise errors.HttpError(response, content, uri=uri)
+        self._documents[(name, version)] = content
+      return self._documents[(name, version)]
+
+  def build(self, name, version):
+    """Returns the calling thread's service object for an API.
+
+    The returned object must only be used from the calling thread; use
+    service() for an object which can be shared between threads.
+    """
+
+    if not hasattr(self._local, 'services'):
+      self._local.services = {}
+
+    services = self._local.services
+    if (name, version) not in services:
+      document = self._document(name, version)
+      with metrics.timer('api.build'):
+        services[(name, version)] = discovery.build_from_document(
+            document, http=self.http(), requestBuilder=self._request_class)
+    return services[(name, version)]
+
+  def service(self, name, version):
+    """Returns a service for an API which may be used from any thread."""
+
+    return _ThreadLocalService(self, name, version)
@@ -47,3 +47,20 @@ def get_zones(input_list):
       output_list.append(zone)
 
   return output_list
+
+def get_region(zone):
+  """Returns the region for a Compute Engine zone ("us-central1-a" -> "us-central1")."""
+
+  return zone.rsplit('-', 1)[0]
+
+def get_regions(zone_list):
+  """Returns the distinct regions for a list of zones, in order of first appearance."""
+
+  output_list = []
+
+  for zone in zone_list:
+    region = get_region(zone)
+    if region not in output_list:
+      output_list.append(region)
+
+  return output_list
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Failing over to other zones when a zone runs out of resources.
+
+When a zone has no capacity for a VM, the operations sent to it fail with a
+resource exhaustion error, and a batch is left with holes in it. Such
+failures are not caused by the pipeline and succeed when retried elsewhere.
+
+classify() recognizes them from the completed operation. A ZoneHealth cache
+then records the zone as unhealthy for a short time (by default, 10
+minutes), and retry() resubmits the request restricted to the healthy zones
+in the same region as the failed one, so that the inputs stay in the same
+region. retry() only submits: the caller waits on the future it returns
+along with the rest of its batch, and calls retry() again when it completes.
+Requests submitted while a zone is unhealthy can also be kept out of it with
+ZoneHealth.restrict().
+
+Failures for lack of quota are not retried: quota is per region, so another
+zone of the region has none either (see scheduler.QuotaScheduler).
+
+The cache may be kept in a local file, so that launchers started one after
+another (or at once) share what each has learned. The file is read and
+updated under an exclusive (fcntl) lock on a lock file next to it, as
+tokens.FileTokenStore does, so concurrent updates are not lost:
+
+  health = failover.ZoneHealth(path='zone-health.json')
+  client = jobs.PipelineClient(service, poll_interval=30)
+  future = client.run(health.restrict(request))
+  attempts = 1
+  while True:
+    completed_op = future.result()
+    retried = failover.retry(client, future.body, completed_op, health,
+                             attempts)
+    if not retried:
+      break
+    future = retried
+    attempts += 1
+"""
+
+import contextlib
+import copy
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+
+from pipelines_pylib import defaults
+from pipelines_pylib import metrics
+from pipelines_pylib import scheduler
+from pipelines_pylib import util
+
+# Failure classes
+ZONE_EXHAUSTED = 'ZONE_EXHAUSTED'
+QUOTA_EXCEEDED = 'QUOTA_EXCEEDED'
+OTHER = 'OTHER'
+
+# Default seconds that a zone is avoided after it ran out of resources
+DEFAULT_TTL = 600
+
+# Default number of times a request is submitted (including the first)
+DEFAULT_MAX_ATTEMPTS = 3
+
+# google.rpc.Code.RESOURCE_EXHAUSTED
+_RESOURCE_EXHAUSTED = 8
+
+_EXHAUSTED_MESSAGE = re.compile(
+    r'ZONE_RESOURCE_POOL_EXHAUSTED|does not have enough resources|'
+    r'resource pool exhausted|resources? (?:are|is) (?:currently )?'
+    r'unavailable', re.IGNORECASE)
+_QUOTA_MESSAGE = re.compile(r'quota', re.IGNORECASE)
+_ZONE_NAME = re.compile(r'\b([a-z]+-[a-z]+\d+-[a-z])\b')
+
+
+def classify(operation):
+  """Returns the failure class of a completed operation (None if it did not
+  fail)."""
+
+  error = operation.get('error')
+  if not error:
+    return None
+
+  message = error.get('message', '')
+  if _QUOTA_MESSAGE.search(message):
+    return QUOTA_EXCEEDED
+  if (_EXHAUSTED_MESSAGE.search(message) or
+      error.get('code') == _RESOURCE_EXHAUSTED):
+    return ZONE_EXHAUSTED
+  return OTHER
+
+
+def failed_zone(operation):
+  """Returns the zone that an operation failed in, or None if not known."""
+
+  match = _ZONE_NAME.search(operation.get('error', {}).get('message', ''))
+  if match:
+    return match.group(1)
+  return util.operation_zone(operation)
+
+
+class ZoneHealth(object):
+  """Zones recently out of resources, each avoided until a TTL expires."""
+
+  def __init__(self, ttl=DEFAULT_TTL, path=None):
+    """Args:
+        ttl: seconds that a zone is avoided after it ran out of resources
+        path: optional local JSON file in which the cache is shared
+    """
+    self._ttl = ttl
+    self._path = path
+    self._unhealthy = {}  # zone -> seconds since the epoch it is avoided until
+    self._thread_lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def _locked(self):
+    """Holds the cache, and its file if any, for a read or update."""
+
+    with self._thread_lock:
+      if not self._path:
+        yield
+        return
+
+      folder = os.path.dirname(self._path)
+      if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+      lock_file = os.fdopen(
+          os.open(self._path + '.lock', os.O_RDWR | os.O_CREAT, 0o600), 'r+')
+      try:
+        with metrics.timer('failover.lock'):
+          fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+  def _load(self):
+    if self._path and os.path.exists(self._path):
+      try:
+        with open(self._path) as f:
+          self._unhealthy.update(json.load(f))
+      except ValueError:
+        pass
+    now = time.time()
+    self._unhealthy = dict((zone, until) for zone, until
+                           in self._unhealthy.items() if until > now)
+
+  def _save(self):
+    if self._path:
+      temp_path = '%s.%d' % (self._path, os.getpid())
+      with open(temp_path, 'w') as f:
+        json.dump(self._unhealthy, f, sort_keys=True)
+      os.rename(temp_path, self._path)
+
+  def mark_unhealthy(self, zone):
+    """Avoids a zone for the TTL."""
+
+    with self._locked():
+      self._load()
+      self._unhealthy[zone] = max(self._unhealthy.get(zone, 0),
+                                  time.time() + self._ttl)
+      self._save()
+
+  def unhealthy_zones(self):
+    """Returns the zones currently avoided."""
+
+    with self._locked():
+      self._load()
+      return sorted(self._unhealthy)
+
+  def healthy(self, zones):
+    """Returns the zones not currently avoided, in order."""
+
+    unhealthy = set(self.unhealthy_zones())
+    return [zone for zone in zones if zone not in unhealthy]
+
+  def restrict(self, body):
+    """Returns a request body without the zones currently avoided, or the
+    body unchanged if it lists no zones or only avoided ones."""
+
+    zones = scheduler.get_zones(body)
+    healthy = self.healthy(zones)
+    if not healthy or len(healthy) == len(zones):
+      return body
+
+    restricted = copy.deepcopy(body)
+    restricted['pipelineArgs'].setdefault('resources', {})['zones'] = healthy
+    return restricted
+
+
+def failover_request(body, zone, health):
+  """Returns a copy of a request body restricted to the healthy zones in
+  the same region as zone, other than zone; or None if there are none.
+
+  If the request lists no zones, all known zones of the region are
+  candidates.
+  """
+
+  region = defaults.get_region(zone)
+  zones = (scheduler.get_zones(body) or
+           defaults.get_zones(['%s-*' % region]))
+  candidates = health.healthy(
+      [z for z in zones if defaults.get_region(z) == region and z != zone])
+  if not candidates:
+    return None
+
+  restricted = copy.deepcopy(body)
+  restricted['pipelineArgs'].setdefault('resources', {})['zones'] = candidates
+  return restricted
+
+
+def retry(client, body, completed_op, health, attempts=1,
+          max_attempts=DEFAULT_MAX_ATTEMPTS):
+  """Resubmits a request whose operation failed for lack of resources in its
+  zone to the other healthy zones of its region. The resubmission is not
+  waited for.
+
+  Args:
+      client: jobs.PipelineClient through which the request is resubmitted
+        (and journaled, if it has a journal)
+      body: the pipelines().run() request body of the completed operation
+      completed_op: the completed operation object
+      health: ZoneHealth, in which exhausted zones are recorded
+      attempts: times the request has been submitted so far
+      max_attempts: times the request may be submitted, including the
+        first
+
+  Returns:
+      the jobs.OperationFuture of the resubmission, or None if the operation
+      did not fail for lack of resources or cannot be retried
+  """
+
+  if (attempts >= max_attempts or
+      classify(completed_op) != ZONE_EXHAUSTED):
+    return None
+  zone = failed_zone(completed_op)
+  if zone is None:
+    return None
+  health.mark_unhealthy(zone)
+
+  retry_body = failover_request(body, zone, health)
+  if retry_body is None:
+    print "Zone %s is out of resources, and no other zone is healthy" % zone
+    return None
+
+  print "Zone %s is out of resources; resubmitting %s in %s" % (
+      zone, completed_op['name'], ', '.join(scheduler.get_zones(retry_body)))
+  metrics.count('failover.resubmitted')
+  return client.run(retry_body)
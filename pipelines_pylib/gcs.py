@@ -0,0 +1,396 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Helpers for Cloud Storage objects referenced by pipelines.
+
+Two interchangeable object stores are provided:
+
+  GcsStore:   Cloud Storage, via the storage JSON API service
+  LocalStore: a local directory standing in for Cloud Storage, where
+              gs://bucket/path/to/object is stored at <root>/bucket/path/to/object
+
+Both return object metadata as a dict with the keys:
+
+  path:       gs://bucket/object
+  size:       size in bytes
+  crc32c:     base64-encoded big-endian CRC32C (as reported by Cloud Storage)
+  generation: object generation (for LocalStore, the modification time in usec)
+  updated:    time the object was last written, in seconds since the epoch
+
+Reader reads files given either a local path or a Cloud Storage path, as
+the scripts which summarize pipeline outputs accept both.
+
+Paths passed to list() may contain Cloud Storage wildcards: "*" matches
+within a single path component, "**" matches across components.
+"""
+
+import base64
+import os
+import re
+import shutil
+import struct
+
+from pipelines_pylib import util
+
+try:
+  # crcmod (a gsutil dependency) provides a C implementation of CRC32C
+  import crcmod.predefined
+  _crc32c_fun = crcmod.predefined.mkCrcFun('crc-32c')
+  _crc32c_in_c = getattr(crcmod.crcmod, '_usingExtension', False)
+except ImportError:
+  _crc32c_fun = None
+  _crc32c_in_c = False
+
+# Whether CRC32C is computed in C rather than (far more slowly) in Python
+HAS_CRCMOD = _crc32c_in_c
+
+_CRC32C_TABLE = []
+for _n in range(256):
+  _c = _n
+  for _k in range(8):
+    _c = (_c >> 1) ^ 0x82F63B78 if _c & 1 else _c >> 1
+  _CRC32C_TABLE.append(_c)
+
+# Size of reads when checksumming local files
+_CHUNK_SIZE = 1024 * 1024
+
+
+def crc32c(data, crc=0):
+  """Returns the CRC32C of data, continuing from a previous crc value."""
+
+  if _crc32c_fun:
+    return _crc32c_fun(data, crc)
+
+  crc ^= 0xFFFFFFFF
+  for byte in bytearray(data):
+    crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+  return crc ^ 0xFFFFFFFF
+
+
+def encode_crc32c(crc):
+  """Returns a CRC32C value encoded as Cloud Storage reports it."""
+
+  return base64.b64encode(struct.pack('>I', crc)).decode('ascii')
+
+
+def split_path(path):
+  """Splits gs://bucket/object into ("bucket", "object")."""
+
+  if not path.startswith('gs://'):
+    raise ValueError('Not a Cloud Storage path: %s' % path)
+
+  parts = path[len('gs://'):].split('/', 1)
+  return parts[0], parts[1] if len(parts) > 1 else ''
+
+
+def has_wildcard(path):
+  return any(c in path for c in '*?[')
+
+
+def _wildcard_prefix(path):
+  """Returns the portion of a path before its first wildcard character."""
+
+  return re.split(r'[*?\[]', path, 1)[0]
+
+
+def _wildcard_regex(path):
+  """Returns a compiled regex for a Cloud Storage wildcard path."""
+
+  regex = ''
+  i = 0
+  while i < len(path):
+    if path.startswith('**', i):
+      regex += '.*'
+      i += 2
+    elif path[i] == '*':
+      regex += '[^/]*'
+      i += 1
+    elif path[i] == '?':
+      regex += '[^/]'
+      i += 1
+    elif path[i] == '[' and ']' in path[i + 1:]:
+      end = path.index(']', i + 1)
+      regex += path[i:end + 1]
+      i = end + 1
+    else:
+      regex += re.escape(path[i])
+      i += 1
+  return re.compile('^' + regex + '$')
+
+
+class GcsStore(object):
+  """Cloud Storage objects, accessed via the storage JSON API."""
+
+  def __init__(self, storage):
+    """Args:
+        storage: storage (v1) service endpoint
+    """
+    self._storage = storage
+
+  @staticmethod
+  def _metadata(item):
+    return {
+      'path': 'gs://%s/%s' % (item['bucket'], item['name']),
+      'size': int(item['size']),
+      'crc32c': item.get('crc32c'),
+      'generation': int(item['generation']),
+      'updated': util.parse_timestamp(item['updated']),
+    }
+
+  def stat(self, path):
+    """Returns the metadata for an object, or None if it does not exist."""
+
+    from apiclient import errors
+
+    bucket, name = split_path(path)
+    try:
+      item = self._storage.objects().get(bucket=bucket, object=name).execute()
+    except errors.HttpError as e:
+      if e.resp.status == 404:
+        return None
+      raise
+    return self._metadata(item)
+
+  def list(self, path):
+    """Yields the metadata for objects matching a path (which may contain
+    wildcards) or under a prefix ending in "/".
+
+    Results are fetched a page at a time, so arbitrarily large listings can
+    be consumed with constant memory.
+    """
+
+    bucket, name = split_path(path)
+    prefix = _wildcard_prefix(name)
+    pattern = _wildcard_regex(path) if has_wildcard(name) else None
+
+    request = self._storage.objects().list(
+        bucket=bucket, prefix=prefix,
+        fields='nextPageToken,'
+               'items(bucket,name,size,crc32c,generation,updated)')
+    while request is not None:
+      response = request.execute()
+      for item in response.get('items', []):
+        metadata = self._metadata(item)
+        if pattern is None or pattern.match(metadata['path']):
+          yield metadata
+      request = self._storage.objects().list_next(request, response)
+
+  def bucket_location(self, path):
+    """Returns the location of the bucket of a path (such as "US" or
+    "US-CENTRAL1"), or None if it cannot be read."""
+
+    from apiclient import errors
+
+    bucket, _ = split_path(path)
+    try:
+      item = self._storage.buckets().get(bucket=bucket,
+                                         fields='location').execute()
+    except errors.HttpError as e:
+      if e.resp.status in (403, 404):
+        return None
+      raise
+    return item.get('location')
+
+  def copy(self, source, destination):
+    """Copies an object, in as many rewrite() calls as the service needs.
+
+    Returns:
+        False if the source object does not exist, else True.
+    """
+
+    from apiclient import errors
+
+    src_bucket, src_name = split_path(source)
+    dst_bucket, dst_name = split_path(destination)
+
+    token = None
+    while True:
+      try:
+        response = self._storage.objects().rewrite(
+            sourceBucket=src_bucket, sourceObject=src_name,
+            destinationBucket=dst_bucket, destinationObject=dst_name,
+            rewriteToken=token, body={}).execute()
+      except errors.HttpError as e:
+        if e.resp.status == 404:
+          return False
+        raise
+      if response['done']:
+        return True
+      token = response['rewriteToken']
+
+  def read(self, path, start=None, end=None):
+    """Returns the contents of an object, or of the byte range [start, end)."""
+
+    bucket, name = split_path(path)
+    request = self._storage.objects().get_media(bucket=bucket, object=name)
+    if start is not None or end is not None:
+      request.headers['Range'] = 'bytes=%d-%s' % (
+          start or 0, '' if end is None else end - 1)
+    return request.execute()
+
+  def read_if_changed(self, path, generation=None):
+    """Returns the contents of an object unless it is still at a generation.
+
+    The object's metadata is fetched conditionally on its generation, so an
+    unchanged object costs one small request and no download.
+
+    Returns:
+        None if the object is at the given generation, else a tuple of the
+        contents and generation ((None, None) if the object does not exist).
+    """
+
+    from apiclient import errors
+
+    bucket, name = split_path(path)
+    try:
+      item = self._storage.objects().get(
+          bucket=bucket, object=name, ifGenerationNotMatch=generation,
+          fields='generation').execute()
+    except errors.HttpError as e:
+      if e.resp.status == 304:
+        return None
+      if e.resp.status == 404:
+        return None, None
+      raise
+
+    current = int(item['generation'])
+    data = self._storage.objects().get_media(
+        bucket=bucket, object=name, generation=current).execute()
+    return data, current
+
+
+class LocalStore(object):
+  """A local directory standing in for Cloud Storage."""
+
+  def __init__(self, root):
+    """Args:
+        root: local directory holding one subdirectory per bucket
+    """
+    self._root = root
+
+  def local_path(self, path):
+    """Returns the local file path for gs://bucket/object."""
+
+    bucket, name = split_path(path)
+    return os.path.join(self._root, bucket, *name.split('/'))
+
+  def stat(self, path):
+    """Returns the metadata for an object, or None if it does not exist."""
+
+    local = self.local_path(path)
+    if not os.path.isfile(local):
+      return None
+
+    crc = 0
+    with open(local, 'rb') as f:
+      for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+        crc = crc32c(chunk, crc)
+
+    return {
+      'path': path,
+      'size': os.path.getsize(local),
+      'crc32c': encode_crc32c(crc),
+      'generation': int(os.path.getmtime(local) * 1000000),
+      'updated': os.path.getmtime(local),
+    }
+
+  def list(self, path):
+    """Yields the metadata for objects matching a path (which may contain
+    wildcards) or under a prefix ending in "/"."""
+
+    bucket, name = split_path(path)
+    prefix = _wildcard_prefix(name)
+    pattern = _wildcard_regex(path) if has_wildcard(name) else None
+
+    bucket_root = os.path.join(self._root, bucket)
+    for dirpath, dirnames, filenames in os.walk(bucket_root):
+      dirnames.sort()
+      for filename in sorted(filenames):
+        relative = os.path.relpath(os.path.join(dirpath, filename), bucket_root)
+        object_path = 'gs://%s/%s' % (bucket, relative.replace(os.sep, '/'))
+        if not object_path.startswith('gs://%s/%s' % (bucket, prefix)):
+          continue
+        if pattern is None or pattern.match(object_path):
+          yield self.stat(object_path)
+
+  def bucket_location(self, path):
+    """Returns None; local buckets have no location."""
+
+    return None
+
+  def copy(self, source, destination):
+    """Copies an object; returns False if it does not exist, else True."""
+
+    if not os.path.isfile(self.local_path(source)):
+      return False
+    local = self.local_path(destination)
+    if not os.path.isdir(os.path.dirname(local)):
+      os.makedirs(os.path.dirname(local))
+    shutil.copyfile(self.local_path(source), local)
+    return True
+
+  def read(self, path, start=None, end=None):
+    """Returns the contents of an object, or of the byte range [start, end)."""
+
+    with open(self.local_path(path), 'rb') as f:
+      f.seek(start or 0)
+      if end is None:
+        return f.read()
+      return f.read(end - (start or 0))
+
+  def read_if_changed(self, path, generation=None):
+    """Returns the contents of an object unless it is still at a generation.
+
+    Returns:
+        None if the object is at the given generation, else a tuple of the
+        contents and generation ((None, None) if the object does not exist).
+    """
+
+    local = self.local_path(path)
+    if not os.path.isfile(local):
+      return None, None
+
+    current = int(os.path.getmtime(local) * 1000000)
+    if current == generation:
+      return None
+    return self.read(path), current
+
+
+class Reader(object):
+  """Reads files by local path or Cloud Storage path."""
+
+  def __init__(self):
+    self._store = None
+
+  def _gcs(self):
+    if not self._store:
+      from pipelines_pylib import clients
+
+      # Files are read from many threads, each needing its own connection
+      storage = clients.ClientPool().service('storage', 'v1')
+      self._store = GcsStore(storage)
+    return self._store
+
+  def expand(self, paths):
+    """Returns the list of files for a list of paths (with wildcards)."""
+
+    expanded = []
+    for path in paths:
+      if path.startswith('gs://'):
+        expanded.extend(o['path'] for o in self._gcs().list(path))
+      else:
+        expanded.append(path)
+    return expanded
+
+  def read(self, path):
+    """Returns the contents of a file."""
+
+    if path.startswith('gs://'):
+      return self._gcs().read(path)
+    with open(path, 'rb') as f:
+      return f.read()
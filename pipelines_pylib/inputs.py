@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Expansion of large input lists into a series of pipeline requests.
+
+The launchers pass each input to the Pipelines API as its own inputFile<n>
+parameter. For a cohort of many thousands of objects, the input list does not
+fit on a command line, and a single request would exceed the API's request
+size limits.
+
+Inputs can instead be read from a manifest (a local file or Cloud Storage
+object with one path, or wildcard pattern, per line) and Cloud Storage
+wildcards can be expanded by listing the matching objects. Both are done
+lazily: manifests are read a block at a time and listings a page at a time,
+so memory use does not depend on the number of inputs.
+
+chunks() then groups the input paths into lists small enough for one
+request, and with_inputs() produces a request body for each list from a
+body built for the first:
+
+  paths = inputs.iter_inputs(store, args.input, args.input_manifest,
+                             expand=args.expand_inputs)
+  input_chunks = inputs.chunks(paths, args.inputs_per_request)
+
+  first = next(input_chunks)
+  body = <request body with inputFile0 .. inputFile<n> for first>
+  for chunk in input_chunks:
+    request = inputs.with_inputs(body, chunk)
+"""
+
+import copy
+import json
+import re
+
+from pipelines_pylib import gcs
+
+# Default maximum number of inputs in one request
+MAX_INPUTS_PER_REQUEST = 1000
+
+# Maximum bytes of (JSON-encoded) input parameters and values in one request,
+# well within the API's request size limit
+MAX_INPUT_BYTES = 512 * 1024
+
+# Size of each read from a manifest in Cloud Storage
+MANIFEST_BLOCK_SIZE = 1024 * 1024
+
+_INPUT_FILE_NAME = re.compile(r'^inputFile(\d+)$')
+
+
+def read_manifest(path, store=None):
+  """Yields the input paths listed in a manifest.
+
+  A manifest has one path per line. Blank lines and lines starting with "#"
+  are skipped.
+
+  Args:
+      path: local path or Cloud Storage path of the manifest.
+      store: gcs.GcsStore or gcs.LocalStore (for a Cloud Storage manifest).
+  """
+
+  if path.startswith('gs://'):
+    lines = _read_object_lines(store, path)
+  else:
+    lines = _read_file_lines(path)
+
+  for line in lines:
+    line = line.strip()
+    if line and not line.startswith('#'):
+      yield line
+
+
+def _read_file_lines(path):
+  with open(path) as f:
+    for line in f:
+      yield line
+
+
+def _read_object_lines(store, path):
+  """Yields the lines of an object, reading it a block at a time."""
+
+  metadata = store.stat(path)
+  if metadata is None:
+    raise ValueError('Manifest does not exist: %s' % path)
+
+  partial = b''
+  for start in range(0, metadata['size'], MANIFEST_BLOCK_SIZE):
+    block = partial + store.read(path, start, start + MANIFEST_BLOCK_SIZE)
+    lines = block.split(b'\n')
+    partial = lines.pop()
+    for line in lines:
+      yield line.decode('utf-8')
+  if partial:
+    yield partial.decode('utf-8')
+
+
+def iter_inputs(store, paths=None, manifest=None, expand=False):
+  """Yields input paths from the command line and/or a manifest.
+
+  Args:
+      store: gcs.GcsStore or gcs.LocalStore used to read a Cloud Storage
+        manifest and to expand wildcards.
+      paths: optional list of input paths.
+      manifest: optional path to a manifest of input paths.
+      expand: if True, Cloud Storage wildcard paths are replaced by the
+        objects they match; otherwise they are passed through (and the
+        Pipelines API expands them when localizing the input).
+  """
+
+  def all_paths():
+    for path in paths or []:
+      yield path
+    if manifest:
+      for path in read_manifest(manifest, store):
+        yield path
+
+  for path in all_paths():
+    if expand and path.startswith('gs://') and gcs.has_wildcard(path):
+      for metadata in store.list(path):
+        yield metadata['path']
+    else:
+      yield path
+
+
+def input_size(path):
+  """Returns the approximate number of request bytes used by an input."""
+
+  # The value in pipelineArgs.inputs, plus an inputParameters entry
+  return len(json.dumps(path)) + 200
+
+
+def chunks(paths, max_inputs=MAX_INPUTS_PER_REQUEST,
+           max_bytes=MAX_INPUT_BYTES):
+  """Groups input paths into lists small enough for one request each.
+
+  Args:
+      paths: iterable of input paths (consumed lazily).
+      max_inputs: maximum number of inputs in a list.
+      max_bytes: maximum total input_size() of a list.
+
+  Yields:
+      Non-empty lists of paths.
+  """
+
+  chunk = []
+  size = 0
+  for path in paths:
+    if chunk and (len(chunk) >= max_inputs or
+                  size + input_size(path) > max_bytes):
+      yield chunk
+      chunk = []
+      size = 0
+    chunk.append(path)
+    size += input_size(path)
+
+  if chunk:
+    yield chunk
+
+
+def with_inputs(body, paths):
+  """Returns a copy of a request body with its inputFile<n> inputs replaced.
+
+  The inputFile0 parameter of the body's pipeline is used as the template
+  for the new inputFile<n> parameters, which are placed where the original
+  inputFile<n> parameters were.
+  """
+
+  pipeline = body['ephemeralPipeline']
+  parameters = pipeline['inputParameters']
+  positions = [i for i, p in enumerate(parameters)
+               if _INPUT_FILE_NAME.match(p['name'])]
+  if not positions:
+    raise ValueError('Request has no inputFile<n> parameters')
+
+  template = [p for p in parameters if p['name'] == 'inputFile0'][0]
+  new_parameters = []
+  for idx in range(len(paths)):
+    parameter = copy.deepcopy(template)
+    parameter['name'] = 'inputFile%d' % idx
+    new_parameters.append(parameter)
+
+  result = dict(body)
+  result['ephemeralPipeline'] = dict(pipeline)
+  result['ephemeralPipeline']['inputParameters'] = (
+      parameters[:positions[0]] + new_parameters +
+      [p for p in parameters[positions[0]:]
+       if not _INPUT_FILE_NAME.match(p['name'])])
+
+  pipeline_args = body['pipelineArgs']
+  result['pipelineArgs'] = dict(pipeline_args)
+  result['pipelineArgs']['inputs'] = dict(
+      [(name, value) for name, value in pipeline_args['inputs'].items()
+       if not _INPUT_FILE_NAME.match(name)] +
+      [('inputFile%d' % idx, path) for idx, path in enumerate(paths)])
+
+  return result
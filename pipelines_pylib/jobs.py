@@ -0,0 +1,546 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Submitting pipelines and waiting for them without a thread per job.
+
+poller.poll() blocks its caller until one operation completes, so a service
+which manages many pipelines at once needs a thread (or process) for each.
+A PipelineClient instead returns an OperationFuture for each request:
+
+  client = jobs.PipelineClient(service, max_in_flight=500)
+  futures = [client.run(body) for body in bodies]
+  for future in client.as_completed(futures):
+    print future.result()['name']
+  client.close()
+
+Requests are submitted by a small pool of threads, no more than
+max_in_flight of them running at once: a request waits (queued, not
+holding a thread) until an earlier one completes. A single monitor thread
+refreshes all of the operations in flight every poll interval, with
+operations().list() (a page of 256 operations per call) when a project is
+given and many operations are in flight, and otherwise with concurrent
+operations().get() calls. Only the running operations created since the
+oldest one in flight are listed; those in flight which are no longer listed
+have completed (or are not listed yet), and are fetched with get(). One
+client can therefore track tens of thousands of operations.
+
+With a journal, requests are submitted with journal.submit(), so that an
+identical request already journaled is resumed rather than submitted again,
+and the completed operations are recorded in it. With a
+notifications.CompletionWaiter, completion is noticed from its
+notifications instead of refreshing the operations every poll interval.
+With a scheduler.QuotaScheduler, each request waits for (and is restricted
+to) a region with quota for it.
+
+OperationFuture.cancel() cancels the remote operation (or, if it has not
+been submitted yet, drops the request). The future then completes with the
+cancelled operation, as reported by the service.
+
+The futures resemble those of concurrent.futures, with result(),
+exception(), done(), cancel() and add_done_callback(). A future's result is
+the completed operation object, whether the pipeline succeeded or failed;
+exception() is only set when the request could not be submitted.
+submission() returns the operation as it was submitted.
+"""
+
+import Queue
+import sys
+import threading
+import time
+
+from pipelines_pylib import journal as journal_lib
+from pipelines_pylib import metrics
+from pipelines_pylib import mirror
+from pipelines_pylib import poller
+from pipelines_pylib import util
+
+# Default number of operations in flight at once
+DEFAULT_MAX_IN_FLIGHT = 1000
+
+# Default seconds between refreshes of the operations in flight
+DEFAULT_POLL_INTERVAL = 30
+
+# Operations in flight beyond which (with a project) they are refreshed by
+# listing rather than fetching each
+LIST_THRESHOLD = 100
+
+# Seconds before the oldest operation in flight from which operations are
+# listed, for differences between the local and service clocks
+_LIST_SLACK = 300
+
+# Seconds between checks for the operations a CompletionWaiter has seen
+# complete
+_WAITER_INTERVAL = 1
+
+_PENDING = 'PENDING'
+_SUBMITTING = 'SUBMITTING'
+_SUBMITTED = 'SUBMITTED'
+_DONE = 'DONE'
+_CANCELLED = 'CANCELLED'
+_FINAL = (_DONE, _CANCELLED)
+_UNSUBMITTED = (_PENDING, _SUBMITTING)
+
+
+class CancelledError(Exception):
+  """The request was cancelled before it was submitted."""
+
+
+class TimeoutError(Exception):
+  """The operation did not complete within the timeout."""
+
+
+class OperationFuture(object):
+  """The eventual completed operation of a pipeline request.
+
+  Its state is kept by the PipelineClient which created it, under the
+  client's condition.
+  """
+
+  def __init__(self, condition, cancel, body=None, operation=None):
+    self._condition = condition
+    self._cancel = cancel
+    self.body = body
+    self.operation = operation  # the latest operation object, once submitted
+    self.state = _SUBMITTED if operation else _PENDING
+    self.error = None
+    self.cancel_requested = False
+    self.callbacks = []
+
+  @property
+  def name(self):
+    """The operation name, or None if not yet submitted."""
+
+    return self.operation['name'] if self.operation else None
+
+  def done(self):
+    """Returns whether the operation completed (or the request was
+    dropped)."""
+
+    with self._condition:
+      return self.state in _FINAL
+
+  def cancelled(self):
+    """Returns whether the request was cancelled before it was submitted."""
+
+    with self._condition:
+      return self.state == _CANCELLED
+
+  def cancel(self):
+    """Cancels the request, and its remote operation if submitted.
+
+    Returns:
+        False if the operation had already completed, else True.
+    """
+
+    return self._cancel(self)
+
+  def add_done_callback(self, callback):
+    """Calls callback(future) when the future completes (at once if it
+    already has), on the thread which completes it."""
+
+    with self._condition:
+      if self.state not in _FINAL:
+        self.callbacks.append(callback)
+        return
+    callback(self)
+
+  def _wait(self, timeout, states=_FINAL):
+    deadline = None if timeout is None else time.time() + timeout
+    with self._condition:
+      while self.state not in states:
+        remaining = 1 if deadline is None else deadline - time.time()
+        if remaining <= 0:
+          raise TimeoutError('Operation %s did not complete in %s seconds' %
+                             (self.name, timeout))
+        # Wait at most a second at a time, so that a KeyboardInterrupt is
+        # seen
+        self._condition.wait(min(remaining, 1))
+
+  def result(self, timeout=None):
+    """Returns the completed operation object.
+
+    Raises:
+        CancelledError: if the request was cancelled before it was submitted
+        TimeoutError: if the operation did not complete within timeout
+          seconds
+        the exception raised by the submission, if it failed
+    """
+
+    self._wait(timeout)
+    if self.state == _CANCELLED:
+      raise CancelledError('Request cancelled before it was submitted')
+    if self.error is not None:
+      raise self.error
+    return self.operation
+
+  def exception(self, timeout=None):
+    """Returns the exception raised by the submission, or None."""
+
+    self._wait(timeout)
+    return self.error
+
+  def submission(self, timeout=None):
+    """Returns the operation object once the request has been submitted
+    (the latest one, if it has since been refreshed).
+
+    Raises:
+        as result()
+    """
+
+    self._wait(timeout, states=(_SUBMITTED,) + _FINAL)
+    if self.state == _CANCELLED:
+      raise CancelledError('Request cancelled before it was submitted')
+    if self.error is not None:
+      raise self.error
+    return self.operation
+
+
+class PipelineClient(object):
+  """Submits pipelines and tracks their operations, returning futures."""
+
+  def __init__(self, service, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+               poll_interval=DEFAULT_POLL_INTERVAL, project=None,
+               workers=poller.DEFAULT_WORKERS, journal=None, waiter=None,
+               scheduler=None):
+    """Creates a client; its threads start with the first request.
+
+    Args:
+        service: genomics service endpoint, which must be safe to use from
+          multiple threads (such as one from clients.ClientPool.service()).
+        max_in_flight: most operations submitted by run() and not yet
+          complete (None for no limit)
+        poll_interval: seconds between refreshes of the operations in flight
+        project: optional Cloud project id of the operations, to refresh
+          many at once by listing them
+        workers: number of threads submitting requests, and of operations
+          fetched concurrently
+        journal: optional journal.Journal through which requests are
+          submitted, and in which completed operations are recorded
+        waiter: optional notifications.CompletionWaiter which notices the
+          completions, instead of refreshing the operations
+        scheduler: optional scheduler.QuotaScheduler through which requests
+          are submitted as regional quota allows
+    """
+    self._service = service
+    self._poll_interval = poll_interval
+    self._project = project
+    self._workers = workers
+    self._journal = journal
+    self._waiter = waiter
+    self._scheduler = scheduler
+
+    self._max_in_flight = max_in_flight
+    self._slots_used = 0
+    self._queue = Queue.Queue()
+    self._condition = threading.Condition()
+    self._in_flight = {}  # operation name -> OperationFuture
+    self._created = {}  # operation name -> create time, for those in flight
+    self._threads = []
+    self._stopped = threading.Event()
+
+  def _start(self):
+    """Starts the submitting and monitor threads. Called with the condition
+    held."""
+
+    if self._threads:
+      return
+    targets = [self._submit_loop] * self._workers + [self._monitor_loop]
+    for target in targets:
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def run(self, body):
+    """Queues a pipelines().run() request; returns its OperationFuture."""
+
+    future = OperationFuture(self._condition, self._cancel, body=body)
+    with self._condition:
+      self._start()
+    self._queue.put(future)
+    return future
+
+  def track(self, operation):
+    """Returns an OperationFuture for an operation already submitted (which
+    does not count against max_in_flight)."""
+
+    future = OperationFuture(self._condition, self._cancel,
+                             operation=operation)
+    if operation.get('done'):
+      self._complete(future, operation)
+      return future
+
+    with self._condition:
+      self._in_flight[operation['name']] = future
+      self._note_submit(operation)
+      self._start()
+    if self._waiter:
+      self._waiter.watch([operation])
+    return future
+
+  def wait(self, operation, timeout=None):
+    """Returns the completed operation object for an OperationFuture or an
+    operation object."""
+
+    if not isinstance(operation, OperationFuture):
+      operation = self.track(operation)
+    with metrics.timer('jobs.wait'):
+      return operation.result(timeout)
+
+  def as_completed(self, futures, timeout=None):
+    """Yields futures as they complete (or are dropped).
+
+    Raises:
+        TimeoutError: if they have not all completed within timeout seconds
+    """
+
+    deadline = None if timeout is None else time.time() + timeout
+    remaining = set(futures)
+    while remaining:
+      with self._condition:
+        done = [f for f in remaining if f.state in _FINAL]
+        while not done:
+          wait = 1 if deadline is None else min(deadline - time.time(), 1)
+          if wait <= 0:
+            raise TimeoutError('%d operations did not complete in %s '
+                               'seconds' % (len(remaining), timeout))
+          self._condition.wait(wait)
+          done = [f for f in remaining if f.state in _FINAL]
+      for future in done:
+        remaining.discard(future)
+        yield future
+
+  def close(self, cancel=False):
+    """Stops the client's threads, and waits for their current calls to
+    return. Requests still waiting for an operation in flight to complete
+    are not submitted.
+
+    Args:
+        cancel: also cancel the operations in flight, and drop the requests
+          not yet submitted
+    """
+
+    if cancel:
+      with self._condition:
+        futures = self._in_flight.values()
+      for future in futures:
+        self._cancel(future)
+      while True:
+        try:
+          future = self._queue.get_nowait()
+        except Queue.Empty:
+          break
+        if future is not None:
+          self._cancel(future)
+
+    self._stopped.set()
+    for _ in range(self._workers):
+      self._queue.put(None)
+    with self._condition:
+      self._condition.notify_all()
+    for thread in self._threads:
+      if thread is not threading.current_thread():
+        thread.join()
+
+  def _note_submit(self, operation):
+    """Records the create time of an operation in flight, from which
+    operations are listed. Called with the condition held."""
+
+    created = operation.get('metadata', {}).get('createTime')
+    self._created[operation['name']] = (util.parse_timestamp(created)
+                                        if created else time.time())
+
+  def _acquire_slot(self):
+    """Waits until fewer than max_in_flight operations are in flight, and
+    claims a slot; returns False if the client is closed first."""
+
+    with self._condition:
+      while (self._max_in_flight and
+             self._slots_used >= self._max_in_flight):
+        if self._stopped.is_set():
+          return False
+        self._condition.wait(1)
+      self._slots_used += 1
+    return True
+
+  def _release_slot(self):
+    with self._condition:
+      self._slots_used -= 1
+      self._condition.notify_all()
+
+  def _run(self, body):
+    """Submits a request, or resumes an identical journaled one; returns its
+    operation object."""
+
+    if self._journal:
+      return journal_lib.submit(self._service, body, self._journal)
+    return self._service.pipelines().run(body=body).execute()
+
+  def _submit(self, body):
+    if self._scheduler:
+      return self._scheduler.submit(body, self._run)
+    return self._run(body)
+
+  def _submit_loop(self):
+    while True:
+      future = self._queue.get()
+      if future is None:
+        return
+      if future.done():
+        continue
+
+      # Wait for an operation in flight to complete, then claim the request
+      if not self._acquire_slot():
+        return
+      with self._condition:
+        dropped = future.state != _PENDING
+        if not dropped:
+          future.state = _SUBMITTING
+      if dropped:
+        self._release_slot()
+        continue
+
+      try:
+        with metrics.timer('jobs.submit'):
+          operation = self._submit(future.body)
+      except Exception as e:  # pylint: disable=broad-except
+        self._release_slot()
+        self._fail(future, e)
+        continue
+      metrics.count('jobs.submitted')
+
+      # A resumed operation may already be done
+      if operation.get('done'):
+        self._complete(future, operation)
+        continue
+
+      with self._condition:
+        future.operation = operation
+        future.state = _SUBMITTED
+        self._in_flight[operation['name']] = future
+        self._note_submit(operation)
+        cancel = future.cancel_requested
+        self._condition.notify_all()
+      if self._waiter:
+        self._waiter.watch([operation])
+      if cancel:
+        self._cancel_remote(future)
+
+  def _refresh(self):
+    """Fetches the operations in flight and completes those which are
+    done."""
+
+    with self._condition:
+      names = sorted(self._in_flight)
+      start = min(self._created.values()) if self._created else None
+    if not names:
+      return
+
+    if self._waiter:
+      for operation in self._waiter.completed(names):
+        with self._condition:
+          future = self._in_flight.get(operation['name'])
+        if future is not None:
+          self._complete(future, operation)
+      return
+
+    operations = []
+    missing = names
+    if self._project and start is not None and len(names) >= LIST_THRESHOLD:
+      with metrics.timer('jobs.list'):
+        listed = dict((op['name'], op) for op in mirror.list_operations(
+            self._service, self._project, start - _LIST_SLACK,
+            status='RUNNING'))
+      operations = [listed[name] for name in names if name in listed]
+      # Operations which have completed since the last refresh, or are not
+      # listed yet (the listing can lag submissions)
+      missing = [name for name in names if name not in listed]
+    operations.extend(poller.get_operations(self._service, missing,
+                                            self._workers))
+
+    for operation in operations:
+      with self._condition:
+        future = self._in_flight.get(operation['name'])
+        # Keep the operation's metadata (such as its zone) current
+        if future is not None and not operation.get('done'):
+          future.operation = operation
+      if future is not None and operation.get('done'):
+        self._complete(future, operation)
+
+  def _monitor_loop(self):
+    interval = _WAITER_INTERVAL if self._waiter else self._poll_interval
+    while not self._stopped.wait(interval):
+      try:
+        self._refresh()
+      except Exception as e:  # pylint: disable=broad-except
+        # Keep monitoring; the next refresh covers what was missed
+        metrics.count('jobs.refresh_errors')
+        print >> sys.stderr, "ERROR: refreshing operations: %s" % e
+
+  def _finish(self, future, state):
+    """Moves a future to a final state. Called with the condition held;
+    returns the callbacks to run once it is released."""
+
+    future.state = state
+    callbacks, future.callbacks = future.callbacks, []
+    self._condition.notify_all()
+    return callbacks
+
+  def _complete(self, future, operation):
+    with self._condition:
+      if future.state in _FINAL:
+        return
+      future.operation = operation
+      self._in_flight.pop(operation['name'], None)
+      self._created.pop(operation['name'], None)
+      callbacks = self._finish(future, _DONE)
+    # Operations passed to track() did not take a slot
+    if future.body is not None:
+      self._release_slot()
+    metrics.count('jobs.completed')
+    if self._scheduler:
+      self._scheduler.release(operation)
+    if self._journal:
+      self._journal.update(operation)
+    for callback in callbacks:
+      callback(future)
+
+  def _fail(self, future, exception):
+    with self._condition:
+      future.error = exception
+      callbacks = self._finish(future, _DONE)
+    for callback in callbacks:
+      callback(future)
+
+  def _cancel_remote(self, future):
+    with metrics.timer('jobs.cancel'):
+      self._service.operations().cancel(name=future.name, body={}).execute()
+    metrics.count('jobs.cancelled')
+
+  def _cancel(self, future):
+    """Drops a request not yet submitted, or cancels its remote operation
+    (once, when it has been submitted); see OperationFuture.cancel()."""
+
+    callbacks = None
+    with self._condition:
+      if future.state in _FINAL:
+        return False
+      already = future.cancel_requested
+      future.cancel_requested = True
+      if future.state == _PENDING:
+        callbacks = self._finish(future, _CANCELLED)
+      submitted = future.state == _SUBMITTED
+
+    if callbacks is not None:
+      metrics.count('jobs.dropped')
+      for callback in callbacks:
+        callback(future)
+    elif submitted and not already:
+      self._cancel_remote(future)
+    # A request being submitted is cancelled by its submitting thread
+    return True
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""A durable local journal of pipeline submissions.
+
+When a launcher dies after submitting a pipeline, the operation name that
+was printed to the console is the only record of what was submitted.
+Re-running the launcher would submit the same work again.
+
+The journal is a SQLite database which records each submission: the request
+body (and a hash of it), the input paths, the operation name, the state and
+the submission/completion times. A launcher which finds an identical request
+body in the journal resumes tracking the existing operation rather than
+submitting a new one.
+
+Typical usage:
+
+  jrnl = journal.Journal('jobs.db')
+  operation = journal.submit(service, body, jrnl)
+  ...
+  completed_op = poller.poll(service, operation, poll_interval)
+  jrnl.update(completed_op)
+
+A Journal may be shared between threads (such as those of a
+jobs.PipelineClient); its calls are serialized.
+
+Note that there is a short window between the pipelines().run() call
+returning and the operation being recorded. A crash within that window
+leaves no record of the submission.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from pipelines_pylib import metrics
+from pipelines_pylib import util
+
+# Submission states
+STATE_RUNNING = 'RUNNING'
+STATE_SUCCEEDED = 'SUCCEEDED'
+STATE_FAILED = 'FAILED'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  body_hash TEXT NOT NULL,
+  pipeline_name TEXT,
+  operation_name TEXT NOT NULL,
+  state TEXT NOT NULL,
+  submit_time REAL NOT NULL,
+  update_time REAL NOT NULL,
+  end_time REAL,
+  error TEXT,
+  body TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS inputs (
+  submission_id INTEGER NOT NULL REFERENCES submissions(id),
+  name TEXT NOT NULL,
+  path TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS submissions_body_hash ON submissions(body_hash);
+CREATE INDEX IF NOT EXISTS submissions_state ON submissions(state);
+CREATE INDEX IF NOT EXISTS submissions_operation ON submissions(operation_name);
+CREATE INDEX IF NOT EXISTS inputs_path ON inputs(path);
+"""
+
+_COLUMNS = ('id', 'body_hash', 'pipeline_name', 'operation_name', 'state',
+            'submit_time', 'update_time', 'end_time', 'error')
+
+
+def body_hash(body):
+  """Returns a stable hex digest for a pipelines().run() request body.
+
+  The hash is computed over a canonical JSON encoding (sorted keys), so it
+  does not depend on dictionary ordering.
+  """
+  encoded = json.dumps(body, sort_keys=True, separators=(',', ':'))
+  return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def _operation_time(operation, field):
+  """Returns a time (seconds since the epoch) from an operation's metadata,
+  or now if it is not there.
+
+  Times are taken from the service where it reports them, so that the run
+  times in the journal agree with those computed from operation objects
+  (see speculation.operation_runtime()).
+  """
+
+  value = operation.get('metadata', {}).get(field)
+  return util.parse_timestamp(value) if value else time.time()
+
+
+def operation_state(operation):
+  """Returns the journal state for an operation object."""
+
+  if not operation.get('done'):
+    return STATE_RUNNING
+  if 'error' in operation:
+    return STATE_FAILED
+  return STATE_SUCCEEDED
+
+
+class Journal(object):
+  """SQLite-backed record of pipeline submissions."""
+
+  def __init__(self, path):
+    """Opens (creating if necessary) the journal at the given path.
+
+    Args:
+        path: file path for the SQLite database (":memory:" for testing).
+    """
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    self._conn.executescript(_SCHEMA)
+    self._conn.commit()
+
+  def close(self):
+    with self._lock:
+      self._conn.close()
+
+  def _rows(self, where, params):
+    with self._lock:
+      cursor = self._conn.execute(
+          'SELECT %s FROM submissions WHERE %s ORDER BY id' %
+          (', '.join(_COLUMNS), where), params)
+      return [dict(zip(_COLUMNS, row)) for row in cursor]
+
+  def lookup(self, bhash):
+    """Returns the most recent submission for a body hash that did not fail.
+
+    Args:
+        bhash: request body hash, as returned by body_hash().
+
+    Returns:
+        A dict with the submission columns, or None if there is no running
+        or successful submission for the body.
+    """
+    rows = self._rows('body_hash = ? AND state != ?', (bhash, STATE_FAILED))
+    return rows[-1] if rows else None
+
+  def by_state(self, state):
+    """Returns all submissions in the given state, oldest first."""
+    return self._rows('state = ?', (state,))
+
+  def by_input(self, path):
+    """Returns all submissions which included the given input path."""
+    return self._rows(
+        'id IN (SELECT submission_id FROM inputs WHERE path = ?)', (path,))
+
+  def runtimes(self, pipeline_name, limit=100):
+    """Returns the run times (in seconds, from the operation's creation to
+    its end) of the most recent successful runs of a pipeline."""
+    with self._lock:
+      cursor = self._conn.execute(
+          'SELECT end_time - submit_time FROM submissions '
+          'WHERE pipeline_name = ? AND state = ? AND end_time IS NOT NULL '
+          'ORDER BY id DESC LIMIT ?', (pipeline_name, STATE_SUCCEEDED, limit))
+      return [row[0] for row in cursor]
+
+  def record(self, body, operation):
+    """Records a newly submitted operation.
+
+    Args:
+        body: the pipelines().run() request body.
+        operation: the operation object returned from the run() call.
+    """
+    now = time.time()
+    pipeline_name = body.get('ephemeralPipeline', {}).get('name')
+    inputs = body.get('pipelineArgs', {}).get('inputs', {})
+
+    with self._lock, self._conn:
+      cursor = self._conn.execute(
+          'INSERT INTO submissions (body_hash, pipeline_name, operation_name, '
+          'state, submit_time, update_time, body) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?)',
+          (body_hash(body), pipeline_name, operation['name'],
+           operation_state(operation),
+           _operation_time(operation, 'createTime'), now,
+           json.dumps(body, sort_keys=True)))
+      self._conn.executemany(
+          'INSERT INTO inputs (submission_id, name, path) VALUES (?, ?, ?)',
+          [(cursor.lastrowid, name, path)
+           for name, path in sorted(inputs.items())])
+
+  def update(self, operation):
+    """Updates the state of a recorded operation.
+
+    The end time is only set when a running submission is first seen to
+    have finished, so that observing it again (such as when resuming) does
+    not move it.
+
+    Args:
+        operation: the current operation object (from operations().get()).
+    """
+    now = time.time()
+    state = operation_state(operation)
+    error = operation.get('error')
+
+    with self._lock, self._conn:
+      self._conn.execute(
+          'UPDATE submissions SET state = ?, update_time = ?, '
+          'end_time = CASE WHEN state = ? AND ? != ? THEN ? '
+          'ELSE end_time END, error = ? WHERE operation_name = ?',
+          (state, now, STATE_RUNNING, state, STATE_RUNNING,
+           _operation_time(operation, 'endTime'),
+           json.dumps(error) if error else None, operation['name']))
+
+
+def submit(service, body, journal=None):
+  """Runs a pipeline, unless the journal shows it was already submitted.
+
+  If the journal has a running or successful submission of an identical
+  request body, the current state of that operation is fetched and returned
+  instead of submitting the request again. Failed submissions are re-run.
+
+  Args:
+      service: genomics service endpoint
+      body: the pipelines().run() request body
+      journal: optional Journal in which to record the submission
+
+  Returns:
+      The operation object for the (new or previously submitted) pipeline.
+  """
+
+  if journal:
+    with metrics.timer('journal.lookup'):
+      previous = journal.lookup(body_hash(body))
+    if previous:
+      operation = service.operations().get(
+          name=previous['operation_name']).execute()
+      journal.update(operation)
+
+      # The operation may have failed since it was journaled as running
+      if operation_state(operation) != STATE_FAILED:
+        metrics.count('journal.resumed')
+        print "Resuming previously submitted operation %s" % (
+            operation['name'])
+        return operation
+      print "Previously submitted operation %s failed; submitting again" % (
+          operation['name'])
+
+  operation = service.pipelines().run(body=body).execute()
+  metrics.count('journal.submitted')
+
+  if journal:
+    journal.record(body, operation)
+
+  return operation
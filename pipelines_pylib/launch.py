@@ -0,0 +1,424 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Options and orchestration shared by the batch launchers.
+
+The samtools, fastqc, bam_qc and set_vcf_sample_id launchers differ only in
+their Docker command and request body. Everything else (reading the inputs, the result
+cache, the journal, --auto-resources, --plan, and waiting for the operations
+with --speculate, --subscription or --zone-failover) is done here:
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--project", required=True, ...)
+  <the launcher's own options>
+  launch.add_arguments(parser)
+  args = launch.parse_args(parser)
+
+  client_pool = clients.ClientPool()
+  store = gcs.GcsStore(client_pool.service('storage', 'v1'))
+  input_paths, input_chunks = launch.read_inputs(parser, args, store)
+  body = <request body with inputFile0 .. inputFile<n> for input_paths>
+
+  requests = itertools.chain(
+      [body], (inputs.with_inputs(body, chunk) for chunk in input_chunks))
+  launch.run_batch(args, requests, client_pool, store)
+
+The requests are submitted with a jobs.PipelineClient, through the journal
+if there is one (and the QuotaScheduler, with --quota-regions), and
+--speculate, --subscription and --zone-failover all wait on its futures.
+
+The options added by add_arguments() are:
+
+--poll-interval <seconds> waits for the operations to complete, refreshing
+those of all the requests together (default: no polling).
+
+With --input-manifest <path>, input paths (or wildcard patterns) are read
+from a local file or Cloud Storage object with one path per line, and with
+--expand-inputs, Cloud Storage wildcards are expanded to the objects they
+match. Inputs are read and listed lazily and split into requests of at most
+--inputs-per-request inputs (and within the API's request size limit), each
+run on its own VM, so a cohort of any size can be submitted without holding
+it in memory.
+
+If a --journal path is given, each submission is recorded in a local SQLite
+journal. Re-running the same command (for example after the launcher was
+interrupted) resumes tracking the journaled operation rather than submitting
+the pipeline again.
+
+If a --cache-dir is given, the outputs of successful runs are recorded in a
+result cache keyed on the pipeline definition and the CRC32C and generation
+of each input object. When the same pipeline is later requested over the same
+inputs, the cached outputs are copied to the new --output location and no
+pipeline is run (unless the cached outputs have since been deleted). Results
+are only recorded when polling for completion. Entries expire after
+--cache-ttl hours, and beyond --cache-max-entries the least recently used
+are evicted. The cache's hits, misses and evictions are printed at the end.
+
+With --speculate (and polling), the operations are polled as a batch. Once
+the run times of enough successful runs of the pipeline are known (from this
+batch and any --journal), an operation which has run for 1.5 times longer
+than the 90th percentile (or --speculate <percentile>) is duplicated in
+another of the --zones, and whichever copy finishes second is cancelled.
+
+With --zone-failover (and polling), an operation which failed because its
+zone ran out of resources is resubmitted (up to twice) restricted to the
+other zones of the same region listed in --zones, skipping zones which ran
+out of resources in the last 10 minutes; new requests also skip those
+zones. With --zone-health <path>, those zones are recorded in a local file
+shared with other launcher runs.
+
+With --subscription <name> (and polling), completion is noticed from
+notifications pulled from a Cloud Pub/Sub subscription (see
+notifications.py), such as one to a Cloud Storage notification on the
+--logging bucket; each operation named by a notification is then fetched to
+check it is done. All the operations are polled only every 5 minutes, in
+case a notification is lost. --subscription cannot be combined with
+--speculate.
+
+With --quota-regions <region> [<region> ...], each request is submitted
+only once one of those regions (of those in --zones) has the CPUs, disk and
+in-use address quota left for it, and is then restricted to that region's
+zones (see scheduler.py). Quota is returned as operations complete, so
+without polling the launcher still waits for every request to be submitted.
+--submit-rate <n> also limits the pipelines().run() calls to n per second.
+
+With --pack-outputs, the outputs of each request are delocalized as a single
+archive and index (see packing.py) rather than as one object per file.
+tools/packed_outputs.py lists the packed files and extracts any of them,
+reading only its byte range of the archive.
+
+With --auto-resources <mirror-db>, the operations mirror at <mirror-db> (see
+tools/operations_mirror.py) is synced, and the cores, memory and disk of
+each request are set to the cheapest predefined machine type (and disk)
+predicted, from the past successful runs of the pipeline, to finish within
+--target-runtime minutes (default: 60). Until the mirror has enough
+successful runs, requests keep their resources. Each request is labelled
+with its bytes of input for later predictions. Note that a recommendation
+can change as runs complete, so a journaled request is only resumed while
+its recommendation is unchanged.
+
+With --plan <path>, nothing is submitted. The requests are built (with
+--auto-resources applied) and written to <path> as JSON, each with its
+inputs and their sizes and an estimate of its run time, VM-hours, disk
+GB-hours, input egress and cost (see planning.py), and the totals are
+printed. The run times are calibrated from the past runs in the
+--auto-resources mirror once it has enough of them, and otherwise come from
+a table of each pipeline's throughput. tools/run_plan.py submits the
+planned requests unchanged.
+
+With --metrics <path>, the time spent loading credentials, building
+services, building the request and in each API call and poll is written to
+<path> as JSON lines when the script exits. --profile <path> also writes
+cProfile statistics for the script to <path>.
+"""
+
+import itertools
+import pprint
+
+from pipelines_pylib import cache
+from pipelines_pylib import failover
+from pipelines_pylib import inputs
+from pipelines_pylib import jobs
+from pipelines_pylib import journal
+from pipelines_pylib import metrics
+from pipelines_pylib import mirror
+from pipelines_pylib import notifications
+from pipelines_pylib import packing
+from pipelines_pylib import planning
+from pipelines_pylib import resources
+from pipelines_pylib import scheduler
+from pipelines_pylib import speculation
+
+
+def add_arguments(parser):
+  """Adds the options common to the batch launchers to an
+  argparse.ArgumentParser."""
+
+  parser.add_argument("--input", nargs="+",
+                      help="Cloud Storage path to input file(s)")
+  parser.add_argument("--input-manifest",
+                      help="Local or Cloud Storage path to a file of input "
+                           "paths, one per line")
+  parser.add_argument("--expand-inputs", action="store_true",
+                      help="Expand Cloud Storage wildcards in the inputs to "
+                           "the objects they match")
+  parser.add_argument("--inputs-per-request", type=int,
+                      default=inputs.MAX_INPUTS_PER_REQUEST,
+                      help="Maximum number of inputs in each pipeline request "
+                           "(default: %d)" % inputs.MAX_INPUTS_PER_REQUEST)
+  parser.add_argument("--poll-interval", default=0, type=int,
+                      help="Frequency (in seconds) to poll for completion "
+                           "(default: no polling)")
+  parser.add_argument("--journal",
+                      help="Path to a local job journal; an identical request "
+                           "already in the journal is resumed, not "
+                           "resubmitted")
+  parser.add_argument("--cache-dir",
+                      help="Local directory of a result cache; if this "
+                           "pipeline already ran over identical inputs, its "
+                           "outputs are copied to --output instead of running "
+                           "it again")
+  parser.add_argument("--cache-ttl", type=float, metavar="HOURS",
+                      help="Hours after which result cache entries expire "
+                           "(default: never)")
+  parser.add_argument("--cache-max-entries", type=int,
+                      help="Most result cache entries to keep, evicting the "
+                           "least recently used (default: no limit)")
+  parser.add_argument("--speculate", nargs="?", type=float,
+                      const=speculation.DEFAULT_PERCENTILE,
+                      metavar="PERCENTILE",
+                      help="When polling, duplicate operations running longer "
+                           "than this percentile of past run times in another "
+                           "zone (default: %(const)s)")
+  parser.add_argument("--zone-failover", action="store_true",
+                      help="When polling, resubmit operations which failed "
+                           "for lack of resources in their zone to other zones "
+                           "of the same region, and keep new requests out of "
+                           "such zones")
+  parser.add_argument("--zone-health",
+                      help="Local file recording zones recently out of "
+                           "resources, shared between launcher runs")
+  parser.add_argument("--subscription",
+                      help="When polling, wait on notifications from this "
+                           "Cloud Pub/Sub subscription (projects/<project>/"
+                           "subscriptions/<name>), polling only as a fallback")
+  parser.add_argument("--quota-regions", nargs="+", metavar="REGION",
+                      help="Submit each request once one of these regions "
+                           "has the Compute Engine quota for it, restricted "
+                           "to that region")
+  parser.add_argument("--submit-rate", type=float,
+                      help="With --quota-regions, most pipelines().run() "
+                           "calls per second")
+  parser.add_argument("--pack-outputs", action="store_true",
+                      help="Write the outputs of each request as one indexed "
+                           "archive instead of an object per file")
+  parser.add_argument("--auto-resources", metavar="MIRROR_DB",
+                      help="Path to an operations mirror; sync it and set "
+                           "each request's resources from past runs of the "
+                           "pipeline")
+  parser.add_argument("--target-runtime", default=60, type=float,
+                      help="Run time (in minutes) that --auto-resources "
+                           "should meet (default: 60)")
+  parser.add_argument("--plan", metavar="PATH",
+                      help="Write the requests, with run time and cost "
+                           "estimates, to PATH instead of submitting them")
+  parser.add_argument("--metrics",
+                      help="Path to write timings and counters to, as JSON "
+                           "lines")
+  parser.add_argument("--profile",
+                      help="Path to write cProfile statistics to")
+
+
+def parse_args(parser):
+  """Parses and checks the command line, and enables metrics if requested;
+  returns the parsed arguments."""
+
+  args = parser.parse_args()
+
+  if not args.input and not args.input_manifest:
+    parser.error("--input or --input-manifest is required")
+  # Speculation polls the batch itself; it cannot also wait on notifications
+  if args.speculate and args.subscription:
+    parser.error("--speculate cannot be used with --subscription")
+  if args.submit_rate and not args.quota_regions:
+    parser.error("--submit-rate requires --quota-regions")
+
+  if args.metrics or args.profile:
+    metrics.enable(export_path=args.metrics, profile_path=args.profile)
+  return args
+
+
+def read_inputs(parser, args, store):
+  """Reads and expands the inputs lazily, in chunks small enough for one
+  request.
+
+  Returns:
+      (the input paths of the first request, an iterator over those of the
+      remaining requests)
+  """
+
+  input_chunks = inputs.chunks(
+      inputs.iter_inputs(store, args.input, args.input_manifest,
+                         expand=args.expand_inputs),
+      args.inputs_per_request)
+  input_paths = next(input_chunks, None)
+  if not input_paths:
+    parser.error("No inputs found")
+  return input_paths, input_chunks
+
+
+def run_batch(args, requests, client_pool, store, min_cores=1):
+  """Submits (or, with --plan, plans) the requests of a batch and, when
+  polling, waits for them to complete.
+
+  Args:
+      args: the arguments returned by parse_args(), with --project
+      requests: iterable of pipelines().run() request bodies
+      client_pool: clients.ClientPool
+      store: gcs.GcsStore, for the result cache and sizing inputs
+      min_cores: fewest cores the pipeline's command can use, for
+        --auto-resources
+  """
+
+  service = client_pool.service('genomics', 'v1alpha2')
+  pp = pprint.PrettyPrinter(indent=2)
+
+  # Recommend resources from the past runs in an operations mirror
+  recommender = None
+  if args.auto_resources:
+    ops = mirror.OperationsMirror(args.auto_resources)
+    ops.sync(service, args.project)
+    recommender = resources.Recommender(
+        ops, store, target_runtime=args.target_runtime * 60)
+
+  # With --plan, estimate the requests instead of submitting them
+  planner = planning.Planner(store, recommender) if args.plan else None
+
+  results = None
+  if args.cache_dir:
+    results = cache.ResultCache(
+        cache.LocalDirectoryBackend(args.cache_dir), store,
+        ttl=args.cache_ttl * 3600 if args.cache_ttl else None,
+        max_entries=args.cache_max_entries)
+
+  jrnl = journal.Journal(args.journal) if args.journal else None
+  polling = args.poll_interval > 0
+
+  waiter = None
+  if polling and args.subscription:
+    # Wait on completion notifications, polling only as a fallback
+    waiter = notifications.CompletionWaiter(
+        service, notifications.PubSubSource(
+            client_pool.service('pubsub', 'v1'), args.subscription))
+
+  # Admit the requests as the regional quota of the project allows
+  sched = None
+  if args.quota_regions:
+    limits = scheduler.fetch_quotas(client_pool.service('compute', 'v1'),
+                                    args.project, args.quota_regions)
+    sched = scheduler.QuotaScheduler(service, limits,
+                                     submit_rate=args.submit_rate)
+
+  # Submit the requests through the journal, refreshing their operations
+  # together. Without polling, nothing waits for operations to complete, so
+  # the submissions are not limited by those in flight.
+  client = jobs.PipelineClient(
+      service,
+      max_in_flight=jobs.DEFAULT_MAX_IN_FLIGHT if polling else None,
+      poll_interval=(args.poll_interval if polling
+                     else jobs.DEFAULT_POLL_INTERVAL),
+      project=args.project, journal=jrnl, waiter=waiter, scheduler=sched)
+  health = failover.ZoneHealth(path=args.zone_health)
+  futures = []
+  cache_keys = {}
+  try:
+    for request in requests:
+      # Name the packed outputs for this request's inputs
+      if args.pack_outputs:
+        request = packing.with_pack_id(request)
+
+      # If this pipeline already ran over identical inputs, copy its
+      # outputs. The key is computed before running it, so the outputs are
+      # recorded against the inputs it read.
+      key = None
+      if results and not planner:
+        key = results.key(request)
+        entry = results.lookup(request, key)
+        if entry:
+          print "Copying outputs of cached operation %s" % entry['operation']
+          restored = results.restore(entry, request, key)
+          if restored is not None:
+            pp.pprint(restored)
+            continue
+
+      # Size the VM and disk from past runs of the pipeline
+      if recommender:
+        request, recommendation = recommender.apply(request,
+                                                    min_cores=min_cores)
+        if recommendation:
+          print "Using %(machine_type)s and a %(disk_gb)d GB disk (predicted " \
+                "run time %(runtime)d seconds)" % recommendation
+
+      # Keep out of zones recently out of resources
+      if args.zone_failover:
+        request = health.restrict(request)
+
+      # With --plan, add the request to the plan instead of running it
+      if planner:
+        planner.add(request)
+        continue
+
+      # Run the pipeline, or resume a previously journaled submission
+      future = client.run(request)
+      futures.append(future)
+      cache_keys[future] = key
+
+    # With --plan, write the plan; it is run with tools/run_plan.py
+    if planner:
+      print planning.summary(planner.write(args.plan))
+      return
+
+    # Emit the result of each pipeline run submission
+    for future in futures:
+      pp.pprint(future.submission())
+
+    if not polling:
+      return
+
+    # Poll until the operations reach completion state ("done: true")
+    attempts = dict.fromkeys(futures, 1)
+    pending = set()
+    speculating = bool(args.speculate)
+    if speculating:
+      # Duplicate stragglers in other zones
+      supervisor = speculation.BatchSupervisor(
+          client, percentile=args.speculate, journal=jrnl)
+      for future in futures:
+        supervisor.add(future)
+      completed = itertools.izip(futures, supervisor.run(args.poll_interval))
+    else:
+      pending.update(futures)
+      completed = ()
+
+    while True:
+      for future, completed_op in completed:
+        pending.discard(future)
+
+        # Resubmit to other zones of the region if the zone ran out of
+        # resources; the resubmission is waited on with the rest
+        if args.zone_failover:
+          retried = failover.retry(client, future.body, completed_op, health,
+                                   attempts[future])
+          if retried:
+            attempts[retried] = attempts[future] + 1
+            cache_keys[retried] = cache_keys[future]
+            pending.add(retried)
+            # Start waiting again, with the resubmission; the completed
+            # futures not yet seen are still pending
+            if not speculating:
+              break
+            continue
+
+        pp.pprint(completed_op)
+
+        if results:
+          results.put(future.body, completed_op, cache_keys[future])
+
+      if not pending:
+        break
+      speculating = False
+      completed = ((future, future.result())
+                   for future in client.as_completed(pending))
+  finally:
+    client.close()
+    if waiter:
+      waiter.close()
+    if results:
+      print "Result cache: %(hits)d hits, %(misses)d misses, " \
+            "%(evictions)d evictions, %(objects_copied)d objects copied" % \
+            results.stats
@@ -0,0 +1,253 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Timers, counters and latency histograms for launchers and pipelines_pylib.
+
+Instrumentation is disabled by default, and then costs a function call and
+a test per measurement: timer() returns a shared no-op timer and count()
+returns immediately. Once enabled, each timer records a latency histogram
+(count, total, min, max and approximate percentiles) and each counter a
+running total.
+
+Typical usage:
+
+  metrics.enable(export_path='metrics.jsonl', profile_path='launcher.prof')
+
+  with metrics.timer('launcher.submit'):
+    operation = service.pipelines().run(body=body).execute()
+  metrics.count('launcher.submissions')
+
+  # Or, where a block cannot be indented:
+  body_timer = metrics.timer('launcher.build_body').start()
+  body = {...}
+  body_timer.stop()
+
+When enabled with an export path, the metrics are written when the process
+exits, as JSON lines: one "run" line (the command line and elapsed time),
+then one line per timer and per counter, for example:
+
+  {"type": "timer", "name": "api.genomics.operations.get", "count": 12,
+   "total": 1.93, "min": 0.11, "max": 0.31, "p50": 0.128, "p90": 0.256,
+   "p99": 0.512}
+
+With a profile path, the main thread is also run under cProfile and the
+statistics dumped there (read them with the pstats module).
+"""
+
+import atexit
+import bisect
+import json
+import sys
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histogram buckets: 1ms to ~17min
+BUCKET_BOUNDS = [0.001 * 2 ** i for i in range(21)]
+
+# Percentiles reported for each timer
+PERCENTILES = (50, 90, 99)
+
+# The active registry, or None when instrumentation is disabled
+_registry = None
+
+
+class Histogram(object):
+  """Records the distribution of a latency, in exponential buckets."""
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+    self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+
+  def record(self, value):
+    self.count += 1
+    self.total += value
+    self.min = value if self.min is None else min(self.min, value)
+    self.max = value if self.max is None else max(self.max, value)
+    self.buckets[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+
+  def percentile(self, p):
+    """Returns the upper bound of the bucket holding the p-th percentile
+    (or the maximum, if that is smaller)."""
+
+    if not self.count:
+      return None
+
+    rank = self.count * p / 100.0
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if seen >= rank and n:
+        bound = BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max
+        return min(bound, self.max)
+    return self.max
+
+  def to_dict(self):
+    result = {
+      'count': self.count,
+      'total': self.total,
+      'min': self.min,
+      'max': self.max,
+    }
+    for p in PERCENTILES:
+      result['p%d' % p] = self.percentile(p)
+    return result
+
+
+class _Registry(object):
+  """Holds the timers and counters of an instrumented process."""
+
+  def __init__(self):
+    self.start = time.time()
+    self.histograms = {}
+    self.counters = {}
+    self.lock = threading.Lock()
+
+  def record(self, name, seconds):
+    with self.lock:
+      if name not in self.histograms:
+        self.histograms[name] = Histogram()
+      self.histograms[name].record(seconds)
+
+  def count(self, name, n):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def lines(self):
+    """Returns the metrics as a list of JSON-serializable dicts."""
+
+    with self.lock:
+      lines = [{
+        'type': 'run',
+        'argv': sys.argv,
+        'start': self.start,
+        'elapsed': time.time() - self.start,
+      }]
+      for name in sorted(self.histograms):
+        line = {'type': 'timer', 'name': name}
+        line.update(self.histograms[name].to_dict())
+        lines.append(line)
+      for name in sorted(self.counters):
+        lines.append({'type': 'counter', 'name': name,
+                      'value': self.counters[name]})
+      return lines
+
+
+class Timer(object):
+  """Times a block (as a context manager) or a start()/stop() interval."""
+
+  def __init__(self, registry, name):
+    self._registry = registry
+    self._name = name
+    self._start = None
+
+  def start(self):
+    self._start = time.time()
+    return self
+
+  def stop(self):
+    self._registry.record(self._name, time.time() - self._start)
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc_info):
+    self.stop()
+
+
+class _NullTimer(object):
+  """The timer returned while instrumentation is disabled."""
+
+  def start(self):
+    return self
+
+  def stop(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def enabled():
+  return _registry is not None
+
+
+def timer(name):
+  """Returns a timer which records its intervals under name."""
+
+  if _registry is None:
+    return _NULL_TIMER
+  return Timer(_registry, name)
+
+
+def count(name, n=1):
+  """Adds n to the counter name."""
+
+  if _registry is not None:
+    _registry.count(name, n)
+
+
+def snapshot():
+  """Returns the current metrics as a list of dicts (as exported), or an
+  empty list when disabled."""
+
+  return _registry.lines() if _registry is not None else []
+
+
+def export(path):
+  """Writes the current metrics to path as JSON lines."""
+
+  with open(path, 'w') as f:
+    for line in snapshot():
+      f.write(json.dumps(line, sort_keys=True) + '\n')
+
+
+def enable(export_path=None, profile_path=None):
+  """Enables instrumentation for the rest of the process.
+
+  Args:
+      export_path: optional path to write the metrics to (as JSON lines)
+        when the process exits.
+      profile_path: optional path to write cProfile statistics for the
+        main thread to when the process exits.
+  """
+
+  global _registry
+  if _registry is not None:
+    return
+  _registry = _Registry()
+
+  profiler = None
+  if profile_path:
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+  def finish():
+    if profiler:
+      profiler.disable()
+      profiler.dump_stats(profile_path)
+    if export_path:
+      export(export_path)
+
+  atexit.register(finish)
+
+
+def disable():
+  """Disables instrumentation and discards the metrics collected."""
+
+  global _registry
+  _registry = None
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""A local, indexed mirror of a project's genomics operations.
+
+Questions such as "which of last night's operations failed, and why" would
+otherwise take an operations().get() call (or a gcloud describe) per
+operation. The mirror is a SQLite database of operations, indexed by state,
+pipeline name, create time, error code and label, so that such queries are
+answered locally in milliseconds.
+
+sync() brings the mirror up to date. It lists the operations created since
+the previous sync, splitting that time window into slices which are listed
+(a page at a time) in parallel. It also re-fetches the operations that were
+still running at the previous sync. Operations which had already finished
+are never fetched again.
+
+Typical usage:
+
+  ops = mirror.OperationsMirror('operations.db')
+  ops.sync(service, 'my-project')
+  for row in ops.query(state='FAILED', since=time.time() - 24 * 3600):
+    print row['name'], row['error_code'], row['error_message']
+"""
+
+import json
+import multiprocessing.pool
+import sqlite3
+import time
+
+from pipelines_pylib import journal
+from pipelines_pylib import metrics
+from pipelines_pylib import poller
+from pipelines_pylib import util
+
+# Default number of time slices listed (and operations fetched) concurrently
+DEFAULT_WORKERS = 8
+
+# Operations per page of operations().list()
+PAGE_SIZE = 256
+
+# History listed by the first sync of a project, in seconds
+DEFAULT_HISTORY = 7 * 24 * 3600
+
+# Seconds of overlap with the previous sync, for operations created while it
+# was listing
+SYNC_OVERLAP = 300
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS operations (
+  name TEXT PRIMARY KEY,
+  project TEXT,
+  pipeline_name TEXT,
+  state TEXT NOT NULL,
+  create_time REAL,
+  start_time REAL,
+  end_time REAL,
+  zone TEXT,
+  error_code INTEGER,
+  error_message TEXT,
+  operation TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS labels (
+  name TEXT NOT NULL REFERENCES operations(name),
+  key TEXT NOT NULL,
+  value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS syncs (
+  project TEXT PRIMARY KEY,
+  sync_time REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS operations_state ON operations(state);
+CREATE INDEX IF NOT EXISTS operations_pipeline ON operations(pipeline_name);
+CREATE INDEX IF NOT EXISTS operations_create_time ON operations(create_time);
+CREATE INDEX IF NOT EXISTS operations_error_code ON operations(error_code);
+CREATE INDEX IF NOT EXISTS labels_name ON labels(name);
+CREATE INDEX IF NOT EXISTS labels_key_value ON labels(key, value);
+"""
+
+COLUMNS = ('name', 'project', 'pipeline_name', 'state', 'create_time',
+           'start_time', 'end_time', 'zone', 'error_code', 'error_message')
+
+
+def _timestamp(metadata, field):
+  value = metadata.get(field)
+  return util.parse_timestamp(value) if value else None
+
+
+def operation_row(operation):
+  """Returns the mirror columns (as a dict) for an operation object."""
+
+  metadata = operation.get('metadata', {})
+  request = metadata.get('request', {})
+  pipeline = request.get('ephemeralPipeline', {})
+  error = operation.get('error', {})
+
+  return {
+    'name': operation['name'],
+    'project': metadata.get('projectId'),
+    'pipeline_name': pipeline.get('name') or request.get('pipelineId'),
+    'state': journal.operation_state(operation),
+    'create_time': _timestamp(metadata, 'createTime'),
+    'start_time': _timestamp(metadata, 'startTime'),
+    'end_time': _timestamp(metadata, 'endTime'),
+    'zone': util.operation_zone(operation),
+    'error_code': error.get('code'),
+    'error_message': error.get('message'),
+  }
+
+
+def time_slices(start, end, count):
+  """Splits [start, end) into count slices; the last is open-ended."""
+
+  step = float(end - start) / count
+  bounds = [start + step * i for i in range(count)] + [None]
+  return list(zip(bounds[:-1], bounds[1:]))
+
+
+def list_operations(service, project, start=None, end=None, status=None):
+  """Returns the operations of a project created in [start, end).
+
+  Args:
+      service: genomics service endpoint
+      project: Cloud project id
+      start, end: optional bounds on the create time (seconds since the
+        epoch)
+      status: optional status of the operations to list (RUNNING, SUCCESS,
+        FAILURE or CANCELED)
+  """
+
+  filters = ['projectId = %s' % project]
+  if start is not None:
+    filters.append('createTime >= %d' % start)
+  if end is not None:
+    filters.append('createTime < %d' % end)
+  if status is not None:
+    filters.append('status = %s' % status)
+
+  operations = []
+  request = service.operations().list(
+      name='operations', filter=' AND '.join(filters), pageSize=PAGE_SIZE)
+  while request is not None:
+    with metrics.timer('mirror.list_page'):
+      response = request.execute()
+    operations.extend(response.get('operations', []))
+    request = service.operations().list_next(request, response)
+  return operations
+
+
+class OperationsMirror(object):
+  """SQLite-backed mirror of genomics operations."""
+
+  def __init__(self, path):
+    """Opens (creating if necessary) the mirror at the given path.
+
+    Args:
+        path: file path for the SQLite database (":memory:" for testing).
+    """
+    self._conn = sqlite3.connect(path)
+    self._conn.executescript(_SCHEMA)
+    self._conn.commit()
+
+  def close(self):
+    self._conn.close()
+
+  def last_sync(self, project):
+    """Returns the time of the last sync of a project, or None."""
+
+    row = self._conn.execute('SELECT sync_time FROM syncs WHERE project = ?',
+                             (project,)).fetchone()
+    return row[0] if row else None
+
+  def put(self, operations):
+    """Adds or replaces operations in the mirror."""
+
+    rows = [operation_row(operation) for operation in operations]
+    with self._conn:
+      self._conn.executemany(
+          'INSERT OR REPLACE INTO operations (%s, operation) VALUES (%s, ?)' %
+          (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+          [[row[c] for c in COLUMNS] + [json.dumps(operation, sort_keys=True)]
+           for row, operation in zip(rows, operations)])
+      self._conn.executemany('DELETE FROM labels WHERE name = ?',
+                             [(row['name'],) for row in rows])
+      self._conn.executemany(
+          'INSERT INTO labels (name, key, value) VALUES (?, ?, ?)',
+          [(operation['name'], key, value)
+           for operation in operations
+           for key, value in sorted(
+               operation.get('metadata', {}).get('labels', {}).items())])
+
+  def sync(self, service, project, since=None, workers=DEFAULT_WORKERS):
+    """Brings the mirror of a project's operations up to date.
+
+    Args:
+        service: genomics service endpoint, which must be safe to use from
+          multiple threads (such as one from clients.ClientPool.service()).
+        project: Cloud project id
+        since: optional create time (seconds since the epoch) to list from;
+          by default, shortly before the last sync, or DEFAULT_HISTORY ago
+          for the first.
+        workers: number of concurrent requests
+
+    Returns:
+        A dict with the number of operations listed and refreshed.
+    """
+
+    now = time.time()
+    if since is None:
+      last = self.last_sync(project)
+      since = last - SYNC_OVERLAP if last else now - DEFAULT_HISTORY
+
+    # Operations created since the last sync, listed in parallel slices
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+      with metrics.timer('mirror.list'):
+        listed = pool.map(
+            lambda bounds: list_operations(service, project, *bounds),
+            time_slices(since, now, workers))
+    finally:
+      pool.close()
+    listed = [operation for page in listed for operation in page]
+    self.put(listed)
+
+    # Operations created earlier which were still running
+    listed_names = set(operation['name'] for operation in listed)
+    running = [name for (name,) in self._conn.execute(
+        'SELECT name FROM operations WHERE project = ? AND state = ?',
+        (project, journal.STATE_RUNNING)) if name not in listed_names]
+    with metrics.timer('mirror.refresh'):
+      refreshed = poller.get_operations(service, running, workers)
+    self.put(refreshed)
+
+    with self._conn:
+      self._conn.execute(
+          'INSERT OR REPLACE INTO syncs (project, sync_time) VALUES (?, ?)',
+          (project, now))
+
+    return {'listed': len(listed), 'refreshed': len(refreshed)}
+
+  def query(self, project=None, state=None, pipeline_name=None, labels=None,
+            since=None, until=None, error_code=None, limit=None):
+    """Returns the mirrored operations matching all the given filters.
+
+    Args:
+        project: Cloud project id
+        state: journal.STATE_RUNNING, STATE_SUCCEEDED or STATE_FAILED
+        pipeline_name: name of the pipeline (or id of a stored pipeline)
+        labels: dict of label key -> value, all of which must match
+        since, until: bounds on the create time (seconds since the epoch)
+        error_code: google.rpc.Code of the operation's error
+        limit: maximum number of operations returned
+
+    Returns:
+        A list of dicts with the mirror COLUMNS and (under "operation") the
+        operation object, most recently created first.
+    """
+
+    where = []
+    params = []
+    for column, value in (('project', project), ('state', state),
+                          ('pipeline_name', pipeline_name),
+                          ('error_code', error_code)):
+      if value is not None:
+        where.append('%s = ?' % column)
+        params.append(value)
+    if since is not None:
+      where.append('create_time >= ?')
+      params.append(since)
+    if until is not None:
+      where.append('create_time < ?')
+      params.append(until)
+    for key, value in sorted((labels or {}).items()):
+      where.append('name IN (SELECT name FROM labels '
+                   'WHERE key = ? AND value = ?)')
+      params.extend([key, value])
+
+    sql = 'SELECT %s, operation FROM operations' % ', '.join(COLUMNS)
+    if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY create_time DESC'
+    if limit:
+      sql += ' LIMIT %d' % limit
+
+    rows = []
+    for row in self._conn.execute(sql, params):
+      result = dict(zip(COLUMNS, row[:-1]))
+      result['operation'] = json.loads(row[-1])
+      rows.append(result)
+    return rows
@@ -0,0 +1,341 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Waiting for operations to complete on notifications rather than polling.
+
+poller.poll() calls operations().get() every poll interval for every
+operation, so completion is noticed up to an interval late, at the cost of
+many calls for a large batch. A CompletionWaiter instead listens for
+notifications naming operations, and only then fetches those operations to
+see whether they are done. All the operations being waited for are also
+polled every fallback interval (by default, 5 minutes), so a lost
+notification only delays completion.
+
+Notifications are pulled from a source:
+
+  * PubSubSource pulls from a Cloud Pub/Sub subscription. The Pipelines API
+    does not publish operation events itself, but it writes each
+    operation's logs (<operation-id>.log, -stdout.log and -stderr.log) to
+    the pipeline's logging path, finishing with them as the operation
+    completes. A Cloud Storage notification on the logging bucket publishes
+    each write:
+
+      gsutil notification create -t pipelines-logs -f json \\
+          -e OBJECT_FINALIZE gs://my-bucket
+      gcloud beta pubsub subscriptions create my-launcher-run \\
+          --topic pipelines-logs
+
+    Messages with an "operation" attribute (the operation name) are also
+    understood, for other publishers.
+
+  * LocalQueueSource is a stand-in fed from a local Queue, for tests.
+
+Notifications are hints: an operation named by one is always fetched to
+check that it is done. A waiter acknowledges only the messages naming
+operations it waits for (or has seen complete recently), and those naming
+no operation. Messages for other launchers' operations on a shared
+subscription are left unacknowledged, and Pub/Sub redelivers them once
+their acknowledgement deadline passes. As each waiter then also pulls the
+others' messages, a subscription per launcher run (created before the
+pipelines are submitted) is still more efficient.
+
+Typical usage:
+
+  source = notifications.PubSubSource(
+      client_pool.service('pubsub', 'v1'),
+      'projects/my-project/subscriptions/my-launcher-run')
+  waiter = notifications.CompletionWaiter(service, source)
+  ...
+  completed_op = waiter.wait(operation)
+  waiter.close()
+
+A jobs.PipelineClient given a waiter completes its futures as the waiter
+sees the operations complete.
+"""
+
+import Queue
+import collections
+import re
+import sys
+import threading
+import time
+
+from pipelines_pylib import metrics
+from pipelines_pylib import poller
+
+# Default seconds between polls of all the operations being waited for
+DEFAULT_FALLBACK_INTERVAL = 300
+
+# Maximum messages pulled from a subscription at a time
+MAX_MESSAGES = 100
+
+# Seconds a local source waits for a notification before returning none
+PULL_TIMEOUT = 10
+
+# Most operations remembered as notified before being waited for, and as
+# completed (whose later notifications are still acknowledged). A shared
+# subscription also names other launchers' operations, which are never
+# waited for; the oldest are forgotten first.
+MAX_HINTS = 10000
+
+_LOG_OBJECT = re.compile(r'^(?:.*/)?(.+?)(?:-stdout|-stderr)?\.log$')
+
+
+def operation_name(attributes):
+  """Returns the operation name that a notification's attributes refer to,
+  or None.
+
+  Args:
+      attributes: the message attributes; either an "operation" attribute,
+        or those of a Cloud Storage notification for an operation's log
+        file.
+  """
+
+  if 'operation' in attributes:
+    return attributes['operation']
+
+  match = _LOG_OBJECT.match(attributes.get('objectId', ''))
+  if match:
+    return 'operations/%s' % match.group(1)
+  return None
+
+
+class LocalQueueSource(object):
+  """Notifications put on a local queue."""
+
+  def __init__(self):
+    self._queue = Queue.Queue()
+
+  def put(self, name):
+    """Notifies that the operation of the given name may have changed."""
+
+    self._queue.put(name)
+
+  def pull(self, wanted=None):
+    """Returns the names notified, waiting up to PULL_TIMEOUT for one. The
+    queue is not shared, so wanted is not used."""
+
+    try:
+      names = [self._queue.get(timeout=PULL_TIMEOUT)]
+    except Queue.Empty:
+      return []
+    while True:
+      try:
+        names.append(self._queue.get_nowait())
+      except Queue.Empty:
+        return names
+
+
+class PubSubSource(object):
+  """Notifications pulled from a Cloud Pub/Sub subscription."""
+
+  def __init__(self, pubsub, subscription):
+    """Args:
+        pubsub: Cloud Pub/Sub (v1) service endpoint
+        subscription: full subscription name
+          ("projects/<project>/subscriptions/<name>")
+    """
+    self._pubsub = pubsub
+    self._subscription = subscription
+
+  def pull(self, wanted=None):
+    """Returns the operation names of the messages pulled (waiting for
+    messages as long as the service does).
+
+    Args:
+        wanted: optional callable, true of the operation names whose
+          messages are acknowledged; by default all are. Messages naming no
+          operation are always acknowledged, and the others are left for
+          other subscribers.
+    """
+
+    subscriptions = self._pubsub.projects().subscriptions()
+    with metrics.timer('notifications.pull'):
+      response = subscriptions.pull(
+          subscription=self._subscription,
+          body={'returnImmediately': False,
+                'maxMessages': MAX_MESSAGES}).execute()
+
+    received = response.get('receivedMessages', [])
+    names = [operation_name(r['message'].get('attributes', {}))
+             for r in received]
+
+    ack_ids = [r['ackId'] for r, name in zip(received, names)
+               if not name or not wanted or wanted(name)]
+    if ack_ids:
+      subscriptions.acknowledge(
+          subscription=self._subscription,
+          body={'ackIds': ack_ids}).execute()
+    metrics.count('notifications.unacknowledged',
+                  len(received) - len(ack_ids))
+
+    return [name for name in names if name]
+
+
+class CompletionWaiter(object):
+  """Waits for operations to complete, woken by notifications."""
+
+  def __init__(self, service, source,
+               fallback_interval=DEFAULT_FALLBACK_INTERVAL,
+               workers=poller.DEFAULT_WORKERS):
+    """Creates a waiter; it starts listening on the first wait.
+
+    Args:
+        service: genomics service endpoint, which must be safe to use from
+          multiple threads (such as one from clients.ClientPool.service()).
+        source: PubSubSource or LocalQueueSource
+        fallback_interval: seconds between polls of all the operations being
+          waited for
+        workers: number of operations fetched concurrently
+    """
+    self._service = service
+    self._source = source
+    self._fallback_interval = fallback_interval
+    self._workers = workers
+
+    self._condition = threading.Condition()
+    self._pending = set()
+    self._completed = {}  # done, and not yet returned
+    self._hinted = collections.OrderedDict()  # notified before being waited for
+    self._finished = collections.OrderedDict()  # recently returned as done
+    self._thread = None
+    self._stopped = False
+
+  def close(self):
+    """Stops listening (after the current pull returns)."""
+
+    with self._condition:
+      self._stopped = True
+
+  def _start(self):
+    """Starts the listener thread. Called with the condition held."""
+
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._listen)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _refresh(self, names):
+    """Fetches operations and records those which are done."""
+
+    if not names:
+      return
+    operations = poller.get_operations(self._service, names, self._workers)
+    with self._condition:
+      for operation in operations:
+        if operation.get('done') and operation['name'] in self._pending:
+          self._pending.discard(operation['name'])
+          self._completed[operation['name']] = operation
+      self._condition.notify_all()
+
+  def _wanted(self, name):
+    """Returns whether notifications of an operation are for this waiter."""
+
+    with self._condition:
+      return (name in self._pending or name in self._completed or
+              name in self._finished)
+
+  def _pop_completed(self, names):
+    """Returns the completed operation objects of those named, forgetting
+    them. Called with the condition held."""
+
+    completed = []
+    for name in names:
+      operation = self._completed.pop(name, None)
+      if operation is None:
+        continue
+      completed.append(operation)
+      self._finished.pop(name, None)
+      self._finished[name] = True
+    while len(self._finished) > MAX_HINTS:
+      self._finished.popitem(last=False)
+    return completed
+
+  def _listen(self):
+    next_fallback = time.time() + self._fallback_interval
+    while True:
+      with self._condition:
+        if self._stopped:
+          return
+
+      try:
+        names = set(self._source.pull(self._wanted))
+        metrics.count('notifications.received', len(names))
+        with self._condition:
+          hinted = names & self._pending
+          for name in (names - self._pending - set(self._completed) -
+                       set(self._finished)):
+            self._hinted.pop(name, None)
+            self._hinted[name] = True
+          while len(self._hinted) > MAX_HINTS:
+            self._hinted.popitem(last=False)
+        metrics.count('notifications.confirmed', len(hinted))
+        self._refresh(sorted(hinted))
+
+        if time.time() >= next_fallback:
+          with self._condition:
+            pending = sorted(self._pending)
+          metrics.count('notifications.fallback_polls')
+          self._refresh(pending)
+          next_fallback = time.time() + self._fallback_interval
+      except Exception as e:  # pylint: disable=broad-except
+        # Keep listening; the fallback polls cover what was missed
+        print >> sys.stderr, "ERROR: waiting for notifications: %s" % e
+        time.sleep(1)
+
+  def watch(self, operations):
+    """Starts listening for the completion of operations (which wait() and
+    as_completed() also do), fetching any already notified."""
+
+    hinted = []
+    with self._condition:
+      for operation in operations:
+        name = operation['name']
+        if operation.get('done'):
+          self._completed[name] = operation
+        elif name not in self._completed:
+          self._pending.add(name)
+          if self._hinted.pop(name, None):
+            hinted.append(name)
+      self._start()
+    self._refresh(hinted)
+
+  def completed(self, names):
+    """Returns the completed operation objects of those named, without
+    waiting (as jobs.PipelineClient does with a waiter). Each is returned
+    once."""
+
+    with self._condition:
+      return self._pop_completed(names)
+
+  def as_completed(self, operations):
+    """Yields the completed operation objects in the order they complete.
+
+    Args:
+        operations: operation objects (as returned by pipelines().run())
+    """
+
+    self.watch(operations)
+    remaining = set(operation['name'] for operation in operations)
+    while remaining:
+      with self._condition:
+        done = remaining & set(self._completed)
+        while not done:
+          # Wait with a timeout, so that a KeyboardInterrupt is seen
+          self._condition.wait(1)
+          done = remaining & set(self._completed)
+        completed = self._pop_completed(sorted(done))
+      for operation in completed:
+        remaining.discard(operation['name'])
+        yield operation
+
+  def wait(self, operation):
+    """Returns the operation object once the operation is done."""
+
+    with metrics.timer('notifications.wait'):
+      return next(self.as_completed([operation]))
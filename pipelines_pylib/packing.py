@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Packed pipeline outputs: one archive and index per operation.
+
+Pipelines such as FastQC and samtools index write a few small files per
+input. Delocalizing output/* copies each to its own object, and for thousands
+of inputs per VM the per-object overhead dominates.
+
+With packed outputs, the pipeline's command is followed by packed_command(),
+which concatenates the files under /mnt/data/output into a single archive,
+
+  /mnt/data/packed/outputs-<id>.pack
+
+and writes an index of the archive's members, one tab-separated line each,
+
+  <path under output/>  <offset in the archive>  <size>
+
+to /mnt/data/packed/outputs-<id>.index. Only these two objects are
+delocalized (from PACKED_PATH). The <id> is a hash of the full Cloud Storage
+paths of the request's inputs, computed by with_pack_id() and passed to the
+command in the PACK_ID environment variable, so each request writes its own
+archive (even when inputs in different folders share a name) and a re-run of
+a request replaces it. Only the shell and coreutils are needed in the Docker
+image.
+
+PackedOutputs reads the indexes under an output path and reads any member
+with a ranged read of its archive, without downloading the whole archive:
+
+  outputs = packing.PackedOutputs(store, 'gs://bucket/fastqc/output')
+  for member in outputs.members():
+    ...
+  data = outputs.read('sample1_fastqc.zip')
+"""
+
+import collections
+import copy
+import hashlib
+import os
+
+from pipelines_pylib import metrics
+
+# Suffixes of the archive and index objects
+ARCHIVE_SUFFIX = '.pack'
+INDEX_SUFFIX = '.index'
+
+# The local copy path (on the data disk) of the packed outputs, for the
+# pipeline's outputParameters
+PACKED_PATH = 'packed/*'
+
+# Name of the input parameter (an environment variable of the command)
+# holding the pack id
+PACK_ID = 'PACK_ID'
+
+_PACK_COMMAND = (
+    'cd /mnt/data/output && mkdir -p /mnt/data/packed && '
+    'NAME=outputs-${PACK_ID} && '
+    'find . -type f | cut -c3- | sort > /tmp/packed-members && '
+    'OFFSET=0 && '
+    'while IFS= read -r FILE; do '
+      'SIZE=$(stat -c %s "${FILE}"); '
+      'printf "%s\\t%d\\t%d\\n" "${FILE}" ${OFFSET} ${SIZE}; '
+      'OFFSET=$((OFFSET + SIZE)); '
+    'done < /tmp/packed-members > /mnt/data/packed/${NAME}' + INDEX_SUFFIX +
+    ' && '
+    'while IFS= read -r FILE; do cat "${FILE}"; done '
+      '< /tmp/packed-members > /mnt/data/packed/${NAME}' + ARCHIVE_SUFFIX)
+
+
+def packed_command(cmd):
+  """Returns a Docker command which runs cmd and then, if it succeeded,
+  packs the files it wrote under /mnt/data/output. Each request body must
+  pass it a pack id, with with_pack_id()."""
+
+  # cmd runs in a subshell, so that an "exit" in it does not skip packing
+  return '(%s) && %s' % (cmd, _PACK_COMMAND)
+
+
+def pack_id(body):
+  """Returns the id of a request's packed outputs: a hash of its input
+  paths."""
+
+  inputs = body['pipelineArgs']['inputs']
+  paths = sorted(value for name, value in inputs.items() if name != PACK_ID)
+  return hashlib.md5('\n'.join(paths).encode('utf-8')).hexdigest()[:16]
+
+
+def with_pack_id(body):
+  """Returns a copy of a request body (whose command is a packed_command())
+  which passes the command the id of its packed outputs."""
+
+  result = dict(body)
+  pipeline = result['ephemeralPipeline'] = dict(body['ephemeralPipeline'])
+  pipeline['inputParameters'] = [
+    p for p in pipeline['inputParameters'] if p['name'] != PACK_ID
+  ] + [ {
+    'name': PACK_ID,
+    'description': 'Id of the packed outputs',
+  } ]
+
+  result['pipelineArgs'] = copy.copy(body['pipelineArgs'])
+  result['pipelineArgs']['inputs'] = dict(body['pipelineArgs']['inputs'])
+  result['pipelineArgs']['inputs'][PACK_ID] = pack_id(body)
+  return result
+
+
+def parse_index(data):
+  """Returns an OrderedDict of member -> (offset, size) for the contents of
+  an index."""
+
+  members = collections.OrderedDict()
+  for line in data.decode('utf-8').splitlines():
+    if line:
+      member, offset, size = line.rsplit('\t', 2)
+      members[member] = (int(offset), int(size))
+  return members
+
+
+class PackedOutputs(object):
+  """The members of the packed outputs written to an output path."""
+
+  def __init__(self, store, path):
+    """Args:
+        store: gcs.GcsStore or gcs.LocalStore
+        path: the Cloud Storage output path that the archives and indexes
+          were delocalized to
+    """
+    self._store = store
+    self._path = path.rstrip('/')
+    self._members = None
+
+  def members(self):
+    """Returns an OrderedDict of member -> (archive path, offset, size),
+    reading the indexes on first use.
+
+    If several archives have a member of the same name, the one in the last
+    archive (by name) is returned.
+    """
+
+    if self._members is None:
+      indexes = sorted(metadata['path'] for metadata in
+                       self._store.list('%s/*%s' % (self._path, INDEX_SUFFIX)))
+      members = collections.OrderedDict()
+      with metrics.timer('packing.read_indexes'):
+        for index in indexes:
+          archive = index[:-len(INDEX_SUFFIX)] + ARCHIVE_SUFFIX
+          for member, (offset, size) in parse_index(
+              self._store.read(index)).items():
+            members[member] = (archive, offset, size)
+      self._members = members
+    return self._members
+
+  def read(self, member):
+    """Returns the contents of a member, with a ranged read of its archive."""
+
+    members = self.members()
+    if member not in members:
+      raise KeyError('No packed output named %s under %s' %
+                     (member, self._path))
+
+    archive, offset, size = members[member]
+    if not size:
+      return b''
+    with metrics.timer('packing.read_member'):
+      return self._store.read(archive, offset, offset + size)
+
+  def extract(self, member, destination):
+    """Writes the contents of a member to a local file."""
+
+    folder = os.path.dirname(destination)
+    if folder and not os.path.isdir(folder):
+      os.makedirs(folder)
+    with open(destination, 'wb') as f:
+      f.write(self.read(member))
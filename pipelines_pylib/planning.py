@@ -0,0 +1,310 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Dry-run plans of pipeline batches, with run time and cost estimates.
+
+A launcher run with --plan builds its pipelines().run() request bodies as
+usual but, instead of submitting them, adds each to a Planner. The Planner
+sizes the inputs of each request and estimates:
+
+  runtime:          seconds from VM start to completion
+  vm_hours:         billed VM hours (a minimum of 10 minutes, then per minute)
+  disk_gb_hours:    GB-hours of boot and data disk
+  egress_gb:        GB of input read from a bucket outside the VM's region
+  cost:             US dollars for the VM, disks and egress
+
+The run time is predicted from the pipeline's past runs in an operations
+mirror when there are enough of them (see resources.Recommender), and
+otherwise from a table of the throughput of each pipeline (THROUGHPUT),
+plus VM startup and the copying of localized inputs. The machine type is
+the cheapest predefined type with the cores and memory requested. When a
+request may run in zones of several regions, the egress is that of the
+worst of them. The estimates do not include the outputs.
+
+The plan is written as JSON:
+
+  {
+    "version": 1,
+    "pipeline": "samtools",
+    "created": "2017-06-01T12:00:00Z",
+    "calibrated": false,
+    "requests": [
+      {"body": {...},
+       "inputs": [{"name": "inputFile0", "path": "gs://...", "bytes": 123}],
+       "estimate": {"machine_type": "n1-standard-1", "runtime": 301, ...}},
+      ...
+    ],
+    "totals": {"requests": 10, "bytes": 1234, "vm_hours": 1.7, ...,
+               "runtime": 1234}
+  }
+
+and tools/run_plan.py submits its request bodies unchanged.
+
+Typical usage:
+
+  planner = planning.Planner(store, resources.Recommender(ops, store))
+  for body in requests:
+    planner.add(body)
+  plan = planner.write('plan.json')
+  print planning.summary(plan)
+"""
+
+import datetime
+import json
+import math
+
+from pipelines_pylib import defaults
+from pipelines_pylib import resources
+from pipelines_pylib import scheduler
+
+# Version of the plan format
+PLAN_VERSION = 1
+
+# Throughput of each pipeline's command: (seconds of setup, MB of input
+# processed per second on one VM)
+THROUGHPUT = {
+  'compress': (10, 30),
+  'samtools': (10, 60),
+  'fastqc': (20, 20),
+  'bam_qc': (20, 15),
+  'set_vcf_sample_id': (10, 40),
+}
+DEFAULT_THROUGHPUT = (10, 20)
+
+# Seconds for a VM to start and pull the Docker image
+STARTUP_SECONDS = 150
+
+# MB per second at which inputs are copied to (and outputs from) the VM
+COPY_RATE = 100
+
+# US dollars per GB of egress between regions of a continent, and between
+# continents
+INTER_REGION_PRICE = 0.01
+INTER_CONTINENT_PRICE = 0.08
+
+# Default cores and memory (GB) of a pipeline VM
+_DEFAULT_CORES = 1
+_DEFAULT_RAM_GB = 3.75
+
+# Multi-region bucket locations, and the prefix of their regions
+_MULTI_REGIONS = {'US': 'us-', 'EU': 'europe-', 'ASIA': 'asia-'}
+
+_GB = 1024 ** 3
+_MB = 1024 ** 2
+
+_TOTALED = ('bytes', 'vm_hours', 'disk_gb_hours', 'egress_gb', 'cost')
+
+
+def machine_type(cores, memory):
+  """Returns the cheapest predefined machine type with at least the cores
+  and memory (GB), or the largest if none has."""
+
+  fitting = [(price, name) for name, machine_cores, machine_memory, price
+             in resources.MACHINE_TYPES
+             if machine_cores >= cores and machine_memory >= memory]
+  if fitting:
+    return min(fitting)[1]
+  return max(resources.MACHINE_TYPES, key=lambda m: (m[1], m[2]))[0]
+
+
+def egress_price(location, region):
+  """Returns the US dollars per GB to read from a bucket location into a
+  region; None if the location is not known."""
+
+  if not location:
+    return None
+
+  location = location.upper()
+  continent = region.split('-')[0]
+  if location in _MULTI_REGIONS:
+    if region.startswith(_MULTI_REGIONS[location]):
+      return 0.0
+    bucket_continent = _MULTI_REGIONS[location].rstrip('-')
+  else:
+    if location == region.upper():
+      return 0.0
+    bucket_continent = location.lower().split('-')[0]
+
+  # The northamerica- regions are billed as the US
+  same = set([continent, bucket_continent]) <= set(['us', 'northamerica'])
+  if continent == bucket_continent or same:
+    return INTER_REGION_PRICE
+  return INTER_CONTINENT_PRICE
+
+
+def _localized_bytes(body, sizes):
+  """Returns the bytes of the inputs which are copied to the VM's disk."""
+
+  parameters = dict((p['name'], p) for p in
+                    body.get('ephemeralPipeline', {}).get('inputParameters',
+                                                          []))
+  inputs = body.get('pipelineArgs', {}).get('inputs', {})
+  return sum(sizes.get(path, 0) for name, path in inputs.items()
+             if 'localCopy' in parameters.get(name, {}))
+
+
+class Planner(object):
+  """Collects the requests of a batch, with their inputs and estimates."""
+
+  def __init__(self, store, recommender=None, throughput=None):
+    """Creates a planner.
+
+    Args:
+        store: gcs.GcsStore or gcs.LocalStore, used to size inputs and find
+          their bucket locations; it must be thread-safe
+        recommender: optional resources.Recommender, whose models of past
+          runs calibrate the run times
+        throughput: optional dict of pipeline name -> (seconds of setup, MB
+          per second), overriding THROUGHPUT
+    """
+    self._store = store
+    self._recommender = recommender
+    self._throughput = dict(THROUGHPUT)
+    self._throughput.update(throughput or {})
+    self._locations = {}  # bucket -> location
+    self._pipeline = None
+    self._calibrated = False
+    self._requests = []
+
+  def _location(self, path):
+    bucket = path.split('/')[2]
+    if bucket not in self._locations:
+      self._locations[bucket] = self._store.bucket_location(path)
+    return self._locations[bucket]
+
+  def _runtime(self, name, body, sizes, cores):
+    size = sum(sizes.values())
+    model = self._recommender.model(name) if self._recommender else None
+    if model is not None:
+      self._calibrated = True
+      return model.predict(size, cores)
+
+    setup, rate = self._throughput.get(name, DEFAULT_THROUGHPUT)
+    copied = _localized_bytes(body, sizes)
+    return (STARTUP_SECONDS + setup + copied / float(COPY_RATE * _MB) +
+            size / float(rate * _MB))
+
+  def _egress(self, body, sizes):
+    """Returns (GB, US dollars) of input egress in the worst region the
+    request may run in."""
+
+    regions = defaults.get_regions(scheduler.get_zones(body))
+    worst = (0.0, 0.0)
+    for region in regions:
+      gb = cost = 0.0
+      for path, size in sizes.items():
+        price = egress_price(self._location(path), region)
+        if price:
+          gb += size / float(_GB)
+          cost += size / float(_GB) * price
+      worst = max(worst, (cost, gb))
+    return worst[1], worst[0]
+
+  def estimate(self, body):
+    """Returns (a dict of input path -> bytes, the estimate) for a request;
+    the estimate is described in the module docstring."""
+
+    sizes = resources.input_sizes(self._store, body)
+    size = sum(sizes.values())
+
+    requested = resources.request_resources(body)
+    cores = requested.get('minimumCpuCores') or _DEFAULT_CORES
+    memory = requested.get('minimumRamGb') or _DEFAULT_RAM_GB
+    disk_gb = scheduler.get_demand(body)[scheduler.DISKS_TOTAL_GB]
+    name = body['ephemeralPipeline'].get('name')
+
+    vm = machine_type(cores, memory)
+    runtime = self._runtime(name, body, sizes, cores)
+    billed = max(resources.MIN_BILLED_SECONDS,
+                 math.ceil(runtime / 60.0) * 60) / 3600.0
+    egress_gb, egress_cost = self._egress(body, sizes)
+
+    return sizes, {
+      'machine_type': vm,
+      'cores': cores,
+      'memory': memory,
+      'disk_gb': disk_gb,
+      'bytes': size,
+      'runtime': int(math.ceil(runtime)),
+      'vm_hours': round(billed, 4),
+      'disk_gb_hours': round(disk_gb * billed, 2),
+      'egress_gb': round(egress_gb, 3),
+      'cost': round(resources.billed_cost(vm, disk_gb, runtime) +
+                    egress_cost, 4),
+    }
+
+  def add(self, body):
+    """Adds a request to the plan; returns its estimate."""
+
+    sizes, estimate = self.estimate(body)
+    inputs = body.get('pipelineArgs', {}).get('inputs', {})
+    self._pipeline = self._pipeline or body['ephemeralPipeline'].get('name')
+    self._requests.append({
+      'body': body,
+      'inputs': [{'name': name, 'path': inputs[name],
+                  'bytes': sizes.get(inputs[name])}
+                 for name in sorted(inputs) if inputs[name] in sizes],
+      'estimate': estimate,
+    })
+    return estimate
+
+  def plan(self):
+    """Returns the plan of the requests added."""
+
+    totals = dict((key, 0) for key in _TOTALED)
+    for request in self._requests:
+      for key in _TOTALED:
+        totals[key] += request['estimate'][key]
+    for key in ('vm_hours', 'disk_gb_hours', 'egress_gb', 'cost'):
+      totals[key] = round(totals[key], 4)
+    totals['requests'] = len(self._requests)
+    totals['runtime'] = max([r['estimate']['runtime']
+                             for r in self._requests] or [0])
+
+    return {
+      'version': PLAN_VERSION,
+      'pipeline': self._pipeline,
+      'created': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+      'calibrated': self._calibrated,
+      'requests': self._requests,
+      'totals': totals,
+    }
+
+  def write(self, path):
+    """Writes the plan as JSON to a local path; returns it."""
+
+    plan = self.plan()
+    with open(path, 'w') as f:
+      json.dump(plan, f, indent=2, sort_keys=True)
+    return plan
+
+
+def read(path):
+  """Returns a plan read from a local path."""
+
+  with open(path) as f:
+    plan = json.load(f)
+  if plan.get('version') != PLAN_VERSION:
+    raise ValueError('Unsupported plan version %s in %s' %
+                     (plan.get('version'), path))
+  return plan
+
+
+def summary(plan):
+  """Returns a short description of a plan's totals."""
+
+  totals = plan['totals']
+  return ('%d requests over %.1f GB of input: %.1f VM-hours, '
+          '%.1f disk GB-hours, %.1f GB egress, about $%.2f '
+          '(longest run %d minutes, %s)' % (
+              totals['requests'], totals['bytes'] / float(_GB),
+              totals['vm_hours'], totals['disk_gb_hours'],
+              totals['egress_gb'], totals['cost'],
+              totals['runtime'] / 60,
+              'calibrated from past runs' if plan['calibrated']
+              else 'from the throughput table'))
@@ -6,8 +6,23 @@
 # license that can be found in the LICENSE file or at
 # https://developers.google.com/open-source/licenses/bsd
 
+import atexit
+import multiprocessing.pool
+import sys
+import threading
 import time
 
+from pipelines_pylib import metrics
+
+# Number of operations fetched concurrently by get_operations()
+DEFAULT_WORKERS = 8
+
+# Thread pools of get_operations(), by number of workers. They live as long
+# as the process, so that each thread keeps its Http connection (and service,
+# from a clients.ClientPool) from one call to the next.
+_pools = {}
+_pools_lock = threading.Lock()
+
 def poll(service, operation, poll_interval):
   """Poll a genomics operation until completion.
 
@@ -23,14 +38,79 @@ def poll(service, operation, poll_interval):
   print
   print "Polling for completion of operation"
 
+  wait_timer = metrics.timer('poller.wait').start()
   while not operation['done']:
     print "Operation not complete. Sleeping %d seconds" % (poll_interval)
 
     time.sleep(poll_interval)
 
-    operation = service.operations().get(name=operation['name']).execute()
+    with metrics.timer('poller.poll'):
+      operation = service.operations().get(name=operation['name']).execute()
+  wait_timer.stop()
 
   print
   print "Operation complete"
   print
   return operation
+
+
+def _pool(workers):
+  """Returns the shared thread pool with the given number of workers."""
+
+  with _pools_lock:
+    if not _pools:
+      atexit.register(shutdown)
+    if workers not in _pools:
+      _pools[workers] = multiprocessing.pool.ThreadPool(workers)
+    return _pools[workers]
+
+
+def shutdown():
+  """Stops the threads of get_operations(), once their fetches finish. Called
+  at exit; later calls start new threads."""
+
+  with _pools_lock:
+    pools = _pools.values()
+    _pools.clear()
+  for pool in pools:
+    pool.close()
+    pool.join()
+
+
+def _get_operation(service, name):
+  """Returns an operation object, or None (reporting the error) if it could
+  not be fetched."""
+
+  try:
+    return service.operations().get(name=name).execute()
+  except Exception as e:  # pylint: disable=broad-except
+    metrics.count('poller.errors')
+    print >> sys.stderr, "ERROR: fetching operation %s: %s" % (name, e)
+    return None
+
+
+def get_operations(service, names, workers=DEFAULT_WORKERS):
+  """Fetch the current state of many genomics operations concurrently.
+
+  The fetches run on a thread pool shared by all callers with the same
+  number of workers, which lives until shutdown() (at exit).
+
+  Args:
+      service: genomics service endpoint, which must be safe to use from
+        multiple threads (such as one from clients.ClientPool.service()).
+      names: list of operation names.
+      workers: number of concurrent requests.
+
+  Returns:
+      The list of operation objects, in the order of names. An operation
+      which could not be fetched is reported on stderr and left out, so
+      that one error does not fail the rest; callers fetch it again later.
+  """
+
+  metrics.count('poller.operations_fetched', len(names))
+  if len(names) <= 1:
+    operations = [_get_operation(service, name) for name in names]
+  else:
+    operations = _pool(workers).map(
+        lambda name: _get_operation(service, name), names)
+  return [operation for operation in operations if operation is not None]
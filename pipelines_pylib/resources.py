@@ -0,0 +1,419 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Machine type and disk recommendations from past runs of a pipeline.
+
+The launchers request a fixed number of cores and amount of memory (or the
+API defaults), however large the inputs. The Recommender instead learns, from
+the successful runs of a pipeline in an operations mirror (see mirror.py),
+how its run time depends on the bytes of input and the cores of the VM:
+
+  runtime = a + b * input_bytes + c * input_bytes / cores
+
+(c is only fitted when the history includes runs with different numbers of
+cores; otherwise the run time is assumed not to depend on them). It then
+proposes the cheapest predefined machine type whose predicted run time meets
+a target, with at least the memory of a past successful run over as much
+input, and a disk sized for the inputs.
+
+The Pipelines API does not record the CPU or memory used by a run, so the
+memory proposed is that of the machines which succeeded, not a measurement.
+
+The bytes of input of each run are taken from its "input-bytes" label, which
+apply() sets on each request, or else by listing its inputs.
+
+Typical usage:
+
+  ops = mirror.OperationsMirror('operations.db')
+  ops.sync(service, project)
+  recommender = resources.Recommender(ops, store, target_runtime=3600)
+  body, recommendation = recommender.apply(body)
+"""
+
+import copy
+import math
+import multiprocessing.pool
+import re
+
+from pipelines_pylib import cache
+from pipelines_pylib import gcs
+from pipelines_pylib import journal
+from pipelines_pylib import metrics
+from pipelines_pylib import util
+
+# Predefined machine types: (name, cores, memory in GB, US dollars per hour)
+# at us-central1 on-demand prices.
+MACHINE_TYPES = [
+  ("n1-standard-1", 1, 3.75, 0.0475),
+  ("n1-standard-2", 2, 7.5, 0.095),
+  ("n1-standard-4", 4, 15, 0.19),
+  ("n1-standard-8", 8, 30, 0.38),
+  ("n1-standard-16", 16, 60, 0.76),
+  ("n1-standard-32", 32, 120, 1.52),
+  ("n1-highmem-2", 2, 13, 0.1184),
+  ("n1-highmem-4", 4, 26, 0.2368),
+  ("n1-highmem-8", 8, 52, 0.4736),
+  ("n1-highmem-16", 16, 104, 0.9472),
+  ("n1-highmem-32", 32, 208, 1.8944),
+  ("n1-highcpu-2", 2, 1.8, 0.0709),
+  ("n1-highcpu-4", 4, 3.6, 0.1418),
+  ("n1-highcpu-8", 8, 7.2, 0.2836),
+  ("n1-highcpu-16", 16, 14.4, 0.5672),
+  ("n1-highcpu-32", 32, 28.8, 1.1344),
+]
+
+# US dollars per GB-hour of standard persistent disk
+DISK_PRICE = 0.04 / 730
+
+# Compute Engine bills a minimum of 10 minutes, then per minute
+MIN_BILLED_SECONDS = 600
+
+# Default target run time, in seconds
+DEFAULT_TARGET_RUNTIME = 3600
+
+# Default disk size, as a multiple of the input size (for the inputs and
+# outputs), plus headroom in GB
+DEFAULT_DISK_FACTOR = 2
+DISK_HEADROOM_GB = 10
+MIN_DISK_GB = 10
+
+# Default number of successful runs needed before recommending resources,
+# and the most recent runs considered
+DEFAULT_MIN_SAMPLES = 5
+DEFAULT_HISTORY = 200
+
+# Label recording the bytes of input of a request
+INPUT_BYTES_LABEL = 'input-bytes'
+
+_GB = 1024 ** 3
+
+_CUSTOM_MACHINE_TYPE = re.compile(r'^custom-(\d+)-(\d+)$')
+
+
+def machine_shape(machine_type):
+  """Returns (cores, memory in GB) for a machine type name (which may be a
+  URL or "<zone>/<name>"), or None if it is not known."""
+
+  name = machine_type.rsplit('/', 1)[-1]
+  for known, cores, memory, _ in MACHINE_TYPES:
+    if name == known:
+      return cores, memory
+
+  match = _CUSTOM_MACHINE_TYPE.match(name)
+  if match:
+    return int(match.group(1)), int(match.group(2)) / 1024.0
+  return None
+
+
+def billed_cost(machine_type, disk_gb, runtime):
+  """Returns the cost in US dollars of a VM of a predefined machine type,
+  with a disk, running for a number of seconds."""
+
+  price = [p for name, _, _, p in MACHINE_TYPES if name == machine_type][0]
+  billed = max(MIN_BILLED_SECONDS, math.ceil(runtime / 60.0) * 60)
+  return (price + disk_gb * DISK_PRICE) * billed / 3600.0
+
+
+def _input_paths(body):
+  inputs = cache.result_inputs(body)
+  return [value for value in inputs.values()
+          if isinstance(value, basestring) and value.startswith('gs://')]
+
+
+def _path_bytes(store, path):
+  if gcs.has_wildcard(path):
+    return sum(metadata['size'] for metadata in store.list(path))
+  metadata = store.stat(path)
+  return metadata['size'] if metadata else 0
+
+
+def input_sizes(store, body, workers=8):
+  """Returns the size of each Cloud Storage input of a request.
+
+  Args:
+      store: gcs.GcsStore or gcs.LocalStore; it must be thread-safe (see
+        clients.ClientPool)
+      body: pipelines().run() request body
+      workers: number of concurrent requests
+
+  Returns:
+      A dict of input path -> bytes (the total for a wildcard path).
+  """
+
+  paths = _input_paths(body)
+  if not paths:
+    return {}
+
+  pool = multiprocessing.pool.ThreadPool(min(workers, len(paths)))
+  try:
+    with metrics.timer('resources.input_bytes'):
+      return dict(zip(paths,
+                      pool.map(lambda path: _path_bytes(store, path), paths)))
+  finally:
+    pool.close()
+
+
+def input_bytes(store, body, workers=8):
+  """Returns the total size of the Cloud Storage inputs of a request (see
+  input_sizes())."""
+
+  return sum(input_sizes(store, body, workers).values())
+
+
+def request_resources(body):
+  """Returns the pipeline resources of a request, overridden by its
+  pipelineArgs resources."""
+
+  merged = dict(body.get('ephemeralPipeline', {}).get('resources', {}))
+  merged.update(body.get('pipelineArgs', {}).get('resources', {}))
+  return merged
+
+
+def run_sample(operation, store=None):
+  """Returns the input bytes, cores, memory and run time (from start to end)
+  of a completed operation, or None if they are not known.
+
+  Args:
+      operation: operation object
+      store: optional gcs.GcsStore or gcs.LocalStore, used to size the
+        inputs of an operation without an "input-bytes" label
+  """
+
+  metadata = operation.get('metadata', {})
+  if not metadata.get('endTime'):
+    return None
+
+  request = metadata.get('request', {})
+  labels = metadata.get('labels', {})
+  if INPUT_BYTES_LABEL in labels:
+    size = int(labels[INPUT_BYTES_LABEL])
+  elif store:
+    size = input_bytes(store, request)
+  else:
+    return None
+
+  compute_engine = metadata.get('runtimeMetadata', {}).get('computeEngine', {})
+  shape = machine_shape(compute_engine.get('machineType', ''))
+  if shape is None:
+    resources = request_resources(request)
+    shape = (resources.get('minimumCpuCores', 1),
+             resources.get('minimumRamGb', 3.75))
+
+  start = metadata.get('startTime') or metadata['createTime']
+  runtime = (util.parse_timestamp(metadata['endTime']) -
+             util.parse_timestamp(start))
+
+  return {'bytes': size, 'cores': shape[0], 'memory': shape[1],
+          'runtime': runtime}
+
+
+def _solve(matrix, vector):
+  """Solves a small linear system by Gaussian elimination, or returns None
+  if it is singular."""
+
+  n = len(vector)
+  rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+  for col in range(n):
+    pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+    if abs(rows[pivot][col]) < 1e-12:
+      return None
+    rows[col], rows[pivot] = rows[pivot], rows[col]
+    for r in range(n):
+      if r != col:
+        factor = rows[r][col] / rows[col][col]
+        rows[r] = [a - factor * b for a, b in zip(rows[r], rows[col])]
+  return [rows[i][n] / rows[i][i] for i in range(n)]
+
+
+def _least_squares(features, targets):
+  """Returns the least squares coefficients for rows of features, or None
+  if they are not determined."""
+
+  n = len(features[0])
+  normal = [[sum(row[i] * row[j] for row in features) for j in range(n)]
+            for i in range(n)]
+  moments = [sum(row[i] * t for row, t in zip(features, targets))
+             for i in range(n)]
+  return _solve(normal, moments)
+
+
+class RuntimeModel(object):
+  """Least squares model of a pipeline's run time from its input bytes and
+  cores."""
+
+  def __init__(self, samples):
+    """Fits the model to samples (as returned by run_sample()).
+
+    Coefficients which would make run time fall with more input are dropped,
+    as is the per-core term when all the samples ran with the same cores.
+    """
+
+    self.samples = samples
+    scales = len(set(sample['cores'] for sample in samples)) > 1
+    terms = ['fixed', 'bytes'] + (['per_core'] if scales else [])
+
+    # Input bytes are fitted in GB, to keep the system well conditioned
+    def features(sample, terms):
+      values = {'fixed': 1.0,
+                'bytes': sample['bytes'] / float(_GB),
+                'per_core': sample['bytes'] / float(_GB) / sample['cores']}
+      return [values[term] for term in terms]
+
+    targets = [sample['runtime'] for sample in samples]
+    coefficients = None
+    while terms:
+      coefficients = _least_squares([features(s, terms) for s in samples],
+                                    targets)
+      if coefficients is None:
+        terms.pop()
+        continue
+      negative = [term for term, value in zip(terms, coefficients)
+                  if value < 0 and term != 'fixed']
+      if not negative:
+        break
+      terms.remove(negative[-1])
+
+    self.coefficients = dict(zip(terms, coefficients or []))
+
+  def predict(self, size, cores):
+    """Returns the predicted run time in seconds for input bytes and
+    cores."""
+
+    gb = size / float(_GB)
+    return max(0.0, self.coefficients.get('fixed', 0) +
+               self.coefficients.get('bytes', 0) * gb +
+               self.coefficients.get('per_core', 0) * gb / cores)
+
+
+class Recommender(object):
+  """Recommends machine types and disks for pipeline requests."""
+
+  def __init__(self, operations_mirror, store,
+               target_runtime=DEFAULT_TARGET_RUNTIME,
+               disk_factor=DEFAULT_DISK_FACTOR,
+               min_samples=DEFAULT_MIN_SAMPLES, history=DEFAULT_HISTORY):
+    """Creates a recommender.
+
+    Args:
+        operations_mirror: mirror.OperationsMirror of past operations (which
+          the caller should sync first)
+        store: gcs.GcsStore or gcs.LocalStore, used to size inputs
+        target_runtime: run time, in seconds, that recommendations should
+          meet
+        disk_factor: disk size as a multiple of the input size
+        min_samples: successful runs of a pipeline needed before making
+          recommendations for it
+        history: most recent successful runs considered
+    """
+    self._mirror = operations_mirror
+    self._store = store
+    self._target_runtime = target_runtime
+    self._disk_factor = disk_factor
+    self._min_samples = min_samples
+    self._history = history
+    self._models = {}
+
+  def model(self, pipeline_name):
+    """Returns the RuntimeModel for a pipeline, or None if it has too few
+    successful runs."""
+
+    if pipeline_name not in self._models:
+      samples = []
+      for row in self._mirror.query(pipeline_name=pipeline_name,
+                                    state=journal.STATE_SUCCEEDED,
+                                    limit=self._history):
+        sample = run_sample(row['operation'], self._store)
+        if sample:
+          samples.append(sample)
+
+      self._models[pipeline_name] = (RuntimeModel(samples)
+                                     if len(samples) >= self._min_samples
+                                     else None)
+    return self._models[pipeline_name]
+
+  def recommend(self, body, size=None, min_cores=1):
+    """Returns the cheapest resources predicted to run a request within the
+    target run time.
+
+    If no machine type meets the target, the one with the shortest predicted
+    run time (then the cheapest) is recommended.
+
+    Args:
+        body: pipelines().run() request body
+        size: the request's input bytes, if already known
+        min_cores: fewest cores to recommend (such as the threads that the
+          pipeline's command uses)
+
+    Returns:
+        A dict with the machine_type, cores, memory (GB), disk_gb, input
+        bytes, predicted runtime (seconds), cost (US dollars) and whether it
+        meets_target; or None if the pipeline has too few successful runs.
+    """
+
+    model = self.model(body['ephemeralPipeline'].get('name'))
+    if model is None:
+      return None
+    if size is None:
+      size = input_bytes(self._store, body)
+
+    # Memory of a past success over at least as much input (or, if none was
+    # as large, the most memory of any success)
+    larger = [s['memory'] for s in model.samples if s['bytes'] >= size]
+    memory = (min(larger) if larger
+              else max(s['memory'] for s in model.samples))
+
+    disk_gb = max(MIN_DISK_GB, int(math.ceil(size * self._disk_factor /
+                                             float(_GB))) + DISK_HEADROOM_GB)
+
+    candidates = []
+    for name, cores, machine_memory, _ in MACHINE_TYPES:
+      if cores < min_cores or machine_memory < memory:
+        continue
+      runtime = model.predict(size, cores)
+      candidates.append({
+        'machine_type': name,
+        'cores': cores,
+        'memory': machine_memory,
+        'disk_gb': disk_gb,
+        'bytes': size,
+        'runtime': runtime,
+        'cost': billed_cost(name, disk_gb, runtime),
+        'meets_target': runtime <= self._target_runtime,
+      })
+    if not candidates:
+      return None
+
+    meeting = [c for c in candidates if c['meets_target']]
+    if meeting:
+      return min(meeting, key=lambda c: (c['cost'], c['runtime']))
+    return min(candidates, key=lambda c: (c['runtime'], c['cost']))
+
+  def apply(self, body, min_cores=1):
+    """Returns a copy of a request with the recommended resources, labelled
+    with its input bytes, and the recommendation (None if there was none,
+    in which case only the label is added)."""
+
+    size = input_bytes(self._store, body)
+    recommendation = self.recommend(body, size, min_cores)
+
+    result = copy.deepcopy(body)
+    pipeline_args = result['pipelineArgs']
+    pipeline_args.setdefault('labels', {})[INPUT_BYTES_LABEL] = str(size)
+    if recommendation:
+      metrics.count('resources.recommended')
+      resources = pipeline_args.setdefault('resources', {})
+      resources['minimumCpuCores'] = recommendation['cores']
+      resources['minimumRamGb'] = recommendation['memory']
+      disks = resources.get('disks') or [
+          {'name': disk['name']} for disk in
+          result['ephemeralPipeline'].get('resources', {}).get('disks', [])]
+      for disk in disks:
+        disk['sizeGb'] = recommendation['disk_gb']
+      resources['disks'] = disks
+
+    return result, recommendation
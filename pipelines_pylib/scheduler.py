@@ -0,0 +1,398 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Quota-aware admission of bulk pipeline submissions.
+
+Submitting thousands of pipelines at once exhausts regional Compute Engine
+quotas (CPUs, total disk GB, in-use IP addresses). Operations which cannot get
+resources fail or sit queued, and get_zones() spreads requests over regions
+without regard to how much headroom each region has.
+
+The QuotaScheduler holds pending request bodies in a priority queue. A request
+is admitted only when one of the regions it may run in has enough quota left
+for the CPUs, disk and address it will use; the request is then restricted to
+the zones of that region. Quota is returned as operations complete. A token
+bucket additionally caps the rate of pipelines().run() calls.
+
+Typical usage:
+
+  client_pool = clients.ClientPool()
+  service = client_pool.service('genomics', 'v1alpha2')
+  compute = client_pool.service('compute', 'v1')
+  limits = scheduler.fetch_quotas(compute, 'my-project', ['us-central1', 'us-east1'])
+  sched = scheduler.QuotaScheduler(service, limits, submit_rate=5)
+  for body in bodies:
+    sched.add(body)
+  completed_ops = sched.run(poll_interval=30)
+
+A jobs.PipelineClient given a scheduler instead submits each request with
+submit(), which blocks the client's submitting thread until a region has
+quota for it, and releases the quota as the client sees the operation
+complete. The launchers do this with --quota-regions.
+"""
+
+import copy
+import heapq
+import threading
+import time
+
+from pipelines_pylib import defaults
+from pipelines_pylib import journal as journal_lib
+from pipelines_pylib import poller
+
+# Compute Engine quota metrics tracked by the scheduler
+CPUS = 'CPUS'
+DISKS_TOTAL_GB = 'DISKS_TOTAL_GB'
+IN_USE_ADDRESSES = 'IN_USE_ADDRESSES'
+
+_METRICS = (CPUS, DISKS_TOTAL_GB, IN_USE_ADDRESSES)
+
+# Values the Pipelines API uses when a request does not specify them
+_DEFAULT_CPUS = 1
+_DEFAULT_BOOT_DISK_GB = 10
+_DEFAULT_DISK_GB = 500
+
+
+def fetch_quotas(compute, project, regions):
+  """Returns the remaining quota for each region.
+
+  Args:
+      compute: compute service endpoint
+      project: Cloud project id
+      regions: list of region names
+
+  Returns:
+      A dict of region -> dict of metric -> (limit - usage).
+  """
+
+  limits = {}
+  for region in regions:
+    info = compute.regions().get(project=project, region=region).execute()
+    limits[region] = {
+      quota['metric']: quota['limit'] - quota['usage']
+      for quota in info.get('quotas', []) if quota['metric'] in _METRICS
+    }
+  return limits
+
+
+def _merged_resources(body):
+  """Returns the request resources, with pipelineArgs overriding the template."""
+
+  resources = dict(body.get('ephemeralPipeline', {}).get('resources', {}))
+  overrides = body.get('pipelineArgs', {}).get('resources', {})
+
+  disks = {}
+  for disk in resources.get('disks', []) + overrides.get('disks', []):
+    disks.setdefault(disk['name'], {}).update(disk)
+
+  resources.update(overrides)
+  resources['disks'] = disks.values()
+  return resources
+
+
+def get_demand(body):
+  """Returns the quota a pipelines().run() request body will consume.
+
+  Returns:
+      A dict of metric -> amount.
+  """
+
+  resources = _merged_resources(body)
+
+  disk_gb = resources.get('bootDiskSizeGb') or _DEFAULT_BOOT_DISK_GB
+  for disk in resources['disks']:
+    disk_gb += disk.get('sizeGb') or _DEFAULT_DISK_GB
+
+  return {
+    CPUS: resources.get('minimumCpuCores') or _DEFAULT_CPUS,
+    DISKS_TOTAL_GB: disk_gb,
+    IN_USE_ADDRESSES: 0 if resources.get('noAddress') else 1,
+  }
+
+
+def get_zones(body):
+  """Returns the zones a request body is allowed to run in (empty for any)."""
+
+  return _merged_resources(body).get('zones') or []
+
+
+def restrict_to_region(body, region):
+  """Returns a copy of the request body with its zones limited to one region.
+
+  If the request did not list zones, all known zones in the region are used.
+  """
+
+  zones = [z for z in get_zones(body) if defaults.get_region(z) == region]
+  if not zones:
+    zones = defaults.get_zones(['%s-*' % region])
+
+  restricted = copy.deepcopy(body)
+  restricted.setdefault('pipelineArgs', {}).setdefault(
+      'resources', {})['zones'] = zones
+  return restricted
+
+
+class TokenBucket(object):
+  """Limits the rate of an action to `rate` per second, with bursts."""
+
+  def __init__(self, rate, capacity=None):
+    self._rate = float(rate)
+    self._capacity = float(capacity or rate)
+    self._tokens = self._capacity
+    self._last = time.time()
+    self._lock = threading.Lock()
+
+  def _refill(self):
+    now = time.time()
+    self._tokens = min(self._capacity,
+                       self._tokens + (now - self._last) * self._rate)
+    self._last = now
+
+  def take(self):
+    """Blocks until a token is available and consumes it. Callers wait
+    without holding the lock, so each takes the next token as it comes."""
+
+    while True:
+      with self._lock:
+        self._refill()
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        wait = (1 - self._tokens) / self._rate
+      time.sleep(wait)
+
+
+class QuotaScheduler(object):
+  """Admits pipeline requests as regional quota allows."""
+
+  def __init__(self, service, limits, submit_rate=None, journal=None):
+    """Creates a scheduler.
+
+    Args:
+        service: genomics service endpoint; running operations are polled
+          concurrently, so it must be thread-safe (see clients.ClientPool)
+        limits: dict of region -> dict of metric -> available amount, as
+          returned by fetch_quotas() or configured by hand. Metrics not listed
+          for a region are not limited.
+        submit_rate: optional maximum pipelines().run() calls per second
+        journal: optional journal.Journal in which to record submissions
+
+    Raises:
+        ValueError: if limits name a metric other than CPUS, DISKS_TOTAL_GB
+          and IN_USE_ADDRESSES.
+    """
+    for region, region_limits in limits.items():
+      unknown = set(region_limits) - set(_METRICS)
+      if unknown:
+        raise ValueError('Unknown quota metrics for %s: %s' %
+                         (region, ', '.join(sorted(unknown))))
+
+    self._service = service
+    self._limits = limits
+    self._in_use = {region: dict.fromkeys(_METRICS, 0) for region in limits}
+    self._bucket = TokenBucket(submit_rate) if submit_rate else None
+    self._journal = journal
+
+    self._pending = []
+    self._sequence = 0
+
+    # operation name -> (region, demand), charged once per operation
+    self._running = {}
+
+    # Held by submit() callers; quota of requests being submitted is held
+    # in _in_use, and counted in _submitting
+    self._condition = threading.Condition()
+    self._submitting = 0
+
+  def add(self, body, priority=0):
+    """Queues a request body. Higher priority requests are admitted first."""
+
+    heapq.heappush(self._pending, (-priority, self._sequence, body))
+    self._sequence += 1
+
+  def headroom(self, region):
+    """Returns the remaining quota of a region, accounting for admitted work."""
+
+    return {metric: self._limits[region][metric] - self._in_use[region][metric]
+            for metric in self._limits[region]}
+
+  def _pick_region(self, body):
+    """Returns the allowed region with the most CPU headroom that fits the
+    request, or None if no allowed region fits."""
+
+    demand = get_demand(body)
+    zones = get_zones(body)
+    regions = defaults.get_regions(zones) if zones else self._limits.keys()
+
+    best = None
+    for region in regions:
+      if region not in self._limits:
+        continue
+
+      headroom = self.headroom(region)
+      if any(demand[metric] > headroom[metric] for metric in headroom):
+        continue
+
+      cpus = headroom.get(CPUS, float('inf'))
+      if best is None or cpus > best[0]:
+        best = (cpus, region)
+
+    return best[1] if best else None
+
+  def admit(self):
+    """Submits every queued request which fits in the remaining quota.
+
+    Requests which do not fit stay queued in priority order; a large request
+    does not block smaller ones behind it.
+
+    Returns:
+        The list of operations submitted.
+    """
+
+    submitted = []
+    deferred = []
+
+    while self._pending:
+      item = heapq.heappop(self._pending)
+      operation = self.submit(item[2], block=False)
+      if operation is None:
+        deferred.append(item)
+      else:
+        submitted.append(operation)
+
+    for item in deferred:
+      heapq.heappush(self._pending, item)
+
+    return submitted
+
+  def _add_use(self, region, demand, sign=1):
+    for metric in _METRICS:
+      self._in_use[region][metric] += sign * demand[metric]
+
+  def _charge(self, operation, region, demand):
+    """Holds quota of a region for an operation. An operation resumed from
+    the journal by several identical requests is charged only once, as it is
+    released once."""
+
+    with self._condition:
+      if operation['name'] in self._running:
+        return
+      self._add_use(region, demand)
+      self._running[operation['name']] = (region, demand)
+
+  def submit(self, body, run=None, block=True):
+    """Waits until a region has quota for a request, then submits it
+    restricted to that region. Unlike add(), this may be called from several
+    threads at once; the quota is returned by release(). admit() submits
+    the queued requests with it.
+
+    Args:
+        body: pipelines().run() request body
+        run: optional callable which submits a request body and returns its
+          operation object; by default journal.submit() with the
+          scheduler's service and journal
+        block: whether to wait for quota; if False and no region has quota,
+          None is returned
+
+    Returns:
+        The operation object.
+
+    Raises:
+        ValueError: if the request cannot fit in any allowed region even
+          with no other work running.
+    """
+
+    demand = get_demand(body)
+    with self._condition:
+      region = self._pick_region(body)
+      while not region:
+        if not block:
+          return None
+        if not self._running and not self._submitting:
+          raise ValueError('Request exceeds the quota of all allowed '
+                           'regions: %s' % demand)
+        # Wait with a timeout, so that a KeyboardInterrupt is seen
+        self._condition.wait(1)
+        region = self._pick_region(body)
+      # Hold the quota while the request is submitted
+      self._add_use(region, demand)
+      self._submitting += 1
+
+    operation = None
+    try:
+      if self._bucket:
+        self._bucket.take()
+      restricted = restrict_to_region(body, region)
+      if run:
+        operation = run(restricted)
+      else:
+        operation = journal_lib.submit(self._service, restricted,
+                                       self._journal)
+    finally:
+      with self._condition:
+        self._submitting -= 1
+        self._add_use(region, demand, sign=-1)
+        if operation is not None:
+          self._charge(operation, region, demand)
+        self._condition.notify_all()
+
+    # A resumed operation may already be done
+    if operation.get('done'):
+      self.release(operation)
+    return operation
+
+  def release(self, operation):
+    """Returns the quota held by a completed operation (if not already
+    returned)."""
+
+    with self._condition:
+      held = self._running.pop(operation['name'], None)
+      if held is None:
+        return
+      self._add_use(*held, sign=-1)
+      self._condition.notify_all()
+
+    if self._journal:
+      self._journal.update(operation)
+
+  def run(self, poll_interval):
+    """Submits all queued requests, admitting more as running ones complete.
+
+    Args:
+        poll_interval: seconds between checks of running operations.
+
+    Returns:
+        The list of completed operation objects.
+
+    Raises:
+        ValueError: if a queued request cannot fit in any allowed region even
+          with no other work running.
+    """
+
+    completed = []
+
+    while self._pending or self._running:
+      for operation in self.admit():
+        if operation['done']:
+          self.release(operation)
+          completed.append(operation)
+
+      if self._pending and not self._running:
+        raise ValueError('Request exceeds the quota of all allowed regions: %s'
+                         % get_demand(self._pending[0][2]))
+
+      if self._running:
+        time.sleep(poll_interval)
+
+      for operation in poller.get_operations(self._service,
+                                             list(self._running)):
+        if operation['done']:
+          self.release(operation)
+          completed.append(operation)
+
+    return completed
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Straggler detection and speculative re-execution for batches of pipelines.
+
+In a large batch, a few operations can hang (in localization, or on a bad
+VM) long after the rest have finished, and hold up the whole batch. The
+BatchSupervisor watches the futures of a batch submitted with a
+jobs.PipelineClient and learns the distribution of run times of each
+pipeline (by pipeline name) from the operations which succeed, along with
+any earlier runs recorded in a journal. An operation which has run for
+longer than a percentile of that distribution (times a multiplier) is
+treated as a straggler: a duplicate of its request is submitted through the
+same client, restricted to the request's other zones. Whichever of the two
+succeeds first is kept and the other is cancelled.
+
+The duplicate writes the same outputs to the same locations as the
+original, so speculation is only suitable for pipelines whose outputs
+are determined by their inputs.
+
+Typical usage:
+
+  client = jobs.PipelineClient(service, poll_interval=30)
+  supervisor = speculation.BatchSupervisor(client, percentile=90)
+  for body in bodies:
+    supervisor.add(client.run(body))
+  completed_ops = supervisor.run(poll_interval=30)
+  client.close()
+"""
+
+import copy
+import math
+import time
+
+from pipelines_pylib import metrics
+from pipelines_pylib import util
+
+# Default percentile of past run times beyond which an operation straggles
+DEFAULT_PERCENTILE = 90
+
+# Default factor applied to the percentile to give the straggler threshold
+DEFAULT_MULTIPLIER = 1.5
+
+# Default number of run times needed before any operation is considered a
+# straggler
+DEFAULT_MIN_SAMPLES = 5
+
+def percentile(values, p):
+  """Returns the p-th percentile of a list of values (nearest rank)."""
+
+  ordered = sorted(values)
+  rank = int(math.ceil(p / 100.0 * len(ordered)))
+  return ordered[max(rank, 1) - 1]
+
+
+def operation_runtime(operation, now=None):
+  """Returns the seconds from an operation's creation to its end (or to now,
+  if it has not ended)."""
+
+  metadata = operation.get('metadata', {})
+  end = metadata.get('endTime')
+  end_seconds = util.parse_timestamp(end) if end else (now or time.time())
+  return end_seconds - util.parse_timestamp(metadata['createTime'])
+
+
+def duplicate_request(body, exclude_zone):
+  """Returns a copy of a request body restricted to its zones other than
+  exclude_zone, or None if it has no other zones."""
+
+  zones = body.get('pipelineArgs', {}).get('resources', {}).get('zones')
+  if not zones:
+    zones = body['ephemeralPipeline'].get('resources', {}).get('zones')
+
+  other_zones = [zone for zone in zones or [] if zone != exclude_zone]
+  if not other_zones:
+    return None
+
+  duplicate = copy.deepcopy(body)
+  duplicate['pipelineArgs'].setdefault('resources', {})['zones'] = other_zones
+  return duplicate
+
+
+def _succeeded(future):
+  """Returns whether a done future's operation succeeded."""
+
+  return (not future.cancelled() and future.exception() is None and
+          'error' not in future.operation)
+
+
+class _Task(object):
+  """A request in the batch, and the futures of the operations running it."""
+
+  def __init__(self, body, future):
+    self.body = body
+    self.pipeline = body['ephemeralPipeline'].get('name')
+    self.attempts = [future]
+    self.result = None
+
+  def running(self):
+    return [future for future in self.attempts if not future.done()]
+
+
+class BatchSupervisor(object):
+  """Watches a batch of operations, duplicating stragglers."""
+
+  def __init__(self, client, percentile=DEFAULT_PERCENTILE,
+               multiplier=DEFAULT_MULTIPLIER, min_samples=DEFAULT_MIN_SAMPLES,
+               max_duplicates=None, journal=None):
+    """Creates a batch supervisor.
+
+    Args:
+        client: jobs.PipelineClient which submitted the batch, through which
+          duplicates are submitted (and journaled, if it has a journal)
+        percentile: percentile of the run time distribution of a pipeline
+          beyond which an operation may be a straggler
+        multiplier: factor applied to the percentile run time
+        min_samples: number of known run times of a pipeline needed before
+          its operations are checked for stragglers
+        max_duplicates: optional maximum number of duplicates to submit
+        journal: optional journal.Journal, whose earlier successful runs
+          seed the distribution
+    """
+    self._client = client
+    self._percentile = percentile
+    self._multiplier = multiplier
+    self._min_samples = min_samples
+    self._max_duplicates = max_duplicates
+    self._journal = journal
+
+    self._tasks = []
+    self._runtimes = {}
+    self.stats = {'duplicates': 0, 'duplicates_won': 0, 'cancelled': 0}
+
+  def add(self, future, body=None):
+    """Adds a request to the batch.
+
+    Args:
+        future: the jobs.OperationFuture of the request
+        body: the request body, if the future was not returned by
+          PipelineClient.run()
+    """
+
+    task = _Task(body or future.body, future)
+    if task.pipeline not in self._runtimes:
+      self._runtimes[task.pipeline] = (
+          self._journal.runtimes(task.pipeline) if self._journal else [])
+    self._tasks.append(task)
+
+  def threshold(self, pipeline):
+    """Returns the run time (in seconds) beyond which an operation of a
+    pipeline is a straggler, or None if too few run times are known."""
+
+    runtimes = self._runtimes.get(pipeline, [])
+    if len(runtimes) < self._min_samples:
+      return None
+    return percentile(runtimes, self._percentile) * self._multiplier
+
+  def _finish(self, task):
+    """Settles a task once one of its attempts has succeeded (cancelling the
+    others), or all of them have failed."""
+
+    done = [future for future in task.attempts if future.done()]
+    succeeded = [future for future in done if _succeeded(future)]
+    if not succeeded:
+      # Keep waiting for any other attempt; otherwise the task failed
+      if len(done) == len(task.attempts):
+        # Prefer an attempt which ran to one which was not submitted
+        ran = [future for future in done
+               if not future.cancelled() and future.exception() is None]
+        task.result = (ran or done)[-1]
+      return
+
+    winner = succeeded[0]
+    task.result = winner
+    self._runtimes[task.pipeline].append(operation_runtime(winner.operation))
+    if winner is not task.attempts[0]:
+      self.stats['duplicates_won'] += 1
+
+    # A cancelled operation completes (and is journaled) as it is next
+    # refreshed
+    for other in task.running():
+      print "Cancelling operation %s (%s finished first)" % (
+          other.name, winner.name)
+      other.cancel()
+      self.stats['cancelled'] += 1
+
+  def _speculate(self, task, now):
+    """Submits a duplicate of a task if its operation is straggling."""
+
+    if len(task.attempts) > 1:
+      return
+    if (self._max_duplicates is not None and
+        self.stats['duplicates'] >= self._max_duplicates):
+      return
+
+    threshold = self.threshold(task.pipeline)
+    operation = task.attempts[0].operation
+    if (threshold is None or operation is None or
+        'createTime' not in operation.get('metadata', {})):
+      return
+
+    runtime = operation_runtime(operation, now)
+    if runtime <= threshold:
+      return
+
+    duplicate = duplicate_request(task.body, util.operation_zone(operation))
+    if duplicate is None:
+      return
+
+    print ("Operation %s has run for %ds (threshold %ds); submitting a "
+           "duplicate in %s" % (operation['name'], runtime, threshold,
+                                ', '.join(duplicate['pipelineArgs']
+                                          ['resources']['zones'])))
+    task.attempts.append(self._client.run(duplicate))
+    self.stats['duplicates'] += 1
+    metrics.count('speculation.duplicates')
+
+  def run(self, poll_interval):
+    """Waits until every request has a completed operation, checking for
+    stragglers every poll interval (the client refreshes the operations).
+
+    Args:
+        poll_interval: seconds between checks.
+
+    Returns:
+        The list of completed operations, one per request in the order
+        added: the attempt which succeeded, or the last which failed.
+
+    Raises:
+        the exception raised by the submission of a request, if it failed
+    """
+
+    print
+    print "Supervising %d operations" % len(self._tasks)
+
+    while True:
+      for task in self._tasks:
+        if task.result is None:
+          self._finish(task)
+
+      pending = [task for task in self._tasks if task.result is None]
+      if not pending:
+        break
+
+      print "%d of %d operations not complete. Sleeping %d seconds" % (
+          len(pending), len(self._tasks), poll_interval)
+      time.sleep(poll_interval)
+
+      now = time.time()
+      for task in pending:
+        if not any(future.done() for future in task.attempts):
+          self._speculate(task, now)
+
+    print
+    print "Batch complete (%d duplicates submitted, %d won)" % (
+        self.stats['duplicates'], self.stats['duplicates_won'])
+    print
+    return [task.result.result() for task in self._tasks]
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""An access token cache shared between processes.
+
+Each launcher process loads the application default credentials and
+exchanges them for an access token of its own, so a scheduler that starts
+thousands of launchers makes thousands of token requests, each a round trip
+(and each counted against the token endpoint's rate limits).
+
+A FileTokenStore keeps the access token in a local JSON file, under an
+exclusive (fcntl) lock, for every process using the same credentials. A
+process which finds a token there with more than REFRESH_MARGIN seconds
+left uses it; otherwise it requests a new token while holding the lock, and
+the processes waiting on the lock then use the new token. Tokens are keyed
+by a hash of the credentials' identity (client, refresh token or service
+account, and scopes), so several identities can share a file.
+
+The store plugs into oauth2client's credentials storage (which it consults
+before every refresh), so clients.ClientPool uses it with:
+
+  client_pool = clients.ClientPool(token_cache='/tmp/pipelines-tokens.json')
+
+or, for every ClientPool in a process (and the processes it starts), by
+setting the PIPELINES_TOKEN_CACHE environment variable to the file's path.
+The file is created readable by its owner only.
+
+Credentials which do not refresh through their storage (such as those of a
+Compute Engine VM, whose tokens come from the local metadata server) are
+not cached.
+"""
+
+import calendar
+import copy
+import datetime
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+from oauth2client import client
+
+from pipelines_pylib import metrics
+
+# Environment variable naming the token cache file
+TOKEN_CACHE_ENV = 'PIPELINES_TOKEN_CACHE'
+
+# Seconds before its expiry that a cached token is replaced
+REFRESH_MARGIN = 300
+
+_IDENTITY_FIELDS = ('client_id', 'refresh_token', 'service_account_email',
+                    '_service_account_email', 'scopes', '_scopes',
+                    'token_uri')
+
+
+def credentials_key(credentials):
+  """Returns a hash of the identity of credentials, omitting their current
+  access token."""
+
+  identity = dict((field, getattr(credentials, field, None))
+                  for field in _IDENTITY_FIELDS)
+  identity['class'] = type(credentials).__name__
+  encoded = json.dumps(identity, sort_keys=True, default=str)
+  return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def _to_seconds(expiry):
+  return calendar.timegm(expiry.utctimetuple()) if expiry else None
+
+
+class FileTokenStore(client.Storage):
+  """Credentials storage whose access token is shared through a file."""
+
+  def __init__(self, path, credentials, refresh_margin=REFRESH_MARGIN):
+    """Creates a store.
+
+    Args:
+        path: path of the token cache file; a lock file is kept next to it
+        credentials: oauth2client credentials whose tokens are cached
+        refresh_margin: seconds before its expiry that a cached token is
+          no longer used
+    """
+    super(FileTokenStore, self).__init__(lock=threading.Lock())
+    self._path = path
+    self._lock_path = path + '.lock'
+    self._lock_file = None
+    self._key = credentials_key(credentials)
+    self._credentials = copy.copy(credentials)
+    self._refresh_margin = refresh_margin
+
+  def acquire_lock(self):
+    super(FileTokenStore, self).acquire_lock()
+    try:
+      folder = os.path.dirname(self._path)
+      if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+      self._lock_file = os.fdopen(
+          os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600), 'r+')
+      with metrics.timer('tokens.lock'):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+    except:
+      super(FileTokenStore, self).release_lock()
+      raise
+
+  def release_lock(self):
+    try:
+      fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+      self._lock_file.close()
+      self._lock_file = None
+    finally:
+      super(FileTokenStore, self).release_lock()
+
+  def _read(self):
+    try:
+      with open(self._path) as f:
+        return json.load(f)
+    except IOError as e:
+      if e.errno == errno.ENOENT:
+        return {}
+      raise
+    except ValueError:
+      # A corrupt cache is replaced on the next refresh
+      return {}
+
+  def _write(self, tokens):
+    temp_path = '%s.%d' % (self._path, os.getpid())
+    with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                           0o600), 'w') as f:
+      json.dump(tokens, f, sort_keys=True)
+    os.rename(temp_path, self._path)
+
+  def locked_get(self):
+    """Returns credentials with the cached access token, or None if there is
+    none with more than the refresh margin left."""
+
+    entry = self._read().get(self._key)
+    if entry is None:
+      return None
+
+    expiry = entry.get('token_expiry')
+    if expiry is not None and expiry - time.time() <= self._refresh_margin:
+      return None
+
+    if entry['access_token'] != self._credentials.access_token:
+      # This process would otherwise have requested a token of its own
+      metrics.count('tokens.refreshes_avoided')
+      self._credentials.access_token = entry['access_token']
+      self._credentials.token_expiry = (
+          datetime.datetime.utcfromtimestamp(expiry) if expiry else None)
+      self._credentials.invalid = False
+    return copy.copy(self._credentials)
+
+  def locked_put(self, credentials):
+    """Records refreshed credentials, sharing their access token."""
+
+    self._credentials = copy.copy(credentials)
+    self._credentials.store = None
+
+    tokens = self._read()
+    if credentials.invalid or not credentials.access_token:
+      tokens.pop(self._key, None)
+    else:
+      metrics.count('tokens.refreshes')
+      tokens[self._key] = {
+        'access_token': credentials.access_token,
+        'token_expiry': _to_seconds(credentials.token_expiry),
+      }
+    self._write(tokens)
+
+  def locked_delete(self):
+    tokens = self._read()
+    if tokens.pop(self._key, None) is not None:
+      self._write(tokens)
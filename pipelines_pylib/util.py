@@ -0,0 +1,41 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Helpers for reading the fields of operation and object metadata.
+
+This module imports no other pipelines_pylib module, so that any of them can
+use it.
+"""
+
+import calendar
+import re
+
+_TIMESTAMP = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?Z$')
+
+
+def parse_timestamp(value):
+  """Returns the seconds since the epoch of an RFC 3339 UTC timestamp, such
+  as "2016-03-26T20:24:23.037434420Z"."""
+
+  match = _TIMESTAMP.match(value)
+  if not match:
+    raise ValueError('Unsupported timestamp: %s' % value)
+
+  # Parsed directly rather than with time.strptime(), which is slower and
+  # (in Python 2) not safe to first call from several threads at once
+  seconds = calendar.timegm([int(field) for field in match.groups()[:6]])
+  return seconds + float(match.group(7) or 0)
+
+
+def operation_zone(operation):
+  """Returns the zone an operation's VM is running in, or None if not yet
+  known."""
+
+  runtime = operation.get('metadata', {}).get('runtimeMetadata', {})
+  return runtime.get('computeEngine', {}).get('zone')
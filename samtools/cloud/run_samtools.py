@@ -37,7 +37,25 @@ Usage:
       --logging <gcs-logging-path> \
       --poll-interval <interval-in-seconds>
 
-Where the poll-interval is optional (default is no polling).
+Where the poll-interval is optional (default is no polling). When polling,
+the operations of all the requests are refreshed together.
+
+By default each input BAM is indexed. With --stats, each BAM is also
+summarized with samtools flagstat and samtools idxstats, writing
+<file>.flagstat and <file>.idxstats next to the index. flagstat runs
+alongside the index (both read the BAM once, concurrently), and idxstats,
+which only reads the index, runs once the index is written. The
+collect_samtools_stats.py script summarizes these files across all inputs.
+
+--csi writes a CSI index (<file>.csi) instead of a BAI, as needed for
+references longer than 2^29 bases. --threads sets the number of additional
+BGZF decompression threads (samtools -@) used by each command, and requests a
+VM with that many cores.
+
+The options shared by the batch launchers, such as --input-manifest,
+--journal, --cache-dir, --speculate, --zone-failover, --subscription,
+--quota-regions, --auto-resources and --plan, are described in
+pipelines_pylib/launch.py.
 
 Users will typically want to restrict the Compute Engine zones to avoid Cloud
 Storage egress charges. This script supports a short-hand pattern-matching
@@ -52,13 +70,49 @@ an explicit list may be specified, space-separated:
 """
 
 import argparse
-import pprint
-
-from oauth2client.client import GoogleCredentials
-from apiclient.discovery import build
+import itertools
 
+from pipelines_pylib import clients
 from pipelines_pylib import defaults
-from pipelines_pylib import poller
+from pipelines_pylib import gcs
+from pipelines_pylib import inputs
+from pipelines_pylib import launch
+from pipelines_pylib import metrics
+from pipelines_pylib import packing
+
+def build_command(stats, csi, threads):
+  """Returns the Docker command which indexes (and optionally computes the
+  flagstat and idxstats of) each input."""
+
+  threads_option = '-@ %d ' % threads if threads else ''
+  index_options = threads_option + ('-c ' if csi else '')
+  suffix = 'csi' if csi else 'bai'
+
+  if not stats:
+    return ('mkdir /mnt/data/output && '
+            'find /mnt/data/input && '
+            'for file in $(/bin/ls /mnt/data/input); do '
+              'samtools index %s'
+                '/mnt/data/input/${file} /mnt/data/output/${file}.%s; '
+            'done') % (index_options, suffix)
+
+  # idxstats reads the index, which samtools looks for next to the BAM
+  return ('mkdir /mnt/data/output && '
+          'find /mnt/data/input && '
+          'cd /mnt/data/input && '
+          'STATUS=0; '
+          'for file in $(/bin/ls); do '
+            '(samtools index %s${file} /mnt/data/output/${file}.%s && '
+             'ln -sf /mnt/data/output/${file}.%s ${file}.%s && '
+             'samtools idxstats ${file} > /mnt/data/output/${file}.idxstats) & '
+            'INDEX_PID=$!; '
+            'samtools flagstat %s${file} > /mnt/data/output/${file}.flagstat '
+              '|| STATUS=1; '
+            'wait ${INDEX_PID} || STATUS=1; '
+          'done; '
+          'exit ${STATUS}') % (index_options, suffix, suffix, suffix,
+                               threads_option)
+
 
 # Parse input args
 parser = argparse.ArgumentParser()
@@ -68,22 +122,36 @@ parser.add_argument("--disk-size", required=True, type=int,
                     help="Size (in GB) of disk for both input and output")
 parser.add_argument("--zones", required=True, nargs="+",
                     help="List of Google Compute Engine zones (supports wildcards)")
-parser.add_argument("--input", required=True, nargs="+",
-                    help="Cloud Storage path to input file(s)")
 parser.add_argument("--output", required=True,
                     help="Cloud Storage path to output file (with the .gz extension)")
 parser.add_argument("--logging", required=True,
                     help="Cloud Storage path to send logging output")
-parser.add_argument("--poll-interval", default=0, type=int,
-                    help="Frequency (in seconds) to poll for completion (default: no polling)")
-args = parser.parse_args()
-
-# Create the genomics service
-credentials = GoogleCredentials.get_application_default()
-service = build('genomics', 'v1alpha2', credentials=credentials)
-
-# Run the pipeline
-operation = service.pipelines().run(body={
+parser.add_argument("--stats", action="store_true",
+                    help="Also write samtools flagstat and idxstats output "
+                         "for each input")
+parser.add_argument("--csi", action="store_true",
+                    help="Write a CSI index instead of a BAI index")
+parser.add_argument("--threads", type=int,
+                    help="Additional decompression threads for each samtools "
+                         "command (samtools -@)")
+launch.add_arguments(parser)
+args = launch.parse_args(parser)
+
+# Create the Cloud Storage store, for listing and sizing the inputs
+client_pool = clients.ClientPool()
+store = gcs.GcsStore(client_pool.service('storage', 'v1'))
+
+# Read and expand the inputs lazily, in chunks small enough for one request
+input_paths, input_chunks = launch.read_inputs(parser, args, store)
+
+# The Docker command, followed by packing its outputs if requested
+cmd = build_command(args.stats, args.csi, args.threads)
+if args.pack_outputs:
+  cmd = packing.packed_command(cmd)
+
+# Build the pipeline request
+body_timer = metrics.timer('launcher.build_body').start()
+body = {
   # The ephemeralPipeline provides the template for the pipeline
   # The pipelineArgs provide the inputs specific to this run
 
@@ -116,12 +184,7 @@ operation = service.pipelines().run(body={
 
       # The Pipelines API will create the input directory when localizing files,
       # but does not create the output directory.
-      'cmd': ('mkdir /mnt/data/output && '
-              'find /mnt/data/input && '
-              'for file in $(/bin/ls /mnt/data/input); do '
-                'samtools index '
-                  '/mnt/data/input/${file} /mnt/data/output/${file}.bai; '
-              'done'),
+      'cmd': cmd,
     },
 
     # The Pipelines API currently supports full GCS paths, along with patterns (globs),
@@ -157,16 +220,19 @@ operation = service.pipelines().run(body={
         'path': 'input/',
         'disk': 'datadisk'
       }
-    } for idx in range(len(args.input)) ],
+    } for idx in range(len(input_paths)) ],
 
     # By specifying an outputParameter, we instruct the pipelines API to
     # copy /mnt/data/output/* to the Cloud Storage location specified in
     # the pipelineArgs (see below).
+    # With --pack-outputs, only the archive and index written to
+    # /mnt/data/packed are copied.
     'outputParameters': [ {
       'name': 'outputPath',
       'description': 'Cloud Storage path for where to samtools output',
       'localCopy': {
-        'path': 'output/*',
+        'path': (packing.PACKED_PATH if args.pack_outputs
+                 else 'output/*'),
         'disk': 'datadisk'
       }
     } ]
@@ -197,7 +263,7 @@ operation = service.pipelines().run(body={
     #   <etc>
     # }
     'inputs': {
-      'inputFile%d' % idx : value for idx, value in enumerate(args.input)
+      'inputFile%d' % idx : value for idx, value in enumerate(input_paths)
     },
 
     # Pass the user-specified Cloud Storage destination path of the samtools output
@@ -210,13 +276,18 @@ operation = service.pipelines().run(body={
       'gcsPath': args.logging
     },
   }
-}).execute()
+}
+
+# Each samtools command uses one core per decompression thread
+if args.threads:
+  body['pipelineArgs']['resources']['minimumCpuCores'] = args.threads
+
+body_timer.stop()
 
-# Emit the result of the pipeline run submission
-pp = pprint.PrettyPrinter(indent=2)
-pp.pprint(operation)
+# The first request is for the first chunk of inputs; build one more request
+# per remaining chunk
+requests = itertools.chain(
+    [body], (inputs.with_inputs(body, chunk) for chunk in input_chunks))
 
-# If requested - poll until the operation reaches completion state ("done: true")
-if args.poll_interval > 0:
-  completed_op = poller.poll(service, operation, args.poll_interval)
-  pp.pprint(completed_op)
+# Submit the requests and, if polling, wait for them to complete
+launch.run_batch(args, requests, client_pool, store, min_cores=args.threads or 1)
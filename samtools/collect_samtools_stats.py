@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+"""Summarize samtools flagstat and idxstats output in a single table.
+
+run_samtools.py --stats writes <file>.flagstat and <file>.idxstats for each
+input BAM. This script reads them (many files in parallel) and writes one
+tab-separated row per BAM:
+
+  Filename, the QC-passed counts from flagstat (total, secondary,
+  supplementary, duplicates, mapped, paired, properly paired, singletons,
+  mate mapped to a different chr), the QC-failed total, the percentage
+  mapped and properly paired, and from idxstats the number of reference
+  sequences with mapped reads and the total mapped and unmapped reads.
+
+A BAM with only one of the two files has the other's columns left empty.
+
+Usage:
+  * PYTHONPATH=.. python collect_samtools_stats.py \
+      [--workers <number-of-parallel-reads>] \
+      [--output <local-tsv-path>] \
+      <stats-path> [<stats-path> ...]
+
+Stats paths may be local files or Cloud Storage paths, which may include
+wildcards; files other than *.flagstat and *.idxstats are ignored:
+
+  PYTHONPATH=.. python collect_samtools_stats.py \
+      "gs://YOUR-BUCKET/pipelines-api-examples/samtools/python/output/*"
+
+The PYTHONPATH must include the top-level directory of
+pipelines-api-examples, and reading from Cloud Storage also requires the
+google-api-python-client.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import multiprocessing.pool
+import re
+import sys
+
+from pipelines_pylib import gcs
+
+# flagstat categories included in the summary (in column order)
+FLAGSTAT_CATEGORIES = [
+  'in total',
+  'secondary',
+  'supplementary',
+  'duplicates',
+  'mapped',
+  'paired in sequencing',
+  'properly paired',
+  'singletons',
+  'with mate mapped to a different chr',
+]
+
+COLUMNS = (['Filename'] + FLAGSTAT_CATEGORIES +
+           ['QC-failed', '% mapped', '% properly paired',
+            'References with reads', 'Mapped reads', 'Unmapped reads'])
+
+# "<passed> + <failed> <category>[ (<percentages or totals>)]". The
+# parenthesized "(mapQ>=5)" is part of a category name and is not matched.
+_FLAGSTAT_LINE = re.compile(
+    r'^(\d+) \+ (\d+) (.*?)'
+    r'(?: \((?:[^()]*:[^()]*|QC-passed reads \+ QC-failed reads)\))?$')
+
+STATS_SUFFIXES = ('.flagstat', '.idxstats')
+
+
+def parse_flagstat(lines):
+  """Parses samtools flagstat output.
+
+  Returns:
+      A dict of category -> (QC-passed count, QC-failed count).
+  """
+
+  counts = {}
+  for line in lines:
+    match = _FLAGSTAT_LINE.match(line.strip())
+    if match:
+      passed, failed, category = match.groups()
+      counts[category] = (int(passed), int(failed))
+  return counts
+
+
+def parse_idxstats(lines):
+  """Parses samtools idxstats output.
+
+  Returns:
+      A list of (reference name, length, mapped reads, unmapped reads); the
+      reference "*" counts unmapped reads without a position.
+  """
+
+  references = []
+  for line in lines:
+    if not line.strip():
+      continue
+    name, length, mapped, unmapped = line.rstrip('\n').split('\t')
+    references.append((name, int(length), int(mapped), int(unmapped)))
+  return references
+
+
+def _percent(count, total):
+  return '%.2f' % (100.0 * count / total) if total else ''
+
+
+def summarize(name, flagstat, idxstats):
+  """Returns the summary row (a list of strings) for one BAM.
+
+  Args:
+      name: the BAM file name
+      flagstat: parse_flagstat() result, or None
+      idxstats: parse_idxstats() result, or None
+  """
+
+  row = [name]
+
+  if flagstat is None:
+    row += [''] * (len(FLAGSTAT_CATEGORIES) + 3)
+  else:
+    passed = dict((c, p) for c, (p, _) in flagstat.items())
+    total = passed.get('in total', 0)
+    row += [str(passed.get(c, '')) for c in FLAGSTAT_CATEGORIES]
+    row += [str(flagstat.get('in total', (0, 0))[1]),
+            _percent(passed.get('mapped', 0), total),
+            _percent(passed.get('properly paired', 0),
+                     passed.get('paired in sequencing', 0))]
+
+  if idxstats is None:
+    row += [''] * 3
+  else:
+    row += [str(sum(1 for r in idxstats if r[0] != '*' and r[2])),
+            str(sum(r[2] for r in idxstats)),
+            str(sum(r[3] for r in idxstats))]
+
+  return row
+
+
+def main():
+  """Entry point to the script."""
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--workers", default=16, type=int,
+                      help="Number of stats files to read in parallel")
+  parser.add_argument("--output",
+                      help="Local path to write the summary (default: stdout)")
+  parser.add_argument("stats", nargs="+",
+                      help="Local or Cloud Storage paths to *.flagstat and "
+                           "*.idxstats files")
+  args = parser.parse_args()
+
+  reader = gcs.Reader()
+  paths = [p for p in reader.expand(args.stats) if p.endswith(STATS_SUFFIXES)]
+
+  def parse(path):
+    lines = reader.read(path).decode('utf-8').splitlines()
+    if path.endswith('.flagstat'):
+      return parse_flagstat(lines)
+    return parse_idxstats(lines)
+
+  pool = multiprocessing.pool.ThreadPool(args.workers)
+  try:
+    parsed = pool.map(parse, paths)
+  finally:
+    pool.close()
+
+  # Pair up the stats of each BAM, keyed by the BAM file name
+  stats = collections.OrderedDict()
+  for path, result in sorted(zip(paths, parsed)):
+    base, suffix = path.rsplit('.', 1)
+    stats.setdefault(base.rsplit('/', 1)[-1], {})[suffix] = result
+
+  out = open(args.output, 'w') if args.output else sys.stdout
+  try:
+    print('\t'.join(COLUMNS), file=out)
+    for name, results in stats.items():
+      print('\t'.join(summarize(name, results.get('flagstat'),
+                                results.get('idxstats'))), file=out)
+  finally:
+    if args.output:
+      out.close()
+
+  print("Summarized samtools stats for %d BAMs" % len(stats), file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
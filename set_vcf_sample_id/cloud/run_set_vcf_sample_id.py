@@ -22,6 +22,11 @@ Usage:
 
 Where the poll-interval is optional (default is no polling).
 
+The options shared by the batch launchers, such as --input-manifest,
+--journal, --cache-dir, --speculate, --zone-failover, --subscription,
+--quota-regions, --auto-resources and --plan, are described in
+pipelines_pylib/launch.py.
+
 Users will typically want to restrict the Compute Engine zones to avoid Cloud
 Storage egress charges. This script supports a short-hand pattern-matching
 for specifying zones, such as:
@@ -43,13 +48,15 @@ the ORIGINAL_SAMPLE_ID input parameter is left out of the pipeline definition.
 """
 
 import argparse
-import pprint
-
-from oauth2client.client import GoogleCredentials
-from apiclient.discovery import build
+import itertools
 
+from pipelines_pylib import clients
 from pipelines_pylib import defaults
-from pipelines_pylib import poller
+from pipelines_pylib import gcs
+from pipelines_pylib import inputs
+from pipelines_pylib import launch
+from pipelines_pylib import metrics
+from pipelines_pylib import packing
 
 # Parse input args
 parser = argparse.ArgumentParser()
@@ -65,23 +72,39 @@ parser.add_argument("--new-sample-id", required=True,
                     help="The new sample ID")
 parser.add_argument("--script-path", required=True,
                     help="Cloud Storage path to script file(s)")
-parser.add_argument("--input", required=True, nargs="+",
-                    help="Cloud Storage path to input file(s)")
 parser.add_argument("--output", required=True,
                     help="Cloud Storage path to output file (with the .gz extension)")
 parser.add_argument("--logging", required=True,
                     help="Cloud Storage path to send logging output")
-parser.add_argument("--poll-interval", default=0, type=int,
-                    help="Frequency (in seconds) to poll for completion (default: no polling)")
-args = parser.parse_args()
+launch.add_arguments(parser)
+args = launch.parse_args(parser)
+
 args.script_path.rstrip('/')
 
-# Create the genomics service
-credentials = GoogleCredentials.get_application_default()
-service = build('genomics', 'v1alpha2', credentials=credentials)
+# Create the Cloud Storage store, for listing and sizing the inputs
+client_pool = clients.ClientPool()
+store = gcs.GcsStore(client_pool.service('storage', 'v1'))
+
+# Read and expand the inputs lazily, in chunks small enough for one request
+input_paths, input_chunks = launch.read_inputs(parser, args, store)
+
+# The Docker command, followed by packing its outputs if requested
+cmd = ('mkdir /mnt/data/output && '
 
-# Run the pipeline
-operation = service.pipelines().run(body={
+       'export SCRIPT_DIR=/mnt/data/scripts && '
+       'chmod u+x ${SCRIPT_DIR}/* && '
+
+       '${SCRIPT_DIR}/process_vcfs.sh '
+         '"${ORIGINAL_SAMPLE_ID:-}" '
+         '"${NEW_SAMPLE_ID}" '
+         '"/mnt/data/input/*" '
+         '"/mnt/data/output"')
+if args.pack_outputs:
+  cmd = packing.packed_command(cmd)
+
+# Build the pipeline request
+body_timer = metrics.timer('launcher.build_body').start()
+body = {
   # The ephemeralPipeline provides the template for the pipeline
   # The pipelineArgs provide the inputs specific to this run
 
@@ -115,16 +138,7 @@ operation = service.pipelines().run(body={
       # The Pipelines API will create the input directory when localizing files,
       # but does not create the output directory.
 
-      'cmd': ('mkdir /mnt/data/output && '
-
-              'export SCRIPT_DIR=/mnt/data/scripts && '
-              'chmod u+x ${SCRIPT_DIR}/* && '
-
-              '${SCRIPT_DIR}/process_vcfs.sh '
-                '"${ORIGINAL_SAMPLE_ID:-}" '
-                '"${NEW_SAMPLE_ID}" '
-                '"/mnt/data/input/*" '
-                '"/mnt/data/output"'),
+      'cmd': cmd,
     },
 
     # The inputFile<n> specified in the pipelineArgs (see below) will
@@ -137,7 +151,7 @@ operation = service.pipelines().run(body={
         'path': 'input/',
         'disk': 'datadisk'
       }
-    } for idx in range(len(args.input)) ] + [ {
+    } for idx in range(len(input_paths)) ] + [ {
       'name': 'setVcfSampleId_Script',
       'description': 'Cloud Storage path to process_vcfs.sh script',
       'defaultValue': '%s/process_vcfs.sh' % args.script_path,
@@ -164,11 +178,14 @@ operation = service.pipelines().run(body={
     # By specifying an outputParameter, we instruct the pipelines API to
     # copy /mnt/data/output/* to the Cloud Storage location specified in
     # the pipelineArgs (see below).
+    # With --pack-outputs, only the archive and index written to
+    # /mnt/data/packed are copied.
     'outputParameters': [ {
       'name': 'outputPath',
       'description': 'Cloud Storage path for where to copy the output',
       'localCopy': {
-        'path': 'output/*',
+        'path': (packing.PACKED_PATH if args.pack_outputs
+                 else 'output/*'),
         'disk': 'datadisk'
       }
     } ]
@@ -198,7 +215,7 @@ operation = service.pipelines().run(body={
     #   'inputFile0': 'gs://bucket/<sample>/*.vcf',
     # }
     'inputs': dict( {
-      'inputFile%d' % idx: value for idx, value in enumerate(args.input)
+      'inputFile%d' % idx: value for idx, value in enumerate(input_paths)
     }.items() + ({
       'ORIGINAL_SAMPLE_ID': args.original_sample_id,
     }.items() if args.original_sample_id else []) + {
@@ -215,13 +232,14 @@ operation = service.pipelines().run(body={
       'gcsPath': args.logging
     },
   }
-}).execute()
+}
+
+body_timer.stop()
 
-# Emit the result of the pipeline run submission
-pp = pprint.PrettyPrinter(indent=2)
-pp.pprint(operation)
+# The first request is for the first chunk of inputs; build one more request
+# per remaining chunk
+requests = itertools.chain(
+    [body], (inputs.with_inputs(body, chunk) for chunk in input_chunks))
 
-# If requested - poll until the operation reaches completion state ("done: true")
-if args.poll_interval > 0:
-  completed_op = poller.poll(service, operation, args.poll_interval)
-  pp.pprint(completed_op)
+# Submit the requests and, if polling, wait for them to complete
+launch.run_batch(args, requests, client_pool, store)
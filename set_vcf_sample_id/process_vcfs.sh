@@ -24,17 +24,27 @@
 # The VCFs can be uncompressed or compressed with gzip or bzip2.
 # If the input VCFs are compressed, then the output VCFs will be too.
 #
+# Each VCF is decompressed, updated and recompressed in a single stream, and
+# the output is verified in the same pass: the updated (uncompressed) VCF is
+# checksummed as it is written, and the compressed output is decompressed and
+# checksummed as it is written. If the two differ, the output is corrupt and
+# the script fails. The results are written to manifest.tsv in the output
+# path, with one row per VCF:
+#
+#   file, uncompressed bytes, uncompressed cksum, verification (OK or FAILED)
+#
 # ** Note that this script will delete the input VCF from the local disk. **
 # ** This script is intended to be run as part of a Pipeline on a VM in   **
 # ** the cloud. Deleting the local copy of the input file allows for the  **
 # ** disk to be sized at less than 2x all of the input VCF files, namely: **
 # **                                                                      **
-# **    disk size ~= 2*size(largest uncompressed VCF)                     **
-# **                 + size(remaining VCFs)                               **
+# **    disk size ~= size(all input VCFs)                                 **
+# **                 + size(largest output VCF)                           **
 # **                                                                      **
 
 set -o errexit
 set -o nounset
+set -o pipefail
 
 # Usage:
 #  ./process_vcfs.sh \
@@ -80,59 +90,108 @@ log "END: log runtime details"
 # Process the input files
 
 declare -i COUNT=0
-declare -i SKIPPED=0
+declare -i FAILED=0
 declare -i UPDATED=0
 
+readonly MANIFEST="${OUTPUT_PATH}/manifest.tsv"
+readonly WORK_DIR=$(mktemp -d)
+readonly CONTENT_FIFO="${WORK_DIR}/content.fifo"
+readonly VERIFY_FIFO="${WORK_DIR}/verify.fifo"
+mkfifo "${CONTENT_FIFO}" "${VERIFY_FIFO}"
+
+printf "file\tbytes\tcksum\tverified\n" > "${MANIFEST}"
+
 readonly START=$(date +%s)
 for FILE in ${INPUT_PATH}; do
   # Check if the input file is compressed.
-  # We'll need to decompress it for processing and then compress the output.
-  COMPRESSION=""
+  # It is decompressed as it is read, and the output compressed the same way.
   case "${FILE}" in
     *.gz)
-      COMPRESSION=gz
-      gunzip ${FILE}
-      FILE=${FILE%.gz}
+      DECOMPRESS="gunzip -c"
+      COMPRESS="gzip -c"
+      FILE_NAME=$(basename ${FILE%.gz})
+      OUTPUT_FILE=${OUTPUT_PATH}/${FILE_NAME}.gz
       ;;
 
-   *.bz2)
-      COMPRESSION=bz2
-      bunzip2 ${FILE}
-      FILE=${FILE%.bz2}
+    *.bz2)
+      DECOMPRESS="bunzip2 -c"
+      COMPRESS="bzip2 -c"
+      FILE_NAME=$(basename ${FILE%.bz2})
+      OUTPUT_FILE=${OUTPUT_PATH}/${FILE_NAME}.bz2
       ;;
-  esac
 
-  INPUT_DIR=$(dirname ${FILE})
-  FILE_NAME=$(basename ${FILE})
+    *)
+      DECOMPRESS="cat"
+      COMPRESS="cat"
+      FILE_NAME=$(basename ${FILE})
+      OUTPUT_FILE=${OUTPUT_PATH}/${FILE_NAME}
+      ;;
+  esac
 
   log "Updating header for file ${FILE_NAME}"
-  cat ${FILE} |
+
+  # Checksum the updated VCF, and the decompressed output, as they are written
+  cksum < "${CONTENT_FIFO}" > "${WORK_DIR}/content.sum" &
+  CONTENT_PID=$!
+  ${DECOMPRESS} < "${VERIFY_FIFO}" | cksum > "${WORK_DIR}/verify.sum" &
+  VERIFY_PID=$!
+
+  # With errexit and pipefail, a failing command would end the script before
+  # the file is recorded as FAILED, so the status is captured explicitly
+  STATUS=0
+  ${DECOMPRESS} ${FILE} |
     python \
       "${SCRIPT_DIR}/set_vcf_sample_id.py" \
-      "${ORIG_SAMPLE_ID}" "${NEW_SAMPLE_ID}" \
-      > ${OUTPUT_PATH}/${FILE_NAME}
+      "${ORIG_SAMPLE_ID}" "${NEW_SAMPLE_ID}" |
+    tee "${CONTENT_FIFO}" |
+    ${COMPRESS} |
+    tee "${VERIFY_FIFO}" \
+    > ${OUTPUT_FILE} || STATUS=$?
+
+  VERIFY_STATUS=0
+  wait ${CONTENT_PID} || VERIFY_STATUS=$?
+  wait ${VERIFY_PID} || VERIFY_STATUS=$?
+
+  VERIFIED=OK
+  if [[ ${STATUS} -ne 0 ]]; then
+    log "ERROR: updating ${FILE_NAME} failed with status ${STATUS}"
+    VERIFIED=FAILED
+  fi
+  if [[ ${VERIFY_STATUS} -ne 0 ]]; then
+    VERIFIED=FAILED
+  fi
+
+  CKSUM=
+  BYTES=
+  read CKSUM BYTES < "${WORK_DIR}/content.sum" || true
+  if [[ "$(cat "${WORK_DIR}/verify.sum")" != "${CKSUM} ${BYTES}" ]]; then
+    VERIFIED=FAILED
+  fi
+  printf "%s\t%s\t%s\t%s\n" \
+    "$(basename ${OUTPUT_FILE})" "${BYTES}" "${CKSUM}" "${VERIFIED}" \
+    >> "${MANIFEST}"
+
+  if [[ "${VERIFIED}" == "OK" ]]; then
+    UPDATED=$((UPDATED + 1))
+  else
+    log "ERROR: verification of ${OUTPUT_FILE} failed"
+    FAILED=$((FAILED + 1))
+  fi
 
   # To minimize disk usage, remove the input file now
   rm -f ${FILE}
 
-  UPDATED=$((UPDATED + 1))
-
-  # Compress the output file if the input was compressed
-  case "${COMPRESSION}" in
-    gz)
-      gzip ${OUTPUT_PATH}/${FILE_NAME}
-      ;;
-    bz2)
-      bzip2 ${OUTPUT_PATH}/${FILE_NAME}
-      ;;
-  esac
-
   COUNT=$((COUNT + 1))
 done
 readonly END=$(date +%s)
 
+rm -rf "${WORK_DIR}"
+
 log ""
 log "Updated: ${UPDATED}"
-log "Skipped: ${SKIPPED}"
+log "Failed verification: ${FAILED}"
 log "Total: ${COUNT} files processed in $((END-START)) seconds"
 
+if [[ ${FAILED} -gt 0 ]]; then
+  exit 1
+fi
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+# operations_mirror.py
+#
+# Keeps a local mirror of a project's genomics operations (see
+# pipelines_pylib/mirror.py) and queries it.
+#
+# Sync the mirror (the first sync lists the last 7 days, unless --since is
+# given; later syncs list only operations created since the previous sync,
+# and refresh those which were still running):
+#
+#  PYTHONPATH=.. python operations_mirror.py --db operations.db \
+#    sync --project MY-PROJECT
+#
+# Query it, for example for the operations that failed in the last day:
+#
+#  PYTHONPATH=.. python operations_mirror.py --db operations.db \
+#    query --state FAILED --since 1d
+#
+# Query filters may be combined: --state, --pipeline, --label KEY=VALUE
+# (repeatable), --since and --until (seconds since the epoch, a UTC date or
+# time such as 2017-03-01 or 2017-03-01T12:00:00, or an age such as 12h or
+# 7d) and --error-code. Results are written as tab-separated columns, or with
+# --json as the full operation objects, one per line.
+
+from __future__ import print_function
+
+import argparse
+import calendar
+import json
+import re
+import sys
+import time
+
+from pipelines_pylib import clients
+from pipelines_pylib import mirror
+
+_AGE = re.compile(r'^(\d+(?:\.\d+)?)([smhd])$')
+_AGE_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_time(value):
+  """Returns seconds since the epoch for a time given as seconds, a UTC date
+  or time, or an age (before now)."""
+
+  match = _AGE.match(value)
+  if match:
+    return time.time() - float(match.group(1)) * _AGE_SECONDS[match.group(2)]
+
+  for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+    try:
+      return calendar.timegm(time.strptime(value, fmt))
+    except ValueError:
+      pass
+  return float(value)
+
+
+def format_time(seconds):
+  if seconds is None:
+    return ''
+  return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--db", required=True,
+                      help="Path of the local mirror database")
+  subparsers = parser.add_subparsers(dest="command")
+
+  sync_parser = subparsers.add_parser("sync", help="Update the mirror")
+  sync_parser.add_argument("--project", required=True,
+                           help="Cloud project id")
+  sync_parser.add_argument("--since", type=parse_time,
+                           help="List operations created since this time")
+  sync_parser.add_argument("--workers", default=mirror.DEFAULT_WORKERS,
+                           type=int, help="Number of concurrent requests")
+
+  query_parser = subparsers.add_parser("query", help="Query the mirror")
+  query_parser.add_argument("--project", help="Cloud project id")
+  query_parser.add_argument("--state",
+                            choices=["RUNNING", "SUCCEEDED", "FAILED"])
+  query_parser.add_argument("--pipeline", help="Pipeline name")
+  query_parser.add_argument("--label", action="append", default=[],
+                            help="KEY=VALUE label to match (repeatable)")
+  query_parser.add_argument("--since", type=parse_time,
+                            help="Operations created at or after this time")
+  query_parser.add_argument("--until", type=parse_time,
+                            help="Operations created before this time")
+  query_parser.add_argument("--error-code", type=int,
+                            help="google.rpc.Code of the operation error")
+  query_parser.add_argument("--limit", type=int,
+                            help="Maximum number of operations to return")
+  query_parser.add_argument("--json", action="store_true",
+                            help="Write full operation objects as JSON lines")
+  args = parser.parse_args()
+
+  ops = mirror.OperationsMirror(args.db)
+
+  if args.command == "sync":
+    service = clients.ClientPool().service('genomics', 'v1alpha2')
+    start = time.time()
+    counts = ops.sync(service, args.project, since=args.since,
+                      workers=args.workers)
+    print("Listed %d and refreshed %d operations in %.1f seconds" %
+          (counts['listed'], counts['refreshed'], time.time() - start),
+          file=sys.stderr)
+    return
+
+  labels = dict(label.split('=', 1) for label in args.label)
+  start = time.time()
+  rows = ops.query(project=args.project, state=args.state,
+                   pipeline_name=args.pipeline, labels=labels,
+                   since=args.since, until=args.until,
+                   error_code=args.error_code, limit=args.limit)
+  elapsed = time.time() - start
+
+  if args.json:
+    for row in rows:
+      print(json.dumps(row['operation'], sort_keys=True))
+  else:
+    print('\t'.join(mirror.COLUMNS))
+    for row in rows:
+      row = dict(row)
+      for column in ('create_time', 'start_time', 'end_time'):
+        row[column] = format_time(row[column])
+      print('\t'.join('' if row[c] is None else
+                      str(row[c]).replace('\t', ' ').replace('\n', ' ')
+                      for c in mirror.COLUMNS))
+
+  print("%d operations (%.1f ms)" % (len(rows), elapsed * 1000),
+        file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+# packed_outputs.py
+#
+# Lists and extracts the packed outputs (see pipelines_pylib/packing.py)
+# written by a launcher run with --pack-outputs.
+#
+# List the members of all the archives under an output path:
+#
+#  PYTHONPATH=.. python packed_outputs.py \
+#    --output gs://MY-BUCKET/fastqc/output list
+#
+# Extract members (by name, or wildcard pattern) to a local folder; only the
+# byte range of each member is read from its archive:
+#
+#  PYTHONPATH=.. python packed_outputs.py \
+#    --output gs://MY-BUCKET/fastqc/output extract "sample1*" --dest results
+
+from __future__ import print_function
+
+import argparse
+import fnmatch
+import os
+import sys
+
+from pipelines_pylib import clients
+from pipelines_pylib import gcs
+from pipelines_pylib import packing
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--output", required=True,
+                      help="Cloud Storage output path of the pipelines")
+  subparsers = parser.add_subparsers(dest="command")
+
+  subparsers.add_parser("list", help="List the packed members")
+
+  extract_parser = subparsers.add_parser("extract",
+                                         help="Extract packed members")
+  extract_parser.add_argument("members", nargs="+",
+                              help="Member names or wildcard patterns")
+  extract_parser.add_argument("--dest", default=".",
+                              help="Local folder to extract to")
+  args = parser.parse_args()
+
+  store = gcs.GcsStore(clients.ClientPool().service('storage', 'v1'))
+  outputs = packing.PackedOutputs(store, args.output)
+  members = outputs.members()
+
+  if args.command == "list":
+    for member, (archive, offset, size) in members.items():
+      print('%s\t%d\t%s' % (member, size, archive))
+    return
+
+  selected = [member for member in members
+              if any(fnmatch.fnmatch(member, pattern)
+                     for pattern in args.members)]
+  if not selected:
+    print("No packed outputs match %s" % ' '.join(args.members),
+          file=sys.stderr)
+    sys.exit(1)
+
+  for member in selected:
+    destination = os.path.join(args.dest, member)
+    outputs.extract(member, destination)
+    print(destination)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+# run_plan.py
+#
+# Submits the requests of a plan written by a launcher run with --plan (see
+# pipelines_pylib/planning.py), exactly as they were planned:
+#
+#  PYTHONPATH=.. python ../samtools/cloud/run_samtools.py --plan plan.json ...
+#  PYTHONPATH=.. python run_plan.py plan.json --journal jobs.db
+#
+# The plan's totals are printed first; --summary prints only them. With
+# --journal, re-running the same plan resumes the requests already
+# submitted rather than submitting them again. With --poll-interval, the
+# script waits for the operations to complete and reports those which
+# failed.
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+from pipelines_pylib import clients
+from pipelines_pylib import jobs
+from pipelines_pylib import journal
+from pipelines_pylib import planning
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("plan",
+                      help="Local path of a plan written with --plan")
+  parser.add_argument("--journal",
+                      help="Path to a local job journal; requests already "
+                           "in the journal are resumed, not resubmitted")
+  parser.add_argument("--poll-interval", default=0, type=int,
+                      help="Frequency (in seconds) to poll for completion "
+                           "(default: no polling)")
+  parser.add_argument("--summary", action="store_true",
+                      help="Print the plan's totals without submitting it")
+  args = parser.parse_args()
+
+  plan = planning.read(args.plan)
+  print(planning.summary(plan))
+  if args.summary:
+    return
+
+  service = clients.ClientPool().service('genomics', 'v1alpha2')
+  jrnl = journal.Journal(args.journal) if args.journal else None
+  polling = args.poll_interval > 0
+
+  # Without polling, nothing waits for operations to complete, so the
+  # submissions are not limited by those in flight
+  client = jobs.PipelineClient(
+      service,
+      max_in_flight=jobs.DEFAULT_MAX_IN_FLIGHT if polling else None,
+      poll_interval=(args.poll_interval if polling
+                     else jobs.DEFAULT_POLL_INTERVAL),
+      journal=jrnl)
+  try:
+    futures = [client.run(request['body']) for request in plan['requests']]
+    for future in futures:
+      print(future.submission()['name'])
+
+    if not polling:
+      return
+
+    # The client records the completed operations in the journal
+    failed = 0
+    for future in client.as_completed(futures):
+      completed_op = future.result()
+      if 'error' in completed_op:
+        failed += 1
+        print("%s failed: %s" % (completed_op['name'],
+                                 completed_op['error'].get('message')),
+              file=sys.stderr)
+  finally:
+    client.close()
+
+  print("%d of %d operations succeeded" %
+        (len(futures) - failed, len(futures)))
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
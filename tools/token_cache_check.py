@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+# Copyright 2017 Google Inc.
+#
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file or at
+# https://developers.google.com/open-source/licenses/bsd
+
+# token_cache_check.py
+#
+# Checks the cross-process access token cache (see pipelines_pylib/tokens.py)
+# against a fake OAuth2 token endpoint, without any Google credentials.
+#
+# The script serves a fake token endpoint and a fake API (which accepts only
+# unexpired tokens from the endpoint) on localhost, then starts --processes
+# processes, as a scheduler would start launchers. Each creates a
+# clients.ClientPool for the same (fake) credentials and makes --requests
+# requests, --interval seconds apart. It reports the token exchanges made,
+# the refreshes that the cache avoided and any rejected requests:
+#
+#  PYTHONPATH=.. python token_cache_check.py --processes 50
+#
+# With --no-cache, each process exchanges its own token, for comparison.
+# Short --expires-in values (with --requests and --interval) exercise
+# refreshes shortly before expiry.
+
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from oauth2client import client
+
+from pipelines_pylib import clients
+from pipelines_pylib import metrics
+
+
+class FakeEndpoints(BaseHTTPServer.HTTPServer):
+  """A token endpoint (POST /token) and an API (GET /api)."""
+
+  def __init__(self, expires_in):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _Handler)
+    self.expires_in = expires_in
+    self.lock = threading.Lock()
+    self.tokens = {}  # access token -> expiry
+    self.exchanges = 0
+    self.rejected = 0
+
+  def url(self, path):
+    return 'http://127.0.0.1:%d%s' % (self.server_port, path)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def _reply(self, status, body):
+    data = json.dumps(body).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+    server = self.server
+    with server.lock:
+      server.exchanges += 1
+      token = 'token-%d' % server.exchanges
+      server.tokens[token] = time.time() + server.expires_in
+    self._reply(200, {'access_token': token,
+                      'expires_in': server.expires_in,
+                      'token_type': 'Bearer'})
+
+  def do_GET(self):
+    server = self.server
+    token = self.headers.getheader('Authorization', '')[len('Bearer '):]
+    with server.lock:
+      valid = server.tokens.get(token, 0) > time.time()
+      if not valid:
+        server.rejected += 1
+    self._reply(200 if valid else 401, {'ok': valid})
+
+  def log_message(self, *args):
+    pass
+
+
+def run_process(token_uri, api_uri, token_cache, requests, interval):
+  """Makes requests with a new ClientPool; returns its metrics counters."""
+
+  metrics.enable()
+  credentials = client.OAuth2Credentials(
+      None, 'fake-client-id', 'fake-client-secret', 'fake-refresh-token',
+      None, token_uri, None)
+  pool = clients.ClientPool(credentials=credentials, token_cache=token_cache)
+
+  for i in range(requests):
+    if i:
+      time.sleep(interval)
+    # As before each API request, replace a token about to expire, then
+    # send the request with the thread's authorized Http
+    pool._refresh_if_expiring()  # pylint: disable=protected-access
+    pool.http().request(api_uri)
+
+  return dict((line['name'], line['value']) for line in metrics.snapshot()
+              if line['type'] == 'counter')
+
+
+def _run_process(args):
+  return run_process(*args)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--processes", default=20, type=int,
+                      help="Number of processes to start")
+  parser.add_argument("--parallel", default=10, type=int,
+                      help="Number of processes running at once")
+  parser.add_argument("--requests", default=1, type=int,
+                      help="Requests made by each process")
+  parser.add_argument("--interval", default=0, type=float,
+                      help="Seconds between the requests of a process")
+  parser.add_argument("--expires-in", default=3600, type=int,
+                      help="Lifetime (in seconds) of the fake tokens")
+  parser.add_argument("--no-cache", action="store_true",
+                      help="Do not share tokens between processes")
+  args = parser.parse_args()
+
+  server = FakeEndpoints(args.expires_in)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+  folder = tempfile.mkdtemp()
+  token_cache = None if args.no_cache else os.path.join(folder, 'tokens.json')
+  try:
+    # A new process for each run, as a scheduler would start launchers
+    pool = multiprocessing.Pool(args.parallel, maxtasksperchild=1)
+    start = time.time()
+    counters = pool.map(_run_process, [
+        (server.url('/token'), server.url('/api'), token_cache,
+         args.requests, args.interval)] * args.processes)
+    elapsed = time.time() - start
+    pool.close()
+  finally:
+    server.shutdown()
+    shutil.rmtree(folder)
+
+  print("%d processes made %d requests in %.1f seconds" %
+        (args.processes, args.processes * args.requests, elapsed))
+  print("Token exchanges:         %d" % server.exchanges)
+  print("Refreshes avoided:       %d" %
+        sum(c.get('tokens.refreshes_avoided', 0) for c in counters))
+  print("Requests rejected (401): %d" % server.rejected)
+
+
+if __name__ == "__main__":
+  main()